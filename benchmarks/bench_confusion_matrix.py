@@ -0,0 +1,67 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''Runtime of confusion matrix counting and plotting with many classes.
+
+Times the integer-coded counting of the confusion matrix against
+sklearn.metrics.confusion_matrix, the per-class sample size labels, and
+the whole of _plot_confusion_matrix (which draws classes in blocks when
+there are more than 100 classes), for increasing numbers of classes.
+
+    python benchmarks/bench_confusion_matrix.py [max_classes]
+'''
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import confusion_matrix
+
+from q2_sample_classifier.visuals import (
+    _confusion_counts, _add_sample_size_to_xtick_labels,
+    _plot_confusion_matrix)
+
+
+def _data(n_classes, samples_per_class=10, accuracy=0.7, seed=0):
+    rng = np.random.RandomState(seed)
+    classes = np.array(['class{0:05d}'.format(i) for i in range(n_classes)])
+    truth = np.repeat(classes, samples_per_class)
+    predicted = np.where(rng.rand(len(truth)) < accuracy, truth,
+                         rng.choice(classes, len(truth)))
+    return (pd.Series(truth, name='truth'),
+            pd.Series(predicted, name='prediction'), list(classes))
+
+
+def _time(f, *args, **kwargs):
+    start = time.perf_counter()
+    f(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def main(max_classes=2000):
+    import matplotlib.pyplot as plt
+
+    print('{0:>8} {1:>10} {2:>10} {3:>10} {4:>10}'.format(
+        'classes', 'sklearn', 'bincount', 'labels', 'plot'))
+    n_classes = 50
+    while n_classes <= max_classes:
+        y_test, y_pred, classes = _data(n_classes)
+        print('{0:>8} {1:>10.3f} {2:>10.3f} {3:>10.3f} {4:>10.2f}'.format(
+            n_classes,
+            _time(confusion_matrix, y_test, y_pred, labels=classes),
+            _time(_confusion_counts, y_test, y_pred, classes),
+            _time(_add_sample_size_to_xtick_labels, y_test, classes),
+            _time(_plot_confusion_matrix, y_test, y_pred, classes,
+                  normalize=True, palette='sirocco')))
+        plt.close('all')
+        n_classes *= 2
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,80 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''Per-fold cost of collecting nested CV predictions and probabilities.
+
+Compares the previous approach (growing the output frames with pd.concat
+after every fold) with _collect_cv_predictions, which fills preallocated
+arrays and builds the frames once. Fold outputs are synthetic, so only the
+accumulation is timed, not model fitting.
+
+    python benchmarks/bench_cv_accumulation.py
+'''
+
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import KFold
+
+from q2_sample_classifier.utilities import _collect_cv_predictions
+
+
+N_SAMPLES = 4000
+FOLD_COUNTS = [10, 100, 1000, 4000]
+CLASSES = pd.Index(['class{0}'.format(i) for i in range(10)])
+
+
+def _fold_outputs(n_folds, seed=0):
+    rng = np.random.RandomState(seed)
+    index = pd.Index(['s{0}'.format(i) for i in range(N_SAMPLES)])
+    folds = list(KFold(n_splits=n_folds).split(np.empty(N_SAMPLES)))
+    preds, probs = [], []
+    for _, test_index in folds:
+        preds.append(rng.choice(CLASSES.values, len(test_index)))
+        probs.append((rng.rand(len(test_index), len(CLASSES)), CLASSES))
+    return index, folds, preds, probs
+
+
+def concat_per_fold(index, folds, preds, probs):
+    predictions = pd.DataFrame()
+    probabilities = pd.DataFrame()
+    for (_, test_index), pred, (prob, classes) in zip(folds, preds, probs):
+        sample_ids = index[test_index]
+        predictions = pd.concat(
+            [predictions, pd.DataFrame(pred, index=sample_ids)])
+        probabilities = pd.concat([probabilities, pd.DataFrame(
+            prob, index=sample_ids, columns=classes)])
+    return predictions, probabilities
+
+
+def preallocated(index, folds, preds, probs):
+    return _collect_cv_predictions(index, folds, preds, probs)
+
+
+def _time(func, args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print('{0:>6} {1:>22} {2:>22}'.format(
+        'folds', 'concat us/fold', 'preallocated us/fold'))
+    for n_folds in FOLD_COUNTS:
+        args = _fold_outputs(n_folds)
+        old = _time(concat_per_fold, args) / n_folds * 1e6
+        new = _time(preallocated, args) / n_folds * 1e6
+        print('{0:>6} {1:>22.1f} {2:>22.1f}'.format(n_folds, old, new))
+
+
+if __name__ == '__main__':
+    main()
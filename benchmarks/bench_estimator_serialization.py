@@ -0,0 +1,109 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''Save and load time of SampleEstimator artifacts.
+
+Compares the legacy layout (joblib dump into a temporary directory, tarred,
+then copied into the artifact; extracted again before every load) with the
+sklearn_pipeline.joblib layout, which is dumped and loaded in place, with
+and without compression. The steps of the transformers are reproduced on
+plain directories, so that only serialization is timed.
+
+    python benchmarks/bench_estimator_serialization.py
+'''
+
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+import joblib
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import Pipeline
+
+from q2_sample_classifier.utilities import SparseFeatureVectorizer
+
+
+N_SAMPLES = 2000
+N_FEATURES = 500
+TREE_COUNTS = [100, 500]
+
+
+def _pipeline(n_estimators, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.rand(N_SAMPLES, N_FEATURES)
+    y = rng.randint(0, 5, N_SAMPLES)
+    est = RandomForestClassifier(n_estimators=n_estimators, random_state=0,
+                                 n_jobs=-1).fit(X, y)
+    return Pipeline([('dv', SparseFeatureVectorizer()), ('est', est)])
+
+
+def save_legacy(pipeline, artifact_dir):
+    tmpdir = tempfile.mkdtemp()
+    tar_fp = os.path.join(tmpdir, 'sklearn_pipeline.tar')
+    with tarfile.open(tar_fp, 'w') as tar:
+        pf = os.path.join(tmpdir, 'sklearn_pipeline.pkl')
+        for fn in joblib.dump(pipeline, pf):
+            tar.add(fn, os.path.basename(fn))
+            os.unlink(fn)
+    shutil.copy(tar_fp, artifact_dir)
+    shutil.rmtree(tmpdir)
+    return os.path.join(artifact_dir, 'sklearn_pipeline.tar')
+
+
+def load_legacy(artifact_dir):
+    with tarfile.open(os.path.join(artifact_dir, 'sklearn_pipeline.tar')) \
+            as tar:
+        dirname = tempfile.mkdtemp()
+        tar.extractall(dirname)
+        pipeline = joblib.load(os.path.join(dirname, 'sklearn_pipeline.pkl'))
+        shutil.rmtree(dirname)
+    return pipeline
+
+
+def save_joblib(pipeline, artifact_dir, compress=0):
+    fp = os.path.join(artifact_dir, 'sklearn_pipeline.joblib')
+    joblib.dump(pipeline, fp, compress=compress)
+    return fp
+
+
+def load_joblib(artifact_dir):
+    return joblib.load(os.path.join(artifact_dir, 'sklearn_pipeline.joblib'))
+
+
+def _time(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    layouts = [('legacy tar', save_legacy, load_legacy, ()),
+               ('joblib', save_joblib, load_joblib, (0,)),
+               ('joblib compress=3', save_joblib, load_joblib, (3,))]
+    print('{0:>6} {1:>18} {2:>10} {3:>10} {4:>10}'.format(
+        'trees', 'layout', 'save s', 'load s', 'size MB'))
+    for n_estimators in TREE_COUNTS:
+        pipeline = _pipeline(n_estimators)
+        for name, save, load, args in layouts:
+            artifact_dir = tempfile.mkdtemp()
+            save_s, fp = _time(save, pipeline, artifact_dir, *args)
+            load_s, _ = _time(load, artifact_dir)
+            size = os.path.getsize(fp) / 1e6
+            shutil.rmtree(artifact_dir)
+            print('{0:>6} {1:>18} {2:>10.3f} {3:>10.3f} {4:>10.1f}'.format(
+                n_estimators, name, save_s, load_s, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''Runtime of the confusion_matrix visualizer on a 200-class problem.
+
+Runs confusion_matrix, with class probabilities so that a ROC plot with
+200 curves is also drawn, with figures saved as PNG and PDF one at a time,
+as PNG and PDF in parallel worker processes, and as SVG only.
+
+    python benchmarks/bench_figure_export.py [n_classes]
+'''
+
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import qiime2
+
+from q2_sample_classifier.classify import confusion_matrix
+
+
+def _data(n_classes, samples_per_class=20, accuracy=0.7, seed=0):
+    rng = np.random.RandomState(seed)
+    classes = np.array(['class{0}'.format(i) for i in range(n_classes)])
+    ids = pd.Index(['sample{0}'.format(i)
+                    for i in range(n_classes * samples_per_class)], name='id')
+    truth = np.repeat(classes, samples_per_class)
+    predicted = np.where(rng.rand(len(truth)) < accuracy, truth,
+                         rng.choice(classes, len(truth)))
+    probabilities = pd.DataFrame(
+        rng.dirichlet(np.ones(n_classes), len(truth)), index=ids,
+        columns=classes)
+    return (pd.Series(predicted, index=ids, name='prediction'),
+            qiime2.CategoricalMetadataColumn(
+                pd.Series(truth, index=ids, name='truth')),
+            probabilities)
+
+
+def _run(predictions, truth, probabilities, **kwargs):
+    output_dir = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        confusion_matrix(output_dir, predictions, truth, probabilities,
+                         **kwargs)
+        return time.perf_counter() - start
+    finally:
+        shutil.rmtree(output_dir)
+
+
+def main(n_classes=200):
+    predictions, truth, probabilities = _data(n_classes)
+    print('{0:>8} {1:>14} {2:>7} {3:>10}'.format(
+        'classes', 'figure_format', 'n_jobs', 'seconds'))
+    for figure_format, n_jobs in [('png+pdf', 1), ('png+pdf', 4),
+                                  ('svg', 1), ('svg', 2)]:
+        seconds = _run(predictions, truth, probabilities,
+                       figure_format=figure_format, n_jobs=n_jobs)
+        print('{0:>8} {1:>14} {2:>7} {3:>10.2f}'.format(
+            n_classes, figure_format, n_jobs, seconds))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
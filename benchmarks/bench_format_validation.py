@@ -0,0 +1,104 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''Validation time of Probabilities and Predictions files at level='max'.
+
+Compares the previous line-by-line validation (every line split and
+stripped, every value passed to float() in a list comprehension) with the
+chunked validation of ProbabilitiesFormat and PredictionsFormat, which
+counts fields and parses the values of many lines at once.
+
+    python benchmarks/bench_format_validation.py
+'''
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from q2_sample_classifier import ProbabilitiesFormat, PredictionsFormat
+
+
+# (samples, classes)
+SHAPES = [(10000, 500), (50000, 500)]
+
+
+def _write_tables(tmpdir, n_samples, n_classes, seed=0):
+    rng = np.random.RandomState(seed)
+    probabilities = pd.DataFrame(
+        rng.dirichlet(np.ones(n_classes), n_samples),
+        index=['sample{0}'.format(i) for i in range(n_samples)],
+        columns=['class{0}'.format(i) for i in range(n_classes)])
+    probabilities_fp = os.path.join(tmpdir, 'class_probabilities.tsv')
+    probabilities.to_csv(probabilities_fp, sep='\t', header=True)
+    predictions = probabilities.idxmax(axis=1).rename('prediction')
+    predictions_fp = os.path.join(tmpdir, 'predictions.tsv')
+    predictions.to_csv(predictions_fp, sep='\t', header=True)
+    return probabilities_fp, predictions_fp
+
+
+def line_by_line_numeric(fp):
+    with open(fp) as fh:
+        fh.readline()
+        for line_number, line in enumerate(fh, start=2):
+            cells = [c.strip() for c in line.split('\t')]
+            if len(cells) < 2:
+                raise ValueError(line_number)
+            [float(c) for c in cells[1:]]
+
+
+def line_by_line_predictions(fp):
+    with open(fp) as fh:
+        fh.readline()
+        for line_number, line in enumerate(fh, start=2):
+            cells = [c.strip() for c in line.split('\t')]
+            if len(cells) != 2:
+                raise ValueError(line_number)
+
+
+def chunked(fmt, fp):
+    fmt(fp, mode='r').validate(level='max')
+
+
+def _time(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    print('{0:>8} {1:>8} {2:>14} {3:>14} {4:>10} {5:>9}'.format(
+        'samples', 'classes', 'format', 'line by line s', 'chunked s',
+        'speedup'))
+    try:
+        for n_samples, n_classes in SHAPES:
+            probabilities_fp, predictions_fp = _write_tables(
+                tmpdir, n_samples, n_classes)
+            for name, old, fmt, fp in [
+                    ('Probabilities', line_by_line_numeric,
+                     ProbabilitiesFormat, probabilities_fp),
+                    ('Predictions', line_by_line_predictions,
+                     PredictionsFormat, predictions_fp)]:
+                old_s = _time(old, fp, repeat=1)
+                new_s = _time(chunked, fmt, fp)
+                print('{0:>8} {1:>8} {2:>14} {3:>14.3f} {4:>10.3f} '
+                      '{5:>8.1f}x'.format(n_samples, n_classes, name, old_s,
+                                          new_s, old_s / new_s))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''Import time of the plugin, as paid by every qiime CLI command.
+
+Imports q2_sample_classifier.plugin_setup (the plugin entry point) in a
+fresh interpreter with `python -X importtime`, and reports the cumulative
+import time of the plugin and of the slow dependencies that are meant to be
+imported only by the functions that use them. Dependencies that were not
+imported are reported as such. The median of several runs is reported.
+
+    python benchmarks/bench_import_time.py [n_runs]
+'''
+
+import subprocess
+import sys
+
+import numpy as np
+
+
+MODULES = ['q2_sample_classifier.plugin_setup', 'q2_sample_classifier',
+           'seaborn', 'matplotlib.pyplot', 'q2templates', 'pkg_resources',
+           'sklearn.ensemble', 'sklearn.svm', 'sklearn.linear_model',
+           'sklearn.neighbors', 'sklearn.feature_selection']
+
+
+def import_times(module='q2_sample_classifier.plugin_setup'):
+    '''Cumulative import time (s) of each module imported by `module`.'''
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+    times = {}
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def main(n_runs=5):
+    runs = [import_times() for _ in range(n_runs)]
+    print('{0:>36} {1:>14}'.format('module', 'cumulative s'))
+    for module in MODULES:
+        times = [run[module] for run in runs if module in run]
+        if times:
+            print('{0:>36} {1:>14.3f}'.format(module, np.median(times)))
+        else:
+            print('{0:>36} {1:>14}'.format(module, 'not imported'))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
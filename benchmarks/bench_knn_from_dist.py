@@ -0,0 +1,94 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''Leave-one-out KNN classification from a distance matrix.
+
+Compares the previous per-sample loop of classify_samples_from_dist (one
+pd.Series, nsmallest and Counter per sample) with _loo_knn_predict, which
+partitions blocks of rows at once and votes with bincount. Both are run on
+the same random symmetric matrix and their predictions are checked to be
+equal.
+
+    python benchmarks/bench_knn_from_dist.py
+'''
+
+import collections
+import time
+
+import numpy as np
+import pandas as pd
+
+from q2_sample_classifier.utilities import _loo_knn_predict
+
+
+SAMPLE_COUNTS = [500, 1000, 2000]
+K = 5
+CLASSES = np.array(['class{0}'.format(i) for i in range(8)], dtype=object)
+
+
+def _distances(n_samples, seed=0):
+    rng = np.random.RandomState(seed)
+    points = rng.rand(n_samples, 10)
+    sq = (points ** 2).sum(axis=1)
+    distances = np.sqrt(np.maximum(
+        sq[:, None] + sq[None, :] - 2 * points @ points.T, 0))
+    np.fill_diagonal(distances, 0)
+    labels = rng.choice(CLASSES, n_samples)
+    return distances, labels
+
+
+def per_sample_loop(distances, labels, k):
+    ids = ['s{0}'.format(i) for i in range(len(labels))]
+    metadata = pd.Series(labels, index=ids)
+    predictions = []
+    for i, row in enumerate(distances):
+        dists = []
+        categories = []
+        for j, dist in enumerate(row):
+            if j == i:
+                continue
+            dists.append(dist)
+            categories.append(metadata[ids[j]])
+        nn = pd.Series(dists, index=categories).nsmallest(k)
+        counter = collections.Counter(nn.index)
+        max_counts = max(counter.values())
+        for category in nn.index:
+            if counter[category] == max_counts:
+                predictions.append(category)
+                break
+    return np.array(predictions, dtype=object)
+
+
+def vectorized(distances, labels, k):
+    return _loo_knn_predict(distances, labels, k)
+
+
+def _time(func, args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    print('{0:>8} {1:>12} {2:>14} {3:>9}'.format(
+        'samples', 'loop s', 'vectorized s', 'speedup'))
+    for n_samples in SAMPLE_COUNTS:
+        distances, labels = _distances(n_samples)
+        old, expected = _time(
+            per_sample_loop, (distances, labels, K), repeat=1)
+        new, observed = _time(vectorized, (distances, labels, K))
+        assert (expected == observed).all()
+        print('{0:>8} {1:>12.3f} {2:>14.4f} {3:>8.0f}x'.format(
+            n_samples, old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
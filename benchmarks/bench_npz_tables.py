@@ -0,0 +1,74 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''Writing, validating and reading Probabilities and Importance tables as
+TSV and as npz.
+
+Each table is written, validated at level='max' and read back through the
+ProbabilitiesFormat (TSV) and ProbabilitiesNPZFormat transformers. The
+tables read back from both formats are checked to be equal.
+
+    python benchmarks/bench_npz_tables.py
+'''
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from q2_sample_classifier import ProbabilitiesFormat, ProbabilitiesNPZFormat
+from q2_sample_classifier.plugin_setup import plugin
+
+
+# (samples, columns): probabilities tables and a feature importance table
+SHAPES = [(10000, 500), (50000, 500), (100000, 1)]
+
+
+def _table(n_samples, n_columns, seed=0):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame(
+        rng.dirichlet(np.ones(n_columns), n_samples),
+        index=pd.Index(['sample{0}'.format(i) for i in range(n_samples)],
+                       name='id'),
+        columns=['class{0}'.format(i) for i in range(n_columns)])
+
+
+def _transformer(from_type, to_type):
+    return plugin.transformers[from_type][to_type].transformer
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def _round_trip(fmt, df):
+    write_s, ff = _timed(_transformer(pd.DataFrame, fmt), df)
+    validate_s, _ = _timed(ff.validate, 'max')
+    read_s, result = _timed(_transformer(fmt, pd.DataFrame), ff)
+    return (write_s, validate_s, read_s), result
+
+
+def main():
+    print('{0:>8} {1:>8} {2:>6} {3:>9} {4:>10} {5:>8}'.format(
+        'samples', 'columns', 'format', 'write s', 'validate s', 'read s'))
+    for n_samples, n_columns in SHAPES:
+        df = _table(n_samples, n_columns)
+        results = []
+        for name, fmt in [('tsv', ProbabilitiesFormat),
+                          ('npz', ProbabilitiesNPZFormat)]:
+            times, result = _round_trip(fmt, df)
+            results.append(result)
+            print('{0:>8} {1:>8} {2:>6} {3:>9.3f} {4:>10.3f} {5:>8.3f}'
+                  .format(n_samples, n_columns, name, *times))
+        pd.testing.assert_frame_equal(*results)
+
+
+if __name__ == '__main__':
+    main()
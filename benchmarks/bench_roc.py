@@ -0,0 +1,65 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''Runtime of the ROC curves for many samples and classes.
+
+Times the per-class ROC curves (_roc_per_class), the macro average, and the
+whole of _generate_roc_plots, and reports the number of vertices plotted.
+
+    python benchmarks/bench_roc.py [n_samples] [n_classes]
+'''
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from q2_sample_classifier.visuals import (
+    _binarize_labels, _roc_per_class, _roc_macro_average,
+    _generate_roc_plots)
+
+
+def _data(n_samples, n_classes, seed=0):
+    rng = np.random.RandomState(seed)
+    classes = ['class{0}'.format(i) for i in range(n_classes)]
+    truth = pd.Series(rng.choice(classes, n_samples))
+    probabilities = pd.DataFrame(
+        rng.dirichlet(np.ones(n_classes), n_samples), columns=classes)
+    return truth, probabilities
+
+
+def _time(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return time.perf_counter() - start, result
+
+
+def main(n_samples=50000, n_classes=300):
+    import matplotlib.pyplot as plt
+
+    truth, probabilities = _data(n_samples, n_classes)
+    classes = list(probabilities.columns)
+    targets = _binarize_labels(truth, classes)
+    probs = probabilities.values
+
+    seconds, (fpr, tpr, roc_auc) = _time(
+        _roc_per_class, targets, probs, classes)
+    print('{0:>32} {1:>10.2f}'.format('_roc_per_class', seconds))
+    seconds, _ = _time(_roc_macro_average, fpr, tpr, roc_auc, classes)
+    print('{0:>32} {1:>10.2f}'.format('_roc_macro_average', seconds))
+    seconds, fig = _time(_generate_roc_plots, truth, probabilities, 'sirocco')
+    print('{0:>32} {1:>10.2f}'.format('_generate_roc_plots', seconds))
+    vertices = sum(len(line.get_xdata()) for ax in fig.axes
+                   for line in ax.get_lines())
+    print('{0:>32} {1:>10}'.format('plotted vertices', vertices))
+    plt.close('all')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
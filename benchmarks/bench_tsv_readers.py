@@ -0,0 +1,83 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''Reading Probabilities and Importance TSV files into DataFrames.
+
+Compares the previous reader of the Importance, Probabilities and
+QueryDistances transformers (every cell read as a string, then each column
+converted with pd.to_numeric) with _read_numeric_dataframe, which parses
+the values straight into float64 in one pass. Both are run on the same
+files and their results are checked to be equal.
+
+    python benchmarks/bench_tsv_readers.py
+'''
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from q2_sample_classifier._transformer import (
+    _read_dataframe, _read_numeric_dataframe)
+
+
+# (samples, columns): a probabilities table and a feature importance table
+SHAPES = [(10000, 500), (50000, 500), (100000, 1)]
+
+
+def _write_table(fp, n_samples, n_columns, seed=0):
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame(
+        rng.dirichlet(np.ones(n_columns), n_samples),
+        index=['sample{0}'.format(i) for i in range(n_samples)],
+        columns=['class{0}'.format(i) for i in range(n_columns)])
+    df.to_csv(fp, sep='\t', na_rep=np.nan, header=True)
+
+
+def per_column_to_numeric(fp):
+    with open(fp) as fh:
+        return _read_dataframe(fh).apply(
+            lambda x: pd.to_numeric(x, errors='raise'))
+
+
+def single_pass(fp):
+    with open(fp) as fh:
+        return _read_numeric_dataframe(fh)
+
+
+def _time(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    print('{0:>8} {1:>8} {2:>14} {3:>14} {4:>9}'.format(
+        'samples', 'columns', 'to_numeric s', 'single pass s', 'speedup'))
+    try:
+        for n_samples, n_columns in SHAPES:
+            fp = os.path.join(tmpdir, 'table.tsv')
+            _write_table(fp, n_samples, n_columns)
+            old, expected = _time(per_column_to_numeric, fp, repeat=1)
+            new, observed = _time(single_pass, fp)
+            pd.testing.assert_frame_equal(expected, observed)
+            print('{0:>8} {1:>8} {2:>14.3f} {3:>14.3f} {4:>8.1f}x'.format(
+                n_samples, n_columns, old, new, old / new))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,10 +10,15 @@ from ._format import (
     BooleanSeriesFormat, BooleanSeriesDirectoryFormat,
     PredictionsFormat, PredictionsDirectoryFormat, ImportanceFormat,
     ImportanceDirectoryFormat, SampleEstimatorDirFmt, PickleFormat,
-    ProbabilitiesFormat, ProbabilitiesDirectoryFormat)
+    JoblibFormat, ProbabilitiesFormat, ProbabilitiesDirectoryFormat,
+    QueryDistancesFormat, QueryDistancesDirectoryFormat, ImportanceNPZFormat,
+    ProbabilitiesNPZFormat)
 from ._type import (BooleanSeries, ClassifierPredictions, RegressorPredictions,
                     Importance, SampleEstimator, Classifier, Regressor,
-                    Probabilities)
+                    Probabilities, QueryDistances)
+from ._estimator_cache import estimator_cache
+from ._model_index import ModelIndex
+from ._save_options import set_save_options
 from ._version import get_versions
 
 
@@ -23,7 +28,12 @@ del get_versions
 __all__ = ['BooleanSeriesFormat', 'BooleanSeriesDirectoryFormat',
            'PredictionsFormat', 'PredictionsDirectoryFormat',
            'ImportanceFormat', 'ImportanceDirectoryFormat',
-           'SampleEstimatorDirFmt', 'PickleFormat', 'BooleanSeries',
+           'SampleEstimatorDirFmt', 'PickleFormat', 'JoblibFormat',
+           'BooleanSeries',
            'ClassifierPredictions', 'RegressorPredictions', 'Importance',
            'Classifier', 'Regressor', 'SampleEstimator', 'Probabilities',
-           'ProbabilitiesFormat', 'ProbabilitiesDirectoryFormat']
+           'ProbabilitiesFormat', 'ProbabilitiesDirectoryFormat',
+           'QueryDistances', 'QueryDistancesFormat',
+           'QueryDistancesDirectoryFormat', 'ImportanceNPZFormat',
+           'ProbabilitiesNPZFormat', 'estimator_cache', 'ModelIndex',
+           'set_save_options']
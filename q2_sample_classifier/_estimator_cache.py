@@ -0,0 +1,160 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''In-process cache of deserialized SampleEstimator pipelines.
+
+Viewing the same SampleEstimator artifact as a Pipeline repeatedly (e.g.,
+calling predict_classification on many tables from a notebook or a batch
+script) would otherwise unpickle the model every time. Loaded pipelines are
+kept in a bounded LRU cache, keyed by the UUID of the artifact when the
+model file sits in an artifact's data directory, or by the path, size and
+modification time of the model file otherwise.
+
+The cache is bounded by entry count and by the estimated in-memory size of
+the cached pipelines; either bound can be disabled with None, and
+max_entries=0 disables caching altogether:
+
+    from q2_sample_classifier import estimator_cache
+    estimator_cache.configure(max_entries=8, max_bytes=4 * 1024 ** 3)
+
+Each view gets its own shallow copy of the cached pipeline and of its
+steps, so that setting parameters (e.g., n_jobs) or replacing steps on one
+view does not affect the others. The fitted arrays are shared and should
+be treated as read-only.
+'''
+
+import collections
+import copy
+import threading
+
+import numpy as np
+
+
+def _artifact_uuid(model_fp):
+    # artifacts are extracted as <root>/data/<files>, next to
+    # <root>/metadata.yaml, which records the UUID of the artifact
+    metadata_fp = model_fp.parent.parent / 'metadata.yaml'
+    if model_fp.parent.name != 'data' or not metadata_fp.exists():
+        return None
+    with open(str(metadata_fp)) as fh:
+        for line in fh:
+            if line.startswith('uuid:'):
+                return line.split(':', 1)[1].strip()
+    return None
+
+
+def _file_key(model_fp):
+    # checksumming multi-GB models on every view would cost as much as
+    # loading them
+    stat = model_fp.stat()
+    return (str(model_fp.resolve()), stat.st_size, stat.st_mtime_ns)
+
+
+def _copy_pipeline(pipeline):
+    '''Shallow copy of a pipeline and of each of its steps.'''
+    result = copy.copy(pipeline)
+    result.steps = [(name, copy.copy(step)) for name, step in pipeline.steps]
+    return result
+
+
+def _estimate_nbytes(obj, seen=None):
+    '''Approximate heap size of the numpy arrays held by obj. Memory-mapped
+    arrays are backed by the OS page cache and are not counted.'''
+    if seen is None:
+        # objects are kept alive, so that their ids are not reused by the
+        # temporary states of extension types
+        seen = {}
+    if id(obj) in seen:
+        return 0
+    seen[id(obj)] = obj
+    if isinstance(obj, np.ndarray):
+        if isinstance(obj, np.memmap):
+            return 0
+        if obj.dtype == object:
+            return obj.nbytes + sum(
+                _estimate_nbytes(item, seen) for item in obj.flat)
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(_estimate_nbytes(value, seen) for value in obj.values())
+    if isinstance(obj, (list, tuple, set)):
+        return sum(_estimate_nbytes(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        return _estimate_nbytes(vars(obj), seen)
+    # extension types such as sklearn trees expose their arrays through
+    # their pickled state
+    if hasattr(obj, '__getstate__') and not isinstance(obj, (str, bytes)):
+        try:
+            state = obj.__getstate__()
+        except TypeError:
+            return 0
+        return _estimate_nbytes(state, seen)
+    return 0
+
+
+class EstimatorCache:
+    '''Bounded LRU cache of loaded pipelines.'''
+
+    def __init__(self, max_entries=4, max_bytes=2 * 1024 ** 3):
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.configure(max_entries, max_bytes)
+
+    def configure(self, max_entries=4, max_bytes=2 * 1024 ** 3):
+        '''Set the maximum number of cached pipelines and their maximum
+        estimated total size in bytes (None for no limit), evicting the
+        least recently used pipelines as needed.'''
+        with self._lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return sum(nbytes for _, nbytes in self._entries.values())
+
+    def load(self, model_fp, loader):
+        '''Return a copy of the pipeline stored in model_fp (a
+        pathlib.Path), calling loader(str(model_fp)) on a cache miss.'''
+        if self.max_entries == 0:
+            return loader(str(model_fp))
+        uuid = _artifact_uuid(model_fp)
+        if uuid is not None:
+            key = (model_fp.name, 'uuid', uuid)
+        else:
+            key = (model_fp.name, 'file') + _file_key(model_fp)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return _copy_pipeline(self._entries[key][0])
+
+        pipeline = loader(str(model_fp))
+        nbytes = _estimate_nbytes(pipeline)
+        with self._lock:
+            if self.max_bytes is None or nbytes <= self.max_bytes:
+                self._entries[key] = (pipeline, nbytes)
+                self._evict()
+        return _copy_pipeline(pipeline)
+
+    def _evict(self):
+        while self._entries and (
+                (self.max_entries is not None and
+                 len(self._entries) > self.max_entries) or
+                (self.max_bytes is not None and
+                 self.nbytes > self.max_bytes)):
+            self._entries.popitem(last=False)
+
+
+estimator_cache = EstimatorCache()
@@ -8,7 +8,10 @@
 
 import tarfile
 import json
+import zipfile
+from itertools import islice, repeat
 
+import numpy as np
 import qiime2.plugin.model as model
 from qiime2.plugin import ValidationError
 
@@ -21,6 +24,27 @@ def _validate_record_len(cells, current_line_number, exp_len):
             .format(exp_len, len(cells), current_line_number, cells))
 
 
+def _record_chunks(fh, n_records=None, chunk_size=2 ** 24):
+    '''Yield (line number, lines) for chunks of the records that follow the
+    header, reading about chunk_size characters at a time, or only the first
+    n_records lines.'''
+    line_number = 2
+    while n_records is None or line_number - 2 < n_records:
+        if n_records is None:
+            lines = fh.readlines(chunk_size)
+        else:
+            lines = list(islice(fh, n_records - (line_number - 2)))
+        if not lines:
+            return
+        yield line_number, lines
+        line_number += len(lines)
+
+
+def _tab_counts(lines):
+    return np.fromiter(map(str.count, lines, repeat('\t')), dtype=np.intp,
+                       count=len(lines))
+
+
 def _validate_file_not_empty(has_data):
     if not has_data:
         raise ValidationError(
@@ -34,21 +58,26 @@ class BooleanSeriesFormat(model.TextFileFormat):
         with self.open() as fh:
             # validate header
             # for now we will not validate any information in the header.
-            line = fh.readline()
+            fh.readline()
 
-            # validate body
+            # validate body, a chunk of lines at a time
             has_data = False
-            for line_number, line in enumerate(fh, start=2):
-                cells = line.strip().split('\t')
-                _validate_record_len(cells, line_number, 2)
-                if str(cells[1]) not in ('True', 'False'):
+            for line_number, lines in _record_chunks(fh, n_records):
+                lines = list(map(str.strip, lines))
+                values = (line.partition('\t')[2] for line in lines)
+                invalid = (_tab_counts(lines) != 1) | ~np.fromiter(
+                    map({'True', 'False'}.__contains__, values), dtype=bool,
+                    count=len(lines))
+                if invalid.any():
+                    # report the first invalid line
+                    i = np.argmax(invalid)
+                    cells = lines[i].split('\t')
+                    _validate_record_len(cells, line_number + i, 2)
                     raise ValidationError(
                         "Expected data to be comprised of values `True` and "
                         "`False`, found {0} at line {1}."
-                        .format(str(cells[1]), line_number))
+                        .format(str(cells[1]), line_number + i))
                 has_data = True
-                if n_records is not None and (line_number - 1) >= n_records:
-                    break
 
             _validate_file_not_empty(has_data)
 
@@ -81,9 +110,65 @@ class JSONFormat(model.TextFileFormat):
                 raise ValidationError(e)
 
 
+# This is effectively an internal format - it isn't registered with the
+# plugin, but rather used as part of a dir fmt. Accepts an uncompressed
+# pickle or any of the compressed containers written by joblib.dump.
+class JoblibFormat(model.BinaryFileFormat):
+    _magic = (b'\x80',  # pickle protocol 2+
+              b'\x78',  # zlib
+              b'\x1f\x8b',  # gzip
+              b'BZh',  # bz2
+              b'\xfd7zXZ',  # xz
+              b']\x00\x00',  # lzma
+              b'\x04"M\x18')  # lz4
+
+    def _validate_(self, level):
+        with self.open() as fh:
+            header = fh.read(6)
+        if not header.startswith(self._magic):
+            raise ValidationError(
+                "Unable to load pickled file (not a joblib file).")
+
+
+# This is effectively an internal format - it isn't registered with the
+# plugin, but rather used as part of a dir fmt. Tree ensembles exported to
+# flat arrays (see _tree_ensemble.py), saved with numpy.savez.
+class TreeEnsembleFormat(model.BinaryFileFormat):
+    def _validate_(self, level):
+        if not zipfile.is_zipfile(str(self)):
+            raise ValidationError(
+                "Unable to load tree ensemble (not an npz file).")
+        with zipfile.ZipFile(str(self)) as npz:
+            if 'info.npy' not in npz.namelist():
+                raise ValidationError(
+                    "Unable to load tree ensemble (no model info found).")
+
+
 class SampleEstimatorDirFmt(model.DirectoryFormat):
     version_info = model.File('sklearn_version.json', format=JSONFormat)
-    sklearn_pipeline = model.File('sklearn_pipeline.tar', format=PickleFormat)
+    # the pipeline is stored either as a joblib file that can be loaded in
+    # place, as tree arrays that do not depend on the scikit-learn version,
+    # or in the legacy layout (a tar of the joblib dump)
+    sklearn_pipeline = model.File(
+        'sklearn_pipeline.tar', format=PickleFormat, optional=True)
+    joblib_pipeline = model.File(
+        'sklearn_pipeline.joblib', format=JoblibFormat, optional=True)
+    tree_ensemble = model.File(
+        'tree_ensemble.npz', format=TreeEnsembleFormat, optional=True)
+    # parameters, classes, feature vocabulary etc. of the model (see
+    # _model_index.py); absent from artifacts written by earlier releases
+    model_index = model.File(
+        'model_index.json', format=JSONFormat, optional=True)
+
+    def _validate_(self, level):
+        n_pipelines = sum((self.path / fn).exists() for fn in (
+            'sklearn_pipeline.tar', 'sklearn_pipeline.joblib',
+            'tree_ensemble.npz'))
+        if n_pipelines != 1:
+            raise ValidationError(
+                "Expected exactly one of sklearn_pipeline.tar, "
+                "sklearn_pipeline.joblib or tree_ensemble.npz, found "
+                "{0}.".format(n_pipelines))
 
 
 class PredictionsFormat(model.TextFileFormat):
@@ -95,18 +180,19 @@ class PredictionsFormat(model.TextFileFormat):
             # header name written by methods in q2-sample-classifier will be
             # "predicted-*", but this should also accommodate user-defined
             # column names.
-            line = fh.readline()
+            fh.readline()
 
-            # validate body
+            # validate body, a chunk of lines at a time
             has_data = False
-            for line_number, line in enumerate(fh, start=2):
-                # we want to strip each cell, not the original line
-                # otherwise empty cells are dropped, causing a TypeError
-                cells = [c.strip() for c in line.split('\t')]
-                _validate_record_len(cells, line_number, 2)
+            for line_number, lines in _record_chunks(fh, n_records):
+                invalid = np.flatnonzero(_tab_counts(lines) != 1)
+                if invalid.size:
+                    i = invalid[0]
+                    # we want to strip each cell, not the original line
+                    # otherwise empty cells are dropped, causing a TypeError
+                    cells = [c.strip() for c in lines[i].split('\t')]
+                    _validate_record_len(cells, line_number + i, 2)
                 has_data = True
-                if n_records is not None and (line_number - 1) >= n_records:
-                    break
 
             _validate_file_not_empty(has_data)
 
@@ -127,52 +213,126 @@ class _MultiColumnNumericFormat(model.TextFileFormat):
             # for now we will not validate any information in the header,
             # since column names, count etc are frequently unique to individual
             # estimators. Let's keep this flexible.
-            line = fh.readline()
+            fh.readline()
 
-            # validate body
+            # validate body, a chunk of lines at a time. All values (except
+            # row names) are parsed at once; if any record is invalid, the
+            # chunk is checked line by line to report the first error.
             has_data = False
-            for line_number, line in enumerate(fh, start=2):
-                # we want to strip each cell, not the original line
-                # otherwise empty cells are dropped, causing a TypeError
-                cells = [c.strip() for c in line.split('\t')]
-                if len(cells) < 2:
-                    raise ValidationError(
-                        "Expected data record to be TSV with two or more "
-                        "fields. Detected {0} fields at line {1}:\n\n{2!r}"
-                        .format(len(cells), line_number, cells))
-                # all values (except row name) should be numbers
+            for line_number, lines in _record_chunks(fh, n_records):
+                records = [line.split('\t', 1) for line in lines]
                 try:
-                    [float(c) for c in cells[1:]]
+                    if min(map(len, records)) < 2:
+                        raise ValueError
+                    np.array('\t'.join(r[1] for r in records).split('\t'),
+                             dtype=np.float64)
                 except ValueError:
-                    raise ValidationError(
-                        "Columns must contain only numeric values. "
-                        "A non-numeric value ({0!r}) was detected at line "
-                        "{1}.".format(cells[1], line_number))
-
+                    self._validate_lines(lines, line_number)
                 has_data = True
-                if n_records is not None and (line_number - 1) >= n_records:
-                    break
 
             _validate_file_not_empty(has_data)
 
+    def _validate_lines(self, lines, first_line_number):
+        for line_number, line in enumerate(lines, start=first_line_number):
+            # we want to strip each cell, not the original line
+            # otherwise empty cells are dropped, causing a TypeError
+            cells = [c.strip() for c in line.split('\t')]
+            if len(cells) < 2:
+                raise ValidationError(
+                    "Expected data record to be TSV with two or more "
+                    "fields. Detected {0} fields at line {1}:\n\n{2!r}"
+                    .format(len(cells), line_number, cells))
+            # all values (except row name) should be numbers
+            try:
+                [float(c) for c in cells[1:]]
+            except ValueError:
+                raise ValidationError(
+                    "Columns must contain only numeric values. "
+                    "A non-numeric value ({0!r}) was detected at line "
+                    "{1}.".format(cells[1], line_number))
+
     def _validate_(self, level):
         record_count_map = {'min': 5, 'max': None}
         self._validate(record_count_map[level])
 
 
+# Numeric tables saved with numpy.savez: the row ids, the column names and
+# a 2-D float array of values. Much faster to write, read and validate than
+# TSV for wide probability tables and long importance tables.
+class _NumericTableNPZFormat(model.BinaryFileFormat):
+    _arrays = ('index', 'columns', 'data')
+
+    def _validate_(self, level):
+        if not zipfile.is_zipfile(str(self)):
+            raise ValidationError("Unable to load table (not an npz file).")
+        with zipfile.ZipFile(str(self)) as npz:
+            missing = [name for name in self._arrays
+                       if name + '.npy' not in npz.namelist()]
+        if missing:
+            raise ValidationError(
+                "Unable to load table (missing array(s): {0}).".format(
+                    ', '.join(missing)))
+
+        with np.load(str(self), allow_pickle=False) as npz:
+            index, columns = npz['index'], npz['columns']
+            _validate_file_not_empty(index.size > 0)
+            if level == 'max':
+                data = npz['data']
+                if data.shape != (index.size, columns.size):
+                    raise ValidationError(
+                        "Expected data of shape {0}, found {1}.".format(
+                            (index.size, columns.size), data.shape))
+                if data.dtype.kind not in 'fiu':
+                    raise ValidationError(
+                        "Columns must contain only numeric values. Found "
+                        "data of type {0}.".format(data.dtype))
+
+
+# Holds a numeric table either as TSV or as npz. New artifacts are written
+# as npz; the TSV layout of earlier artifacts is still read.
+class _NumericTableDirFmt(model.DirectoryFormat):
+    def _validate_(self, level):
+        n_tables = sum(
+            (self.path / fn).exists() for fn in (self.tsv_fn, self.npz_fn))
+        if n_tables != 1:
+            raise ValidationError(
+                "Expected exactly one of {0} or {1}, found {2}.".format(
+                    self.tsv_fn, self.npz_fn, n_tables))
+
+
 class ImportanceFormat(_MultiColumnNumericFormat):
     pass
 
 
-ImportanceDirectoryFormat = model.SingleFileDirectoryFormat(
-    'ImportanceDirectoryFormat', 'importance.tsv',
-    ImportanceFormat)
+class ImportanceNPZFormat(_NumericTableNPZFormat):
+    pass
+
+
+class ImportanceDirectoryFormat(_NumericTableDirFmt):
+    tsv_fn, npz_fn = 'importance.tsv', 'importance.npz'
+    tsv = model.File(tsv_fn, format=ImportanceFormat, optional=True)
+    npz = model.File(npz_fn, format=ImportanceNPZFormat, optional=True)
 
 
 class ProbabilitiesFormat(_MultiColumnNumericFormat):
     pass
 
 
-ProbabilitiesDirectoryFormat = model.SingleFileDirectoryFormat(
-    'ProbabilitiesDirectoryFormat', 'class_probabilities.tsv',
-    ProbabilitiesFormat)
+class ProbabilitiesNPZFormat(_NumericTableNPZFormat):
+    pass
+
+
+class ProbabilitiesDirectoryFormat(_NumericTableDirFmt):
+    tsv_fn, npz_fn = 'class_probabilities.tsv', 'class_probabilities.npz'
+    tsv = model.File(tsv_fn, format=ProbabilitiesFormat, optional=True)
+    npz = model.File(npz_fn, format=ProbabilitiesNPZFormat, optional=True)
+
+
+# rows are query samples, columns are reference samples
+class QueryDistancesFormat(_MultiColumnNumericFormat):
+    pass
+
+
+QueryDistancesDirectoryFormat = model.SingleFileDirectoryFormat(
+    'QueryDistancesDirectoryFormat', 'query_distances.tsv',
+    QueryDistancesFormat)
@@ -0,0 +1,97 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''Summary of a trained SampleEstimator pipeline.
+
+SampleEstimator artifacts hold a small model_index.json next to the model,
+with the estimator parameters, the class labels (classifiers only), the
+feature vocabulary, the RFE scores (if feature selection was optimized),
+the shape of the training data and the split of n_jobs between the levels
+of parallelism used to fit the model. Viewing an artifact as a ModelIndex reads
+only that file, so tools that need this information do not have to
+deserialize the model:
+
+    index = artifact.view(ModelIndex)
+    index['classes'], index['feature_names']
+
+Artifacts written by earlier releases have no index; for those it is built
+from the loaded pipeline.
+'''
+
+import numpy as np
+import pandas as pd
+
+from ._save_options import save_options
+
+
+_json_types = (str, int, float, bool, type(None))
+
+
+class ModelIndex(dict):
+    '''Parameters, classes, feature vocabulary, RFE scores, training shape
+    and parallel budget of a SampleEstimator pipeline, as JSON-compatible
+    values.'''
+
+    @property
+    def parameters(self):
+        return pd.Series(self['parameters'], name='Parameter setting',
+                         dtype=object)
+
+    @property
+    def parallel_budget(self):
+        '''Split of n_jobs used to fit the model (see _parallel_budget), or
+        None if it was not recorded.'''
+        # indexes written by earlier releases have no budget
+        return self.get('parallel_budget')
+
+    @property
+    def rfe_scores(self):
+        '''RFE scores as a pd.Series, or None if feature selection was not
+        optimized.'''
+        scores = self['rfe_scores']
+        if scores is None:
+            return None
+        return pd.Series(scores['values'], index=scores['index'],
+                         name='Accuracy')
+
+
+def _json_value(value):
+    # parameters that JSON cannot hold (tuples, dicts, numpy scalars,
+    # estimators) are kept as they would be printed
+    if isinstance(value, _json_types):
+        return value
+    return str(value)
+
+
+def _estimator_parameters(pipeline):
+    # (drop pipeline params and individual base estimators)
+    return {k: v for k, v in pipeline.get_params().items() if
+            k.startswith('est__') and k != 'est__base_estimator'}
+
+
+def model_index(pipeline):
+    '''Build the ModelIndex of a trained SampleEstimator pipeline.'''
+    est = pipeline.named_steps.est
+    classes = getattr(est, 'classes_', None)
+    rfe_scores = getattr(pipeline, 'rfe_scores', None)
+    training_shape = getattr(pipeline, 'training_shape', None)
+    parallel_budget = save_options(pipeline)['parallel_budget']
+    return ModelIndex(
+        estimator=type(est).__name__,
+        parameters={k: _json_value(v)
+                    for k, v in _estimator_parameters(pipeline).items()},
+        classes=None if classes is None else np.asarray(classes).tolist(),
+        feature_names=np.asarray(
+            pipeline.named_steps.dv.feature_names_, dtype=str).tolist(),
+        rfe_scores=None if rfe_scores is None else {
+            'index': np.asarray(rfe_scores.index).tolist(),
+            'values': np.asarray(rfe_scores, dtype=float).tolist()},
+        training_shape=None if training_shape is None else
+        [int(n) for n in training_shape],
+        parallel_budget=None if parallel_budget is None else
+        {k: int(v) for k, v in parallel_budget.items()})
@@ -0,0 +1,46 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''Options for saving a trained pipeline as a SampleEstimator artifact.
+
+fit_classifier and fit_regressor return a scikit-learn Pipeline, which is
+written to the artifact afterwards by the Pipeline -> SampleEstimatorDirFmt
+transformer. Options that only affect how the pipeline is saved (e.g., its
+compression) or what is recorded alongside it (the split of n_jobs used to
+fit it, see ModelIndex) are registered for that pipeline object here,
+rather than set as attributes on it, so that the pipeline itself is not
+modified. Options
+are looked up by identity: any other pipeline, including a copy of a
+registered one, is saved with the defaults. Entries are dropped along with
+their pipeline.
+'''
+
+import weakref
+
+
+_defaults = {'compress': 0, 'estimator_format': 'joblib',
+             'parallel_budget': None}
+
+# pipelines do not define __eq__, so they are compared by identity
+_options = weakref.WeakKeyDictionary()
+
+
+def set_save_options(pipeline, **options):
+    '''Register options (compress, estimator_format, parallel_budget) for
+    saving pipeline.'''
+    unknown = set(options) - set(_defaults)
+    if unknown:
+        raise TypeError(
+            'Unknown save options: %s' % ', '.join(sorted(unknown)))
+    _options[pipeline] = dict(_options.get(pipeline, {}), **options)
+
+
+def save_options(pipeline):
+    '''Options registered for saving pipeline, with the defaults for any
+    that were not set.'''
+    return dict(_defaults, **_options.get(pipeline, {}))
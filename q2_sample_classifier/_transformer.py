@@ -7,8 +7,11 @@
 # ----------------------------------------------------------------------------
 
 import os
+import shutil
+import struct
 import tarfile
 import json
+import zipfile
 
 import pandas as pd
 import numpy as np
@@ -19,9 +22,17 @@ import joblib
 from sklearn.pipeline import Pipeline
 
 from .plugin_setup import plugin
+from .utilities import SparseFeatureVectorizer
+from ._estimator_cache import estimator_cache
+from ._model_index import ModelIndex, model_index
+from ._save_options import save_options
+from ._tree_ensemble import (
+    to_tree_ensemble, tree_ensemble, tree_arrays, _TreeEnsemble)
 from ._format import (SampleEstimatorDirFmt, JSONFormat, BooleanSeriesFormat,
                       ImportanceFormat, PredictionsFormat, PickleFormat,
-                      ProbabilitiesFormat)
+                      ProbabilitiesFormat, QueryDistancesFormat,
+                      ImportanceNPZFormat, ImportanceDirectoryFormat,
+                      ProbabilitiesNPZFormat, ProbabilitiesDirectoryFormat)
 
 
 def _read_dataframe(fh):
@@ -33,6 +44,70 @@ def _read_dataframe(fh):
     return df
 
 
+def _read_numeric_dataframe(fh):
+    # Parse all columns but the index straight into float64 in one pass,
+    # rather than reading every cell as a string and converting each column
+    # with pd.to_numeric. Files that cannot be parsed this way are read as
+    # before, so that errors (and any values only pd.to_numeric accepts)
+    # are unchanged.
+    columns = pd.read_csv(fh, sep='\t', header=0, nrows=0).columns
+    dtype = {i: np.float64 for i in range(1, len(columns))}
+    dtype[0] = str
+    fh.seek(0)
+    try:
+        df = pd.read_csv(fh, sep='\t', header=0, index_col=0, dtype=dtype)
+    except ValueError:
+        fh.seek(0)
+        return _read_dataframe(fh).apply(
+            lambda x: pd.to_numeric(x, errors='raise'))
+    df.index.name = 'id'
+    return df
+
+
+def _write_npz_table(data, fh):
+    np.savez(fh, index=np.asarray(data.index, dtype=str),
+             columns=np.asarray(data.columns, dtype=str),
+             data=data.to_numpy(dtype=np.float64))
+
+
+def _read_npz_table(fp):
+    with np.load(str(fp), allow_pickle=False) as npz:
+        return pd.DataFrame(npz['data'],
+                            index=pd.Index(npz['index'], name='id'),
+                            columns=npz['columns'])
+
+
+def _read_table_dirfmt(dirfmt):
+    # new artifacts hold an npz table, earlier ones a TSV table
+    npz_fp = dirfmt.path / dirfmt.npz_fn
+    if npz_fp.exists():
+        return _read_npz_table(npz_fp)
+    with (dirfmt.path / dirfmt.tsv_fn).open() as fh:
+        return _read_numeric_dataframe(fh)
+
+
+def _write_table_dirfmt(data, dirfmt):
+    with (dirfmt.path / dirfmt.npz_fn).open('wb') as fh:
+        _write_npz_table(data, fh)
+    return dirfmt
+
+
+def _copy_tsv_to_dirfmt(ff, dirfmt):
+    shutil.copyfile(str(ff), str(dirfmt.path / dirfmt.tsv_fn))
+    return dirfmt
+
+
+def _dirfmt_to_tsv(dirfmt, ff):
+    tsv_fp = dirfmt.path / dirfmt.tsv_fn
+    if tsv_fp.exists():
+        shutil.copyfile(str(tsv_fp), str(ff))
+    else:
+        with ff.open() as fh:
+            _read_table_dirfmt(dirfmt).to_csv(
+                fh, sep='\t', header=True, na_rep=np.nan)
+    return ff
+
+
 @plugin.register_transformer
 def _1(data: pd.Series) -> (BooleanSeriesFormat):
     ff = BooleanSeriesFormat()
@@ -87,15 +162,13 @@ def _7(data: pd.DataFrame) -> (ImportanceFormat):
 @plugin.register_transformer
 def _8(ff: ImportanceFormat) -> (pd.DataFrame):
     with ff.open() as fh:
-        return _read_dataframe(fh).apply(
-            lambda x: pd.to_numeric(x, errors='raise'))
+        return _read_numeric_dataframe(fh)
 
 
 @plugin.register_transformer
 def _9(ff: ImportanceFormat) -> (qiime2.Metadata):
     with ff.open() as fh:
-        return qiime2.Metadata(_read_dataframe(fh).apply(
-            lambda x: pd.to_numeric(x, errors='raise')))
+        return qiime2.Metadata(_read_numeric_dataframe(fh))
 
 
 @plugin.register_transformer
@@ -109,19 +182,228 @@ def _10(data: pd.DataFrame) -> (ProbabilitiesFormat):
 @plugin.register_transformer
 def _11(ff: ProbabilitiesFormat) -> (pd.DataFrame):
     with ff.open() as fh:
-        return _read_dataframe(fh).apply(
-            lambda x: pd.to_numeric(x, errors='raise'))
+        return _read_numeric_dataframe(fh)
 
 
 @plugin.register_transformer
 def _12(ff: ProbabilitiesFormat) -> (qiime2.Metadata):
     with ff.open() as fh:
-        return qiime2.Metadata(_read_dataframe(fh).apply(
-            lambda x: pd.to_numeric(x, errors='raise')))
+        return qiime2.Metadata(_read_numeric_dataframe(fh))
+
+
+@plugin.register_transformer
+def _13(data: pd.DataFrame) -> (QueryDistancesFormat):
+    ff = QueryDistancesFormat()
+    with ff.open() as fh:
+        data.to_csv(fh, sep='\t', header=True)
+    return ff
+
+
+@plugin.register_transformer
+def _14(ff: QueryDistancesFormat) -> (pd.DataFrame):
+    with ff.open() as fh:
+        return _read_numeric_dataframe(fh)
+
+
+@plugin.register_transformer
+def _15(data: pd.DataFrame) -> (ImportanceNPZFormat):
+    ff = ImportanceNPZFormat()
+    with ff.open() as fh:
+        _write_npz_table(data, fh)
+    return ff
+
+
+@plugin.register_transformer
+def _16(ff: ImportanceNPZFormat) -> (pd.DataFrame):
+    return _read_npz_table(ff)
+
+
+@plugin.register_transformer
+def _17(ff: ImportanceNPZFormat) -> (qiime2.Metadata):
+    return qiime2.Metadata(_read_npz_table(ff))
+
+
+@plugin.register_transformer
+def _18(data: pd.DataFrame) -> (ImportanceDirectoryFormat):
+    return _write_table_dirfmt(data, ImportanceDirectoryFormat())
+
+
+@plugin.register_transformer
+def _19(dirfmt: ImportanceDirectoryFormat) -> (pd.DataFrame):
+    return _read_table_dirfmt(dirfmt)
+
+
+@plugin.register_transformer
+def _20(dirfmt: ImportanceDirectoryFormat) -> (qiime2.Metadata):
+    return qiime2.Metadata(_read_table_dirfmt(dirfmt))
+
+
+@plugin.register_transformer
+def _21(ff: ImportanceFormat) -> (ImportanceDirectoryFormat):
+    return _copy_tsv_to_dirfmt(ff, ImportanceDirectoryFormat())
+
+
+@plugin.register_transformer
+def _22(dirfmt: ImportanceDirectoryFormat) -> (ImportanceFormat):
+    return _dirfmt_to_tsv(dirfmt, ImportanceFormat())
+
+
+@plugin.register_transformer
+def _23(data: pd.DataFrame) -> (ProbabilitiesNPZFormat):
+    ff = ProbabilitiesNPZFormat()
+    with ff.open() as fh:
+        _write_npz_table(data, fh)
+    return ff
+
+
+@plugin.register_transformer
+def _24(ff: ProbabilitiesNPZFormat) -> (pd.DataFrame):
+    return _read_npz_table(ff)
+
+
+@plugin.register_transformer
+def _25(ff: ProbabilitiesNPZFormat) -> (qiime2.Metadata):
+    return qiime2.Metadata(_read_npz_table(ff))
+
+
+@plugin.register_transformer
+def _26(data: pd.DataFrame) -> (ProbabilitiesDirectoryFormat):
+    return _write_table_dirfmt(data, ProbabilitiesDirectoryFormat())
+
+
+@plugin.register_transformer
+def _27(dirfmt: ProbabilitiesDirectoryFormat) -> (pd.DataFrame):
+    return _read_table_dirfmt(dirfmt)
+
+
+@plugin.register_transformer
+def _28(dirfmt: ProbabilitiesDirectoryFormat) -> (qiime2.Metadata):
+    return qiime2.Metadata(_read_table_dirfmt(dirfmt))
+
+
+@plugin.register_transformer
+def _29(ff: ProbabilitiesFormat) -> (ProbabilitiesDirectoryFormat):
+    return _copy_tsv_to_dirfmt(ff, ProbabilitiesDirectoryFormat())
+
+
+@plugin.register_transformer
+def _30(dirfmt: ProbabilitiesDirectoryFormat) -> (ProbabilitiesFormat):
+    return _dirfmt_to_tsv(dirfmt, ProbabilitiesFormat())
+
+
+def _mmap_mode(joblib_fp):
+    # numpy arrays pickled as attributes in an uncompressed joblib file are
+    # memory-mapped read-only rather than copied onto the heap, so that
+    # processes loading the same artifact share their pages through the OS
+    # page cache. Compressed files cannot be memory-mapped. This does not
+    # cover the nodes of scikit-learn decision trees (RandomForest,
+    # ExtraTrees, GradientBoosting), which Tree.__setstate__ copies onto the
+    # heap; tree ensembles saved as tree arrays are memory-mapped instead
+    # (see _npz_arrays).
+    with open(str(joblib_fp), 'rb') as fh:
+        return 'r' if fh.read(1) == b'\x80' else None
+
+
+def _save_tree_ensemble(pipeline, fp, compress=False):
+    est = pipeline.named_steps.est
+    if not isinstance(est, _TreeEnsemble):
+        est = to_tree_ensemble(est)
+    info = dict(est.info_)
+    # training summaries recorded on the pipeline
+    if hasattr(pipeline, 'rfe_scores'):
+        info['rfe_scores'] = {'index': pipeline.rfe_scores.index.tolist(),
+                              'values': pipeline.rfe_scores.tolist()}
+    if hasattr(pipeline, 'training_shape'):
+        info['training_shape'] = list(pipeline.training_shape)
+    save = np.savez_compressed if compress else np.savez
+    save(fp, info=np.array(json.dumps(info)),
+         feature_names=np.array(pipeline.named_steps.dv.feature_names_,
+                                dtype=str),
+         **est.arrays_)
+
+
+_npy_header_readers = {(1, 0): np.lib.format.read_array_header_1_0,
+                       (2, 0): np.lib.format.read_array_header_2_0}
+
+
+def _npz_arrays(fp, names):
+    '''Arrays stored in an npz file. Arrays stored uncompressed (by
+    numpy.savez) are memory-mapped read-only from their offset in the file,
+    so that processes loading the same artifact share their pages through
+    the OS page cache; compressed arrays are read onto the heap.'''
+    arrays = {}
+    with zipfile.ZipFile(fp) as npz, open(fp, 'rb') as fh:
+        for name in names:
+            member = npz.getinfo(name + '.npy')
+            if member.compress_type == zipfile.ZIP_STORED:
+                # the member data follows its local header, whose name and
+                # extra fields may differ in length from the central one
+                fh.seek(member.header_offset + 26)
+                name_length, extra_length = struct.unpack('<HH', fh.read(4))
+                fh.seek(name_length + extra_length, os.SEEK_CUR)
+                version = np.lib.format.read_magic(fh)
+                if version in _npy_header_readers:
+                    shape, fortran_order, dtype = \
+                        _npy_header_readers[version](fh)
+                    if not dtype.hasobject and 0 not in shape:
+                        arrays[name] = np.memmap(
+                            fp, dtype=dtype, mode='r', offset=fh.tell(),
+                            shape=shape, order='F' if fortran_order else 'C')
+                        continue
+            with npz.open(member) as member_fh:
+                arrays[name] = np.lib.format.read_array(
+                    member_fh, allow_pickle=False)
+    return arrays
+
+
+def _load_tree_ensemble(fp):
+    with np.load(fp, allow_pickle=False) as data:
+        info = json.loads(str(data['info']))
+        feature_names = data['feature_names'].tolist()
+    arrays = _npz_arrays(fp, tree_arrays)
+    rfe_scores = info.pop('rfe_scores', None)
+    training_shape = info.pop('training_shape', None)
+
+    vectorizer = SparseFeatureVectorizer()
+    vectorizer.feature_names_ = feature_names
+    pipeline = Pipeline(
+        [('dv', vectorizer), ('est', tree_ensemble(arrays, info))])
+    if rfe_scores is not None:
+        pipeline.rfe_scores = pd.Series(
+            rfe_scores['values'], index=rfe_scores['index'], name='Accuracy')
+    if training_shape is not None:
+        pipeline.training_shape = tuple(training_shape)
+    return pipeline
+
+
+def _load_joblib(joblib_fp):
+    '''Load a joblib-saved pipeline, memory-mapping its numpy attributes if
+    the file is uncompressed (tree nodes are still copied onto the heap, see
+    _mmap_mode).'''
+    return joblib.load(joblib_fp, mmap_mode=_mmap_mode(joblib_fp))
+
+
+def _load_legacy_tar(tar_fp):
+    # legacy layout: extract the tarred joblib dump before loading it
+    with tarfile.open(tar_fp) as tar:
+        tmpdir = model.DirectoryFormat()
+        dirname = str(tmpdir)
+        tar.extractall(dirname)
+        pipeline = joblib.load(os.path.join(dirname, 'sklearn_pipeline.pkl'))
+        for fn in tar.getnames():
+            os.unlink(os.path.join(dirname, fn))
+    return pipeline
 
 
 @plugin.register_transformer
 def _a(dirfmt: SampleEstimatorDirFmt) -> Pipeline:
+    # loaded pipelines are kept in estimator_cache, so that viewing the same
+    # artifact again does not deserialize the model again. Tree arrays do
+    # not depend on the scikit-learn version.
+    tree_ensemble_fp = dirfmt.path / 'tree_ensemble.npz'
+    if tree_ensemble_fp.exists():
+        return estimator_cache.load(tree_ensemble_fp, _load_tree_ensemble)
+
     sklearn_version = dirfmt.version_info.view(dict)['sklearn-version']
     if sklearn_version != sklearn.__version__:
         raise ValueError('The scikit-learn version (%s) used to generate this'
@@ -131,37 +413,47 @@ def _a(dirfmt: SampleEstimatorDirFmt) -> Pipeline:
                          ' data-corruption errors.'
                          % (sklearn_version, sklearn.__version__))
 
-    sklearn_pipeline = dirfmt.sklearn_pipeline.view(PickleFormat)
+    joblib_fp = dirfmt.path / 'sklearn_pipeline.joblib'
+    if joblib_fp.exists():
+        return estimator_cache.load(joblib_fp, _load_joblib)
 
-    with tarfile.open(str(sklearn_pipeline)) as tar:
-        tmpdir = model.DirectoryFormat()
-        dirname = str(tmpdir)
-        tar.extractall(dirname)
-        pipeline = joblib.load(os.path.join(dirname, 'sklearn_pipeline.pkl'))
-        for fn in tar.getnames():
-            os.unlink(os.path.join(dirname, fn))
-
-    return pipeline
+    sklearn_pipeline = dirfmt.sklearn_pipeline.view(PickleFormat)
+    return estimator_cache.load(sklearn_pipeline.path, _load_legacy_tar)
 
 
 @plugin.register_transformer
 def _b(data: Pipeline) -> SampleEstimatorDirFmt:
-    sklearn_pipeline = PickleFormat()
-    with tarfile.open(str(sklearn_pipeline), 'w') as tar:
-        tmpdir = model.DirectoryFormat()
-        pf = os.path.join(str(tmpdir), 'sklearn_pipeline.pkl')
-        for fn in joblib.dump(data, pf):
-            tar.add(fn, os.path.basename(fn))
-            os.unlink(fn)
-
     dirfmt = SampleEstimatorDirFmt()
     dirfmt.version_info.write_data(
         {'sklearn-version': sklearn.__version__}, dict)
-    dirfmt.sklearn_pipeline.write_data(sklearn_pipeline, PickleFormat)
+    # fit_classifier and fit_regressor register the requested format and
+    # compression (see set_save_options)
+    options = save_options(data)
+    if options['estimator_format'] == 'tree-arrays' or \
+            isinstance(data.named_steps.est, _TreeEnsemble):
+        _save_tree_ensemble(data, str(dirfmt.path / 'tree_ensemble.npz'),
+                            options['compress'] > 0)
+    else:
+        # dump straight into the artifact, so that it can be loaded in place
+        joblib.dump(data, str(dirfmt.path / 'sklearn_pipeline.joblib'),
+                    compress=options['compress'])
+    # small summary of the model, read instead of loading it (see ModelIndex)
+    with (dirfmt.path / 'model_index.json').open('w') as fh:
+        json.dump(model_index(data), fh)
 
     return dirfmt
 
 
+@plugin.register_transformer
+def _c(dirfmt: SampleEstimatorDirFmt) -> ModelIndex:
+    index_fp = dirfmt.path / 'model_index.json'
+    if index_fp.exists():
+        with index_fp.open() as fh:
+            return ModelIndex(json.load(fh))
+    # artifacts written by earlier releases have no index
+    return model_index(_a(dirfmt))
+
+
 @plugin.register_transformer
 def _d(fmt: JSONFormat) -> dict:
     with fmt.open() as fh:
@@ -0,0 +1,339 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''Array-backed tree ensembles.
+
+Fitted RandomForest, ExtraTrees, GradientBoosting and AdaBoost (with tree
+base estimators) models are exported to flat arrays: the nodes of all trees
+are concatenated, with int32 split features and child indices and float32
+thresholds and leaf values (per-tree weights are float64). Predictions are
+made by a batched NumPy traversal of all trees at once, so loading and
+predicting do not depend on sklearn.ensemble or on the scikit-learn version
+the model was trained with.
+
+Thresholds are rounded down to float32. Trees are evaluated on float32
+features, as in scikit-learn, so every sample takes the same path as in the
+original model. Leaf values are float32, so predicted values and
+probabilities match the original model to float32 precision.
+'''
+
+import json
+
+import numpy as np
+from scipy.sparse import issparse
+from scipy.special import expit, softmax
+from sklearn.base import BaseEstimator, ClassifierMixin, RegressorMixin
+
+
+_forests = ['RandomForestClassifier', 'ExtraTreesClassifier',
+            'RandomForestRegressor', 'ExtraTreesRegressor']
+_gradient_boosting = ['GradientBoostingClassifier',
+                      'GradientBoostingRegressor']
+_adaboost = ['AdaBoostClassifier', 'AdaBoostRegressor']
+tree_ensembles = _forests + _gradient_boosting + _adaboost
+
+tree_arrays = ['feature', 'threshold', 'left', 'right', 'value', 'roots',
+               'tree_output', 'tree_weight', 'feature_importances']
+
+
+def _float32_floor(values):
+    # largest float32 <= each value, so that for float32 x,
+    # x <= threshold in float64 iff x <= the rounded threshold
+    rounded = values.astype(np.float32)
+    above = rounded > values
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    return rounded
+
+
+def _tree_arrays(trees, classification):
+    '''Concatenate the nodes of fitted sklearn trees.'''
+    feature, threshold, left, right, value, roots = [], [], [], [], [], []
+    offset = 0
+    for tree in trees:
+        tree = tree.tree_
+        n_nodes = tree.node_count
+        leaf = tree.children_left < 0
+        roots.append(offset)
+        feature.append(np.where(leaf, -1, tree.feature))
+        threshold.append(_float32_floor(tree.threshold))
+        left.append(np.where(leaf, -1, tree.children_left + offset))
+        right.append(np.where(leaf, -1, tree.children_right + offset))
+        if classification:
+            # class probabilities at each node, as in predict_proba
+            counts = tree.value[:, 0, :]
+            normalizer = counts.sum(axis=1, keepdims=True)
+            normalizer[normalizer == 0] = 1
+            value.append(counts / normalizer)
+        else:
+            value.append(tree.value[:, 0, :1])
+        offset += n_nodes
+    return {'feature': np.concatenate(feature).astype(np.int32),
+            'threshold': np.concatenate(threshold).astype(np.float32),
+            'left': np.concatenate(left).astype(np.int32),
+            'right': np.concatenate(right).astype(np.int32),
+            'value': np.concatenate(value).astype(np.float32),
+            'roots': np.array(roots, dtype=np.int32)}
+
+
+def _json_params(estimator):
+    # estimator parameters, for summaries; objects are kept as their repr
+    return json.loads(json.dumps(
+        estimator.get_params(deep=False), default=repr))
+
+
+def to_tree_ensemble(estimator):
+    '''Export a fitted sklearn tree ensemble to a TreeEnsembleClassifier or
+    TreeEnsembleRegressor.'''
+    name = estimator.__class__.__name__
+    if name not in tree_ensembles:
+        raise ValueError(
+            '{0} cannot be exported to tree arrays. Supported estimators '
+            'are: {1}.'.format(name, ', '.join(tree_ensembles)))
+    classification = name.endswith('Classifier')
+    info = {'estimator': name, 'params': _json_params(estimator)}
+    if classification:
+        info['classes'] = estimator.classes_.tolist()
+
+    if name in _forests:
+        trees = estimator.estimators_
+        arrays = _tree_arrays(trees, classification)
+        arrays['tree_output'] = np.zeros(len(trees), dtype=np.int32)
+        arrays['tree_weight'] = np.ones(len(trees))
+
+    elif name in _gradient_boosting:
+        init = estimator.init_
+        if not (init == 'zero' or init.__class__.__name__ in (
+                'DummyClassifier', 'DummyRegressor')):
+            raise ValueError('Gradient boosting models with a custom init '
+                             'estimator cannot be exported to tree arrays.')
+        n_stages, n_outputs = estimator.estimators_.shape
+        arrays = _tree_arrays(estimator.estimators_.ravel(), False)
+        arrays['tree_output'] = np.tile(
+            np.arange(n_outputs, dtype=np.int32), n_stages)
+        arrays['tree_weight'] = np.full(
+            n_stages * n_outputs, estimator.learning_rate, dtype=np.float64)
+        # the initial raw prediction of the default init estimators does
+        # not depend on the features
+        info['init'] = estimator._raw_predict_init(
+            np.zeros((1, estimator.n_features_in_), dtype=np.float32)
+            )[0].tolist()
+        info['loss'] = estimator.loss
+
+    else:
+        trees = estimator.estimators_
+        if trees[0].__class__.__name__ not in ('DecisionTreeClassifier',
+                                               'DecisionTreeRegressor'):
+            raise ValueError('AdaBoost models can only be exported to tree '
+                             'arrays if their base estimator is a decision '
+                             'tree.')
+        arrays = _tree_arrays(trees, classification)
+        arrays['tree_output'] = np.zeros(len(trees), dtype=np.int32)
+        arrays['tree_weight'] = estimator.estimator_weights_[
+            :len(trees)].astype(np.float64)
+        if classification:
+            # SAMME.R was removed in scikit-learn 1.6, along with (later)
+            # the algorithm parameter
+            info['algorithm'] = getattr(estimator, 'algorithm', 'SAMME')
+            # since scikit-learn 1.3, SAMME scores each class that a tree
+            # does not vote for with -weight / (n_classes - 1), rather than 0
+            info['samme_scores'] = 'symmetric' if _sklearn_version() >= \
+                (1, 3) else 'votes'
+
+    arrays['feature_importances'] = np.asarray(
+        estimator.feature_importances_, dtype=np.float64)
+    return tree_ensemble(arrays, info)
+
+
+def tree_ensemble(arrays, info):
+    '''Build a TreeEnsembleClassifier or TreeEnsembleRegressor from the
+    arrays and info of an exported model.'''
+    if info['estimator'].endswith('Classifier'):
+        return TreeEnsembleClassifier(arrays, info)
+    return TreeEnsembleRegressor(arrays, info)
+
+
+class _TreeEnsemble(BaseEstimator):
+    '''A tree ensemble stored as flat node arrays. Only prediction is
+    supported; get_params reports the parameters of the exported model.'''
+
+    def __init__(self, arrays, info):
+        self.arrays_ = arrays
+        self.info_ = info
+        for name in tree_arrays:
+            setattr(self, name + '_', arrays[name])
+
+    def get_params(self, deep=True):
+        return dict(self.info_['params'])
+
+    def set_params(self, **params):
+        # parameters only describe the exported model; n_jobs etc. are
+        # accepted and ignored. info_ is replaced rather than updated, as it
+        # may be shared with copies of this estimator.
+        self.info_ = dict(self.info_, params=dict(self.info_['params'],
+                                                  **params))
+        return self
+
+    def fit(self, X, y=None):
+        raise NotImplementedError(
+            'Tree ensembles exported to arrays can only be used for '
+            'prediction. Retrain the original estimator instead.')
+
+    def _apply(self, X):
+        '''Leaf node index of each sample (rows) in each tree (columns).'''
+        values = _feature_values(X)
+        node = np.repeat(
+            self.roots_[None, :].astype(np.intp), X.shape[0], axis=0)
+        while True:
+            feature = self.feature_[node]
+            samples, trees = np.nonzero(feature >= 0)
+            if len(samples) == 0:
+                return node
+            split = node[samples, trees]
+            go_left = values(samples, feature[samples, trees]) <= \
+                self.threshold_[split]
+            node[samples, trees] = np.where(
+                go_left, self.left_[split], self.right_[split])
+
+    def _blocks(self, X, block_size=1000):
+        # blocks of rows; sparse blocks stay sparse (see _feature_values)
+        for start in range(0, X.shape[0], block_size):
+            yield X[start:start + block_size]
+
+    def _aggregate(self, leaves):
+        raise NotImplementedError
+
+    def _decision(self, X):
+        return np.concatenate(
+            [self._aggregate(self._apply(block)) for block in self._blocks(X)])
+
+
+class TreeEnsembleClassifier(ClassifierMixin, _TreeEnsemble):
+    def __init__(self, arrays, info):
+        super().__init__(arrays, info)
+        self.classes_ = np.array(info['classes'])
+        self.n_classes_ = len(self.classes_)
+
+    def _aggregate(self, leaves):
+        name = self.info_['estimator']
+        if name in _forests:
+            return self.value_[leaves].mean(axis=1, dtype=np.float64)
+        if name in _gradient_boosting:
+            return _gradient_boosting_raw(self, leaves)
+        # AdaBoost decision function
+        weights = self.tree_weight_
+        if self.info_['algorithm'] == 'SAMME.R':
+            proba = np.clip(self.value_[leaves].astype(np.float64),
+                            np.finfo(np.float64).eps, None)
+            log_proba = np.log(proba)
+            decision = ((self.n_classes_ - 1) * (
+                log_proba - log_proba.mean(axis=2, keepdims=True))
+                ).sum(axis=1)
+        else:
+            votes = np.argmax(self.value_[leaves], axis=2)
+            other = 0
+            if self.info_.get('samme_scores', 'symmetric') == 'symmetric':
+                other = -1 / (self.n_classes_ - 1)
+            decision = np.stack([
+                (np.where(votes == c, 1, other) * weights).sum(axis=1)
+                for c in range(self.n_classes_)], axis=1)
+        return decision / weights.sum()
+
+    def predict_proba(self, X):
+        decision = self._decision(X)
+        name = self.info_['estimator']
+        if name in _forests:
+            return decision
+        if name in _gradient_boosting:
+            if self.n_classes_ > 2:
+                return softmax(decision, axis=1)
+            scale = 2 if self.info_['loss'] == 'exponential' else 1
+            positive = expit(scale * decision[:, 0])
+            return np.column_stack([1 - positive, positive])
+        # AdaBoost
+        if self.n_classes_ == 2:
+            decision = decision[:, 1] - decision[:, 0]
+            decision = np.column_stack([-decision, decision]) / 2
+        else:
+            decision = decision / (self.n_classes_ - 1)
+        return softmax(decision, axis=1)
+
+    def predict(self, X):
+        name = self.info_['estimator']
+        if name in _gradient_boosting and \
+                self.info_['loss'] == 'exponential':
+            return self.classes_[(self._decision(X)[:, 0] >= 0).astype(int)]
+        if name in _adaboost:
+            decision = self._decision(X)
+            if self.n_classes_ == 2:
+                return self.classes_[
+                    (decision[:, 1] - decision[:, 0] > 0).astype(int)]
+            return self.classes_[np.argmax(decision, axis=1)]
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+class TreeEnsembleRegressor(RegressorMixin, _TreeEnsemble):
+    def _aggregate(self, leaves):
+        name = self.info_['estimator']
+        values = self.value_[leaves, 0].astype(np.float64)
+        if name in _forests:
+            return values.mean(axis=1)
+        if name in _gradient_boosting:
+            return _gradient_boosting_raw(self, leaves)[:, 0]
+        # AdaBoost: weighted median of the tree predictions
+        order = np.argsort(values, axis=1)
+        cdf = np.cumsum(self.tree_weight_[order], axis=1)
+        median = np.argmax(cdf >= 0.5 * cdf[:, -1:], axis=1)
+        return np.take_along_axis(
+            values, order[np.arange(len(values)), median][:, None],
+            axis=1)[:, 0]
+
+    def predict(self, X):
+        return self._decision(X)
+
+
+def _sklearn_version():
+    import sklearn
+
+    return tuple(int(v) for v in sklearn.__version__.split('.')[:2])
+
+
+def _feature_values(X):
+    '''Function returning the float32 values X[samples, features] of a
+    block of rows, as evaluated by sklearn trees. Sparse blocks are looked up
+    in their CSR arrays rather than densified across all features.'''
+    if not issparse(X):
+        X = np.asarray(X, dtype=np.float32)
+        return lambda samples, features: X[samples, features]
+
+    X = X.tocsr()
+    X.sum_duplicates()
+    n_features = X.shape[1]
+    # entries in row-major order, keyed by their flat index
+    keys = np.repeat(np.arange(X.shape[0], dtype=np.int64),
+                     np.diff(X.indptr)) * n_features + X.indices
+    data = np.append(X.data.astype(np.float32), np.float32(0))
+
+    def values(samples, features):
+        query = samples.astype(np.int64) * n_features + features
+        position = np.searchsorted(keys, query)
+        found = position < len(keys)
+        found[found] = keys[position[found]] == query[found]
+        # absent entries are zero (the appended last element of data)
+        return data[np.where(found, position, len(keys))]
+
+    return values
+
+
+def _gradient_boosting_raw(ensemble, leaves):
+    contributions = ensemble.value_[leaves, 0] * ensemble.tree_weight_
+    init = np.asarray(ensemble.info_['init'], dtype=np.float64)
+    raw = np.empty((len(leaves), len(init)))
+    for k in range(len(init)):
+        raw[:, k] = init[k] + contributions[
+            :, ensemble.tree_output_ == k].sum(axis=1)
+    return raw
@@ -26,3 +26,5 @@ Importance = SemanticType(
     'Importance', variant_of=FeatureData.field['type'])
 Probabilities = SemanticType(
     'Probabilities', variant_of=SampleData.field['type'])
+QueryDistances = SemanticType(
+    'QueryDistances', variant_of=SampleData.field['type'])
@@ -6,23 +6,30 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-import collections
+import os
+import tempfile
 
-from sklearn.ensemble import IsolationForest
 from sklearn.metrics import mean_squared_error, accuracy_score
-from sklearn.feature_extraction import DictVectorizer
 from sklearn.pipeline import Pipeline
+from sklearn.base import is_classifier
 
 import qiime2
 import pandas as pd
+import numpy as np
 import biom
 import skbio
+from q2_types.distance_matrix import LSMatFormat
 
 from .utilities import (_load_data, _prepare_training_data,
                         nested_cross_validation, _fit_estimator,
                         _extract_features, _plot_accuracy,
                         _summarize_estimator, predict_probabilities,
-                        _classifiers)
+                        SparseFeatureVectorizer,
+                        _upgrade_legacy_vectorizer, _loo_knn_sweep,
+                        _lsmat_to_memmap, _knn_predict, _visualize_knn)
+from ._tree_ensemble import tree_ensembles
+from ._model_index import ModelIndex
+from ._save_options import set_save_options
 
 
 defaults = {
@@ -34,7 +41,15 @@ defaults = {
     'estimator_c': 'RandomForestClassifier',
     'estimator_r': 'RandomForestRegressor',
     'palette': 'sirocco',
-    'missing_samples': 'error'
+    'missing_samples': 'error',
+    'tuning_strategy': 'random',
+    'tuning_iterations': 20,
+    'evaluation': 'cv',
+    'selection_method': 'rfecv',
+    'block_size': 1000,
+    'compress': 0,
+    'estimator_format': 'joblib',
+    'figure_format': 'png+pdf'
 }
 
 
@@ -103,32 +118,34 @@ def metatable(ctx,
 
 
 def classify_samples_from_dist(ctx, distance_matrix, metadata, k=1,
-                               palette=defaults['palette']):
+                               palette=defaults['palette'],
+                               memory_map=False,
+                               block_size=defaults['block_size'],
+                               k_values=None):
     ''' Returns knn classifier results from a distance matrix.'''
-    distance_matrix = distance_matrix.view(skbio.DistanceMatrix)
-    predictions = []
     metadata_series = metadata.to_series()
-    for i, row in enumerate(distance_matrix):
-        dists = []
-        categories = []
-        for j, dist in enumerate(row):
-            if j == i:
-                continue  # exclude self
-            dists.append(dist)
-            categories.append(metadata_series[distance_matrix.ids[j]])
-
-        # k-long series of (category: dist) ordered small -> large
-        nn_categories = pd.Series(dists, index=categories).nsmallest(k)
-        counter = collections.Counter(nn_categories.index)
-        max_counts = max(counter.values())
-        # in order of closeness, pick a category that is or shares
-        # max_counts
-        for category in nn_categories.index:
-            if counter[category] == max_counts:
-                predictions.append(category)
-                break
-
-    predictions = pd.Series(predictions, index=distance_matrix.ids)
+    # a k-sweep shares the neighbor search across all k values
+    if k_values is None:
+        k_values = [k]
+    # leave-one-out: the k nearest other samples vote, and ties go to the
+    # closest of the tied categories
+    if memory_map:
+        lsmat_fp = str(distance_matrix.view(LSMatFormat))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ids, distances = _lsmat_to_memmap(
+                lsmat_fp, os.path.join(temp_dir, 'distances.npy'),
+                block_size)
+            labels = metadata_series.loc[ids]
+            predictions, accuracy = _loo_knn_sweep(
+                distances, labels.values, k_values, block_size)
+            del distances
+    else:
+        distance_matrix = distance_matrix.view(skbio.DistanceMatrix)
+        ids = list(distance_matrix.ids)
+        labels = metadata_series.loc[ids]
+        predictions, accuracy = _loo_knn_sweep(
+            distance_matrix.data, labels.values, k_values, block_size)
+    predictions = pd.Series(predictions, index=ids)
     predictions.index.name = 'SampleID'
     pred = qiime2.Artifact.import_data(
         'SampleData[ClassifierPredictions]', predictions)
@@ -137,7 +154,33 @@ def classify_samples_from_dist(ctx, distance_matrix, metadata, k=1,
     accuracy_results, = confusion(
         pred, metadata, missing_samples='ignore', palette=palette)
 
-    return pred, accuracy_results
+    # leave-one-out accuracy of each k, as metadata keyed by k
+    accuracy = accuracy.to_frame()
+    accuracy.index = pd.Index(accuracy.index.astype(str), name='id')
+    tabulate = ctx.get_action('sample_classifier', 'knn_accuracy')
+    k_accuracy, = tabulate(qiime2.Metadata(accuracy))
+
+    return pred, accuracy_results, k_accuracy
+
+
+def classify_samples_from_query_dist(
+        distances: pd.DataFrame, metadata: qiime2.CategoricalMetadataColumn,
+        k: int = 1, block_size: int = defaults['block_size']) -> pd.Series:
+    reference_labels = metadata.to_series()
+    missing = distances.columns.difference(reference_labels.index)
+    if len(missing) > 0:
+        raise ValueError(
+            'The following reference samples are not present in the '
+            'metadata: {0}'.format(', '.join(map(str, missing))))
+    reference_labels = reference_labels.loc[distances.columns]
+
+    predictions = _knn_predict(
+        distances.values, reference_labels.values, k, block_size)
+
+    predictions = pd.Series(
+        predictions, index=distances.index, name='prediction')
+    predictions.index.name = 'SampleID'
+    return predictions
 
 
 def classify_samples(ctx,
@@ -153,7 +196,12 @@ def classify_samples(ctx,
                      optimize_feature_selection=False,
                      parameter_tuning=False,
                      palette=defaults['palette'],
-                     missing_samples=defaults['missing_samples']):
+                     missing_samples=defaults['missing_samples'],
+                     tuning_strategy=defaults['tuning_strategy'],
+                     tuning_iterations=defaults['tuning_iterations'],
+                     selection_method=defaults['selection_method'],
+                     compress=defaults['compress'],
+                     estimator_format=defaults['estimator_format']):
 
     split = ctx.get_action('sample_classifier', 'split_table')
     fit = ctx.get_action('sample_classifier', 'fit_classifier')
@@ -169,7 +217,9 @@ def classify_samples(ctx,
     sample_estimator, importance = fit(
         X_train, metadata, step, cv, random_state, n_jobs, n_estimators,
         estimator, optimize_feature_selection, parameter_tuning,
-        missing_samples='ignore')
+        missing_samples='ignore', tuning_strategy=tuning_strategy,
+        tuning_iterations=tuning_iterations, selection_method=selection_method,
+        compress=compress, estimator_format=estimator_format)
 
     predictions, probabilities, = predict_test(
         X_test, sample_estimator, n_jobs)
@@ -199,7 +249,12 @@ def regress_samples(ctx,
                     optimize_feature_selection=False,
                     stratify=False,
                     parameter_tuning=False,
-                    missing_samples=defaults['missing_samples']):
+                    missing_samples=defaults['missing_samples'],
+                    tuning_strategy=defaults['tuning_strategy'],
+                    tuning_iterations=defaults['tuning_iterations'],
+                    selection_method=defaults['selection_method'],
+                    compress=defaults['compress'],
+                    estimator_format=defaults['estimator_format']):
 
     split = ctx.get_action('sample_classifier', 'split_table')
     fit = ctx.get_action('sample_classifier', 'fit_regressor')
@@ -213,7 +268,9 @@ def regress_samples(ctx,
     sample_estimator, importance = fit(
         X_train, metadata, step, cv, random_state, n_jobs, n_estimators,
         estimator, optimize_feature_selection, parameter_tuning,
-        missing_samples='ignore')
+        missing_samples='ignore', tuning_strategy=tuning_strategy,
+        tuning_iterations=tuning_iterations, selection_method=selection_method,
+        compress=compress, estimator_format=estimator_format)
 
     predictions, = predict_test(X_test, sample_estimator, n_jobs)
 
@@ -233,12 +290,23 @@ def fit_classifier(table: biom.Table,
                    estimator: str = defaults['estimator_c'],
                    optimize_feature_selection: bool = False,
                    parameter_tuning: bool = False,
-                   missing_samples: str = defaults['missing_samples']
+                   missing_samples: str = defaults['missing_samples'],
+                   tuning_strategy: str = defaults['tuning_strategy'],
+                   tuning_iterations: int = defaults['tuning_iterations'],
+                   selection_method: str = defaults['selection_method'],
+                   compress: int = defaults['compress'],
+                   estimator_format: str = defaults['estimator_format']
                    ) -> (Pipeline, pd.DataFrame):
+    _check_estimator_format(estimator, estimator_format)
     estimator, importance = _fit_estimator(
         table, metadata, estimator, n_estimators, step, cv, random_state,
         n_jobs, optimize_feature_selection, parameter_tuning,
-        missing_samples=missing_samples, classification=True)
+        missing_samples=missing_samples, classification=True,
+        tuning_strategy=tuning_strategy, tuning_iterations=tuning_iterations,
+        selection_method=selection_method)
+    # read by the SampleEstimator transformer when the artifact is written
+    set_save_options(
+        estimator, compress=compress, estimator_format=estimator_format)
 
     return estimator, importance
 
@@ -251,20 +319,40 @@ def fit_regressor(table: biom.Table,
                   estimator: str = defaults['estimator_r'],
                   optimize_feature_selection: bool = False,
                   parameter_tuning: bool = False,
-                  missing_samples: str = defaults['missing_samples']
+                  missing_samples: str = defaults['missing_samples'],
+                  tuning_strategy: str = defaults['tuning_strategy'],
+                  tuning_iterations: int = defaults['tuning_iterations'],
+                  selection_method: str = defaults['selection_method'],
+                  compress: int = defaults['compress'],
+                  estimator_format: str = defaults['estimator_format']
                   ) -> (Pipeline, pd.DataFrame):
+    _check_estimator_format(estimator, estimator_format)
     estimator, importance = _fit_estimator(
         table, metadata, estimator, n_estimators, step, cv, random_state,
         n_jobs, optimize_feature_selection, parameter_tuning,
-        missing_samples=missing_samples, classification=False)
+        missing_samples=missing_samples, classification=False,
+        tuning_strategy=tuning_strategy, tuning_iterations=tuning_iterations,
+        selection_method=selection_method)
+    # read by the SampleEstimator transformer when the artifact is written
+    set_save_options(
+        estimator, compress=compress, estimator_format=estimator_format)
 
     return estimator, importance
 
 
+def _check_estimator_format(estimator, estimator_format):
+    # fail before training if the estimator cannot be saved as requested
+    if estimator_format == 'tree-arrays' and estimator not in tree_ensembles:
+        raise ValueError(
+            'estimator_format "tree-arrays" is only available for tree '
+            'ensembles: {0}.'.format(', '.join(tree_ensembles)))
+
+
 def predict_base(table, sample_estimator, n_jobs):
     # extract feature data from biom
     feature_data = _extract_features(table)
     index = table.ids()
+    sample_estimator = _upgrade_legacy_vectorizer(sample_estimator)
 
     # reset n_jobs if this is a valid parameter for the estimator
     if 'est__n_jobs' in sample_estimator.get_params().keys():
@@ -278,7 +366,7 @@ def predict_base(table, sample_estimator, n_jobs):
     y_pred.index.name = 'SampleID'
 
     # log prediction probabilities (classifiers only)
-    if sample_estimator.named_steps.est.__class__.__name__ in _classifiers:
+    if is_classifier(sample_estimator.named_steps.est):
         probs = predict_probabilities(sample_estimator, feature_data, index)
     else:
         probs = None
@@ -321,13 +409,19 @@ def regress_samples_ncv(
         n_estimators: int = defaults['n_estimators'],
         estimator: str = defaults['estimator_r'], stratify: str = False,
         parameter_tuning: bool = False,
-        missing_samples: str = defaults['missing_samples']
+        missing_samples: str = defaults['missing_samples'],
+        parallel_folds: bool = False,
+        tuning_strategy: str = defaults['tuning_strategy'],
+        tuning_iterations: int = defaults['tuning_iterations'],
+        evaluation: str = defaults['evaluation']
         ) -> (pd.Series, pd.DataFrame):
 
     y_pred, importances, probabilities = nested_cross_validation(
         table, metadata, cv, random_state, n_jobs, n_estimators, estimator,
         stratify, parameter_tuning, classification=False,
-        scoring=mean_squared_error, missing_samples=missing_samples)
+        scoring=mean_squared_error, missing_samples=missing_samples,
+        parallel_folds=parallel_folds, tuning_strategy=tuning_strategy,
+        tuning_iterations=tuning_iterations, evaluation=evaluation)
     return y_pred, importances
 
 
@@ -338,25 +432,34 @@ def classify_samples_ncv(
         n_estimators: int = defaults['n_estimators'],
         estimator: str = defaults['estimator_c'],
         parameter_tuning: bool = False,
-        missing_samples: str = defaults['missing_samples']
+        missing_samples: str = defaults['missing_samples'],
+        parallel_folds: bool = False,
+        tuning_strategy: str = defaults['tuning_strategy'],
+        tuning_iterations: int = defaults['tuning_iterations'],
+        evaluation: str = defaults['evaluation']
         ) -> (pd.Series, pd.DataFrame, pd.DataFrame):
 
     y_pred, importances, probabilities = nested_cross_validation(
         table, metadata, cv, random_state, n_jobs, n_estimators, estimator,
         stratify=True, parameter_tuning=parameter_tuning, classification=False,
-        scoring=accuracy_score, missing_samples=missing_samples)
+        scoring=accuracy_score, missing_samples=missing_samples,
+        parallel_folds=parallel_folds, tuning_strategy=tuning_strategy,
+        tuning_iterations=tuning_iterations, evaluation=evaluation)
     return y_pred, importances, probabilities
 
 
 def scatterplot(output_dir: str, predictions: pd.Series,
                 truth: qiime2.NumericMetadataColumn,
-                missing_samples: str = defaults['missing_samples']) -> None:
+                missing_samples: str = defaults['missing_samples'],
+                figure_format: str = defaults['figure_format'],
+                n_jobs: int = defaults['n_jobs']) -> None:
     predictions = pd.to_numeric(predictions)
 
     _plot_accuracy(output_dir, predictions, truth, probabilities=None,
                    missing_samples=missing_samples,
                    classification=False, palette=None,
-                   plot_title='regression scatterplot')
+                   plot_title='regression scatterplot',
+                   figure_format=figure_format, n_jobs=n_jobs)
 
 
 def confusion_matrix(output_dir: str,
@@ -365,7 +468,9 @@ def confusion_matrix(output_dir: str,
                      probabilities: pd.DataFrame = None,
                      missing_samples: str = defaults['missing_samples'],
                      vmin: int = 'auto', vmax: int = 'auto',
-                     palette: str = defaults['palette']) -> None:
+                     palette: str = defaults['palette'],
+                     figure_format: str = defaults['figure_format'],
+                     n_jobs: int = defaults['n_jobs']) -> None:
     if vmin == 'auto':
         vmin = None
     if vmax == 'auto':
@@ -376,11 +481,19 @@ def confusion_matrix(output_dir: str,
     _plot_accuracy(output_dir, predictions, truth, probabilities,
                    missing_samples=missing_samples,
                    classification=True, palette=palette,
-                   plot_title='confusion matrix', vmin=vmin, vmax=vmax)
+                   plot_title='confusion matrix', vmin=vmin, vmax=vmax,
+                   figure_format=figure_format, n_jobs=n_jobs)
+
+
+def knn_accuracy(output_dir: str, accuracy: qiime2.Metadata) -> None:
+    accuracy = accuracy.to_dataframe()
+    accuracy.index.name = 'k'
+    _visualize_knn(output_dir, accuracy)
 
 
-def summarize(output_dir: str, sample_estimator: Pipeline):
-    _summarize_estimator(output_dir, sample_estimator)
+def summarize(output_dir: str, sample_estimator: ModelIndex,
+              figure_format: str = defaults['figure_format']):
+    _summarize_estimator(output_dir, sample_estimator, figure_format)
 
 
 def heatmap(ctx, table, importance, sample_metadata=None,
@@ -451,15 +564,15 @@ def detect_outliers(table: biom.Table,
                     contamination: float = 0.05, random_state: int = None,
                     n_jobs: int = defaults['n_jobs'],
                     missing_samples: str = 'ignore') -> (pd.Series):
+    from sklearn.ensemble import IsolationForest
 
     features, sample_md = _load_data(
         table, metadata, missing_samples=missing_samples)
 
     # if opting to train on a subset, choose subset that fits criteria
     if subset_column and subset_value:
-        X_train = \
-            [f for s, f in
-             zip(sample_md[subset_column] == subset_value, features) if s]
+        X_train = features[
+            np.flatnonzero(sample_md[subset_column] == subset_value)]
     # raise error if subset_column or subset_value (but not both) are set
     elif subset_column is not None or subset_value is not None:
         raise ValueError((
@@ -469,7 +582,7 @@ def detect_outliers(table: biom.Table,
         X_train = features
 
     # fit isolation tree
-    estimator = Pipeline([('dv', DictVectorizer()),
+    estimator = Pipeline([('dv', SparseFeatureVectorizer()),
                           ('est', IsolationForest(n_jobs=n_jobs,
                                                   n_estimators=n_estimators,
                                                   contamination=contamination,
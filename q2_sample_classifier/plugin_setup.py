@@ -10,7 +10,7 @@ import importlib
 
 from qiime2.plugin import (
     Int, Str, Float, Range, Bool, Plugin, Metadata, Choices, MetadataColumn,
-    Numeric, Categorical, Citations, Visualization, TypeMatch)
+    Numeric, Categorical, Citations, Visualization, TypeMatch, List)
 from q2_types.feature_table import (
     FeatureTable, Frequency, RelativeFrequency, PresenceAbsence, Balance,
     PercentileNormalized, Design)
@@ -20,24 +20,29 @@ from q2_types.distance_matrix import DistanceMatrix
 from q2_feature_table import heatmap_choices
 from .classify import (
     classify_samples, classify_samples_from_dist, regress_samples,
+    classify_samples_from_query_dist,
     regress_samples_ncv,
     classify_samples_ncv, fit_classifier, fit_regressor, split_table,
     predict_classification, predict_regression, confusion_matrix, scatterplot,
-    summarize, metatable, heatmap)
-from .visuals import _custom_palettes
+    summarize, metatable, heatmap, knn_accuracy)
+from .visuals import palette_names
 from ._format import (SampleEstimatorDirFmt,
                       BooleanSeriesFormat,
                       BooleanSeriesDirectoryFormat,
                       ImportanceFormat,
+                      ImportanceNPZFormat,
                       ImportanceDirectoryFormat,
                       PredictionsFormat,
                       PredictionsDirectoryFormat,
                       ProbabilitiesFormat,
-                      ProbabilitiesDirectoryFormat)
+                      ProbabilitiesNPZFormat,
+                      ProbabilitiesDirectoryFormat,
+                      QueryDistancesFormat,
+                      QueryDistancesDirectoryFormat)
 
 from ._type import (ClassifierPredictions, RegressorPredictions,
                     SampleEstimator, BooleanSeries, Importance,
-                    Classifier, Regressor, Probabilities)
+                    Classifier, Regressor, Probabilities, QueryDistances)
 import q2_sample_classifier
 
 citations = Citations.load('citations.bib', package='q2_sample_classifier')
@@ -106,14 +111,24 @@ parameters = {
     'rfe': {
         'step': Float % Range(0.0, 1.0, inclusive_end=False,
                               inclusive_start=False),
-        'optimize_feature_selection': Bool},
+        'optimize_feature_selection': Bool,
+        'selection_method': Str % Choices(['rfecv', 'importance'])},
     'cv': {
         'cv': Int % Range(1, None),
-        'parameter_tuning': Bool},
+        'parameter_tuning': Bool,
+        'tuning_strategy': Str % Choices(['random', 'halving']),
+        'tuning_iterations': Int % Range(1, None)},
+    'ncv': {
+        'parallel_folds': Bool,
+        'evaluation': Str % Choices(['cv', 'oob'])},
+    'serialization': {
+        'compress': Int % Range(0, 9, inclusive_end=True),
+        'estimator_format': Str % Choices(['joblib', 'tree-arrays'])},
     'modified_metadata': {
         'metadata': Metadata,
         'column': Str},
-    'regressor': {'stratify': Bool}
+    'regressor': {'stratify': Bool},
+    'figures': {'figure_format': Str % Choices(['png+pdf', 'svg'])}
 }
 
 parameter_descriptions = {
@@ -138,17 +153,76 @@ parameter_descriptions = {
                  'percentage of features to remove at each iteration.'),
         'optimize_feature_selection': ('Automatically optimize input feature '
                                        'selection using recursive feature '
-                                       'elimination.')},
+                                       'elimination.'),
+        'selection_method': ('If optimize_feature_selection is True, the '
+                             'method used to choose the optimal number of '
+                             'features. "rfecv" uses cross-validated '
+                             'recursive feature elimination, refitting the '
+                             'estimator at every elimination step. '
+                             '"importance" is much faster: it ranks '
+                             'features once per fold by importance and '
+                             'scores the top-ranked subsets over a '
+                             'geometric grid of about 1/step feature '
+                             'counts.')},
     'cv': {
         'cv': 'Number of k-fold cross-validations to perform.',
         'parameter_tuning': ('Automatically tune hyperparameters using random '
-                             'grid search.')},
+                             'grid search.'),
+        'tuning_strategy': ('If parameter_tuning is True, the search strategy '
+                            'to use. "random" fits every candidate '
+                            'parameter setting on the full training data. '
+                            '"halving" uses successive halving: candidates '
+                            'are first evaluated with few trees (ensemble '
+                            'estimators) or few samples (other estimators), '
+                            'and only the best third advance to each '
+                            'larger round.'),
+        'tuning_iterations': ('If parameter_tuning is True, the number of '
+                              'candidate parameter settings to evaluate.')},
+    'ncv': {
+        'parallel_folds': ('Fit the outer cross-validation folds in '
+                           'parallel. n_jobs is divided between the folds '
+                           'and the estimator (or hyperparameter search) '
+                           'within each fold. Results are identical to '
+                           'fitting folds one at a time.'),
+        'evaluation': ('How to predict each sample. "cv" uses (nested) '
+                       'k-fold cross-validation. "oob" fits the estimator '
+                       'once and predicts each sample from the trees that '
+                       'were not grown on it (out-of-bag), which is about '
+                       'cv times faster. "oob" requires a RandomForest or '
+                       'ExtraTrees estimator, enables bootstrapping, and '
+                       'cannot be combined with parameter_tuning.')},
+    'serialization': {
+        'compress': ('Compression level (0-9) of the saved estimator. 0 '
+                     'disables compression, which gives the fastest saving '
+                     'and loading, and lets numpy arrays in the saved '
+                     'pipeline be memory-mapped when it is loaded. The '
+                     'nodes of decision trees are always loaded into '
+                     'memory unless estimator_format is "tree-arrays". '
+                     'Higher levels give smaller artifacts.'),
+        'estimator_format': (
+            'How the trained estimator is saved. "joblib" saves the '
+            'complete scikit-learn pipeline. "tree-arrays" saves tree '
+            'ensembles (RandomForest, ExtraTrees, GradientBoosting and '
+            'AdaBoost) as compact float32/int32 node arrays. These '
+            'artifacts are smaller, load faster, and can still be used for '
+            'prediction after scikit-learn upgrades; the saved estimator '
+            'can only be used for prediction and summaries, and predicted '
+            'values match the original estimator to float32 precision.')},
     'regressor': {
         'stratify': ('Evenly stratify training and test data among metadata '
                      'categories. If True, all values in column must match '
                      'at least two samples.')},
     'estimator': {
-        'estimator': 'Estimator method to use for sample prediction.'}
+        'estimator': 'Estimator method to use for sample prediction.'},
+    'figures': {
+        'figure_format': ('File format of the figures. "png+pdf" displays '
+                          'a PNG image and links to a PDF. "svg" saves a '
+                          'single SVG, which is faster to produce for large '
+                          'figures (e.g., confusion matrices of many '
+                          'classes) and is only rasterized by the browser '
+                          'when it is displayed.'),
+        'n_jobs': ('Number of processes used to render figures. Each '
+                   'figure and file format is rendered separately.')}
 }
 
 classifiers = Str % Choices(
@@ -170,13 +244,14 @@ pipeline_parameters = {
     **parameters['base'],
     **parameters['rfe'],
     **parameters['splitter'],
-    **parameters['cv']}
+    **parameters['cv'],
+    **parameters['serialization']}
 
 classifier_pipeline_parameters = {
     **pipeline_parameters,
     'metadata': MetadataColumn[Categorical],
     'estimator': classifiers,
-    'palette': Str % Choices(_custom_palettes().keys())}
+    'palette': Str % Choices(palette_names)}
 
 regressor_pipeline_parameters = {
     **pipeline_parameters,
@@ -189,7 +264,8 @@ pipeline_parameter_descriptions = {
     **parameter_descriptions['rfe'],
     **parameter_descriptions['splitter'],
     **parameter_descriptions['estimator'],
-    **parameter_descriptions['cv']}
+    **parameter_descriptions['cv'],
+    **parameter_descriptions['serialization']}
 
 classifier_pipeline_parameter_descriptions = {
     **pipeline_parameter_descriptions,
@@ -247,21 +323,40 @@ plugin.pipelines.register_function(
     parameters={
         'metadata': MetadataColumn[Categorical],
         'k': Int,
-        'palette': Str % Choices(_custom_palettes().keys()),
+        'palette': Str % Choices(palette_names),
+        'memory_map': Bool,
+        'block_size': Int % Range(1, None),
+        'k_values': List[Int % Range(1, None)],
     },
     outputs=[
         ('predictions', SampleData[ClassifierPredictions]),
         ('accuracy_results', Visualization),
+        ('k_accuracy', Visualization),
     ],
     input_descriptions={'distance_matrix': 'a distance matrix'},
     parameter_descriptions={
         'metadata': 'Categorical metadata column to use as prediction target.',
         'k': 'Number of nearest neighbors',
         'palette': 'The color palette to use for plotting.',
+        'memory_map': 'Stream the distance matrix into a temporary '
+                      'memory-mapped file instead of loading it into memory. '
+                      'Use for distance matrices larger than available RAM; '
+                      'predictions are identical to the in-memory mode. The '
+                      'temporary file needs as much free disk space as the '
+                      'full matrix (8 bytes per pair of samples).',
+        'block_size': 'Number of distance matrix rows processed at a time. '
+                      'Peak memory use grows with block_size times the '
+                      'number of samples.',
+        'k_values': 'Evaluate several numbers of nearest neighbors in a '
+                    'single pass over the distance matrix. Leave-one-out '
+                    'accuracy for each k is shown in k_accuracy, and '
+                    'predictions are returned for the most accurate k (the '
+                    'smallest, if tied). Overrides k.',
         },
     output_descriptions={
         'predictions': 'leave one out predictions for each sample',
         'accuracy_results': 'Accuracy results visualization.',
+        'k_accuracy': 'Leave-one-out accuracy for each k.',
     },
     name=('Run k-nearest-neighbors on a labeled distance matrix.'),
     description=(
@@ -272,6 +367,37 @@ plugin.pipelines.register_function(
 )
 
 
+plugin.methods.register_function(
+    function=classify_samples_from_query_dist,
+    inputs={'distances': SampleData[QueryDistances]},
+    parameters={
+        'metadata': MetadataColumn[Categorical],
+        'k': Int % Range(1, None),
+        'block_size': Int % Range(1, None),
+    },
+    outputs=[('predictions', SampleData[ClassifierPredictions])],
+    input_descriptions={
+        'distances': 'Distances between each query sample (rows) and each '
+                     'labeled reference sample (columns).'},
+    parameter_descriptions={
+        'metadata': 'Categorical metadata column containing the labels of '
+                    'the reference samples.',
+        'k': 'Number of nearest neighbors',
+        'block_size': 'Number of query samples processed at a time.',
+    },
+    output_descriptions={
+        'predictions': 'Predicted labels for each query sample.'},
+    name='Run k-nearest-neighbors on query samples against labeled '
+         'reference samples.',
+    description=(
+        'Predict the labels of new (query) samples from their distances to '
+        'a set of labeled reference samples, using the same k-nearest-'
+        'neighbors voting as classify-samples-from-dist. Only the query x '
+        'reference distances are needed, not a distance matrix of all '
+        'samples.')
+)
+
+
 plugin.pipelines.register_function(
     function=regress_samples,
     inputs=inputs,
@@ -292,6 +418,7 @@ plugin.methods.register_function(
     parameters={
         **parameters['base'],
         **parameters['cv'],
+        **parameters['ncv'],
         'metadata': MetadataColumn[Numeric],
         **parameters['regressor'],
         'estimator': regressors},
@@ -301,6 +428,7 @@ plugin.methods.register_function(
     parameter_descriptions={
         **parameter_descriptions['base'],
         **parameter_descriptions['cv'],
+        **parameter_descriptions['ncv'],
         **parameter_descriptions['regressor'],
         'metadata': 'Numeric metadata column to use as prediction target.',
         **parameter_descriptions['estimator']},
@@ -316,6 +444,7 @@ plugin.methods.register_function(
     parameters={
         **parameters['base'],
         **parameters['cv'],
+        **parameters['ncv'],
         'metadata': MetadataColumn[Categorical],
         'estimator': classifiers},
     outputs=[('predictions', SampleData[ClassifierPredictions]),
@@ -325,6 +454,7 @@ plugin.methods.register_function(
     parameter_descriptions={
         **parameter_descriptions['base'],
         **parameter_descriptions['cv'],
+        **parameter_descriptions['ncv'],
         'metadata': 'Categorical metadata column to use as prediction target.',
         **parameter_descriptions['estimator']},
     output_descriptions={**output_descriptions,
@@ -342,6 +472,7 @@ plugin.methods.register_function(
         **parameters['base'],
         **parameters['rfe'],
         **parameters['cv'],
+        **parameters['serialization'],
         'metadata': MetadataColumn[Categorical],
         'estimator': classifiers},
     outputs=[('sample_estimator', SampleEstimator[Classifier]),
@@ -351,6 +482,7 @@ plugin.methods.register_function(
         **parameter_descriptions['base'],
         **parameter_descriptions['rfe'],
         **parameter_descriptions['cv'],
+        **parameter_descriptions['serialization'],
         'metadata': 'Numeric metadata column to use as prediction target.',
         **parameter_descriptions['estimator']},
     output_descriptions={
@@ -368,6 +500,7 @@ plugin.methods.register_function(
         **parameters['base'],
         **parameters['rfe'],
         **parameters['cv'],
+        **parameters['serialization'],
         'metadata': MetadataColumn[Numeric],
         'estimator': regressors},
     outputs=[('sample_estimator', SampleEstimator[Regressor]),
@@ -377,6 +510,7 @@ plugin.methods.register_function(
         **parameter_descriptions['base'],
         **parameter_descriptions['rfe'],
         **parameter_descriptions['cv'],
+        **parameter_descriptions['serialization'],
         'metadata': 'Numeric metadata column to use as prediction target.',
         **parameter_descriptions['estimator']},
     output_descriptions={
@@ -427,13 +561,16 @@ plugin.visualizers.register_function(
     inputs={'predictions': SampleData[RegressorPredictions]},
     parameters={
         'truth': MetadataColumn[Numeric],
-        'missing_samples': parameters['base']['missing_samples']},
+        'missing_samples': parameters['base']['missing_samples'],
+        **parameters['figures'],
+        'n_jobs': parameters['base']['n_jobs']},
     input_descriptions={'predictions': (
         'Predicted values to plot on y axis. Must be predictions of '
         'numeric data produced by a sample regressor.')},
     parameter_descriptions={
         'truth': 'Metadata column (true values) to plot on x axis.',
-        'missing_samples': parameter_descriptions['base']['missing_samples']},
+        'missing_samples': parameter_descriptions['base']['missing_samples'],
+        **parameter_descriptions['figures']},
     name='Make 2D scatterplot and linear regression of regressor predictions.',
     description='Make a 2D scatterplot and linear regression of predicted vs. '
                 'true values for a set of samples predicted using a sample '
@@ -450,7 +587,9 @@ plugin.visualizers.register_function(
         'missing_samples': parameters['base']['missing_samples'],
         'vmin': Float | Str % Choices(['auto']),
         'vmax': Float | Str % Choices(['auto']),
-        'palette': Str % Choices(_custom_palettes().keys())},
+        'palette': Str % Choices(palette_names),
+        **parameters['figures'],
+        'n_jobs': parameters['base']['n_jobs']},
     input_descriptions={
         'predictions': 'Predicted values to plot on x axis. Should be '
                        'predictions of categorical data produced by a sample '
@@ -463,14 +602,17 @@ plugin.visualizers.register_function(
         '"auto", vmin is set to the minimum value in the data.',
         'vmax': 'The maximum value to use for anchoring the colormap. If '
         '"auto", vmax is set to the maximum value in the data.',
-        'palette': 'The color palette to use for plotting.'},
+        'palette': 'The color palette to use for plotting.',
+        **parameter_descriptions['figures']},
     name='Make a confusion matrix from sample classifier predictions.',
     description='Make a confusion matrix and calculate accuracy of predicted '
                 'vs. true values for a set of samples classified using a '
                 'sample classifier. If per-sample class probabilities are '
                 'provided, will also generate Receiver Operating '
                 'Characteristic curves and calculate area under the curve for '
-                'each class.'
+                'each class. With more than 100 classes, the heatmap shows '
+                'blocks of consecutive classes; the exact matrix is included '
+                'in the results table.'
 )
 
 
@@ -507,14 +649,29 @@ plugin.methods.register_function(
 )
 
 
+plugin.visualizers.register_function(
+    function=knn_accuracy,
+    inputs={},
+    parameters={'accuracy': Metadata},
+    parameter_descriptions={
+        'accuracy': 'Leave-one-out accuracy (in an "Accuracy" column) of '
+                    'each number of nearest neighbors (the metadata IDs).'},
+    name='Tabulate KNN accuracy by number of nearest neighbors.',
+    description='Tabulate the leave-one-out accuracy of each number of '
+                'nearest neighbors evaluated by classify_samples_from_dist, '
+                'marking the most accurate.'
+)
+
+
 plugin.visualizers.register_function(
     function=summarize,
     inputs={'sample_estimator': SampleEstimator[Classifier | Regressor]},
-    parameters={},
+    parameters=parameters['figures'],
     input_descriptions={
         'sample_estimator': 'Sample estimator trained with fit_classifier or '
                             'fit_regressor.'},
-    parameter_descriptions={},
+    parameter_descriptions={
+        'figure_format': parameter_descriptions['figures']['figure_format']},
     name='Summarize parameter and feature extraction information for a '
          'trained estimator.',
     description='Summarize parameter and feature extraction information for a '
@@ -623,7 +780,8 @@ plugin.pipelines.register_function(
 # Registrations
 plugin.register_semantic_types(
     SampleEstimator, BooleanSeries, Importance, ClassifierPredictions,
-    RegressorPredictions, Classifier, Regressor, Probabilities)
+    RegressorPredictions, Classifier, Regressor, Probabilities,
+    QueryDistances)
 plugin.register_semantic_type_to_format(
     SampleEstimator[Classifier],
     artifact_format=SampleEstimatorDirFmt)
@@ -645,9 +803,13 @@ plugin.register_semantic_type_to_format(
 plugin.register_semantic_type_to_format(
     SampleData[Probabilities],
     artifact_format=ProbabilitiesDirectoryFormat)
+plugin.register_semantic_type_to_format(
+    SampleData[QueryDistances],
+    artifact_format=QueryDistancesDirectoryFormat)
 plugin.register_formats(
     SampleEstimatorDirFmt, BooleanSeriesFormat, BooleanSeriesDirectoryFormat,
-    ImportanceFormat, ImportanceDirectoryFormat, PredictionsFormat,
-    PredictionsDirectoryFormat, ProbabilitiesFormat,
-    ProbabilitiesDirectoryFormat)
+    ImportanceFormat, ImportanceNPZFormat, ImportanceDirectoryFormat,
+    PredictionsFormat, PredictionsDirectoryFormat, ProbabilitiesFormat,
+    ProbabilitiesNPZFormat, ProbabilitiesDirectoryFormat, QueryDistancesFormat,
+    QueryDistancesDirectoryFormat)
 importlib.import_module('q2_sample_classifier._transformer')
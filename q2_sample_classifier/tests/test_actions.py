@@ -5,6 +5,7 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import os
 import pandas as pd
 import numpy as np
 import biom
@@ -16,6 +17,7 @@ from q2_sample_classifier.tests.test_base_class import \
     SampleClassifierTestPluginBase
 from q2_sample_classifier.tests.test_estimators import SampleEstimatorTestBase
 from q2_sample_classifier.classify import summarize
+from q2_sample_classifier import SampleEstimatorDirFmt, ModelIndex
 
 
 class NowLetsTestTheActions(SampleClassifierTestPluginBase):
@@ -158,3 +160,10 @@ class TestSummarize(SampleEstimatorTestBase):
     def test_summary_without_rfecv(self):
         del self.pipeline.rfe_scores
         summarize(self.temp_dir.name, self.pipeline)
+
+    def test_summary_from_model_index(self):
+        index = self.get_transformer(SampleEstimatorDirFmt, ModelIndex)(
+            self._sklp)
+        summarize(self.temp_dir.name, index)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.temp_dir.name, 'rfe_plot.png')))
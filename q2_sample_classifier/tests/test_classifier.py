@@ -18,7 +18,8 @@ from qiime2.plugins import sample_classifier
 
 from q2_sample_classifier.visuals import (
     _custom_palettes, _roc_palette, _roc_per_class, _roc_micro_average,
-    _roc_macro_average, _binarize_labels, _generate_roc_plots)
+    _roc_macro_average, _binarize_labels, _generate_roc_plots,
+    _downsample_roc, palette_names)
 from q2_sample_classifier.utilities import _extract_rfe_scores
 from q2_sample_classifier.tests.test_base_class import \
     SampleClassifierTestPluginBase
@@ -152,6 +153,9 @@ class TestROC(SampleClassifierTestPluginBase):
     def test_roc_palette(self):
         [_roc_palette(p, 3) for p in _custom_palettes().keys()]
 
+    def test_palette_names(self):
+        self.assertEqual(palette_names, list(_custom_palettes()))
+
     def test_roc_per_class(self):
         fpr, tdr, roc_auc = _roc_per_class(self.md, self.probs, [0, 1, 2])
         for d, e in zip([fpr, tdr, roc_auc],
@@ -175,16 +179,33 @@ class TestROC(SampleClassifierTestPluginBase):
 
     def test_roc_macro_average(self):
         fpr, tdr, roc_auc = _roc_macro_average(
-            self.exp_fpr, self.exp_tdr, self.exp_roc_auc, [0, 1, 2])
-        np.testing.assert_array_almost_equal(fpr['macro'], np.array(
-            [0., 0.07142857, 0.07692308, 0.14285714, 0.15384615, 0.46153846,
-             0.61538462, 0.69230769, 0.76923077, 0.78571429, 0.84615385,
-             0.92857143, 1.]))
+            self.exp_fpr, self.exp_tdr, self.exp_roc_auc, [0, 1, 2],
+            n_points=11)
+        np.testing.assert_array_almost_equal(
+            fpr['macro'], np.linspace(0, 1, 11))
         np.testing.assert_array_almost_equal(tdr['macro'], np.array(
-            [0.04761905, 0.1031746, 0.1031746, 0.21428571, 0.26190476,
-             0.45238095, 0.54761905, 0.64285714, 0.69047619, 0.74603175,
-             0.7936508, 0.90476191, 1.]))
-        self.assertAlmostEqual(roc_auc['macro'], 0.49930228548098726)
+            [0.04761905, 0.1031746, 0.26190476, 0.26190476, 0.26190476,
+             0.45238095, 0.45238095, 0.64285714, 0.74603175, 0.7936508, 1.]))
+        # macro-average AUC is the mean of the per-class AUCs
+        self.assertAlmostEqual(roc_auc['macro'], 0.4413919413919414)
+
+    def test_downsample_roc(self):
+        np.random.seed(0)
+        fpr = np.r_[0, np.sort(np.random.rand(1000)), 1]
+        tpr = np.r_[0, np.sort(np.random.rand(1000)), 1]
+        ds_fpr, ds_tpr = _downsample_roc(fpr, tpr, max_points=50)
+        self.assertLessEqual(len(ds_fpr), 51)
+        self.assertEqual((ds_fpr[0], ds_tpr[0]), (0, 0))
+        self.assertEqual((ds_fpr[-1], ds_tpr[-1]), (1, 1))
+        # vertices are a subset of the original curve
+        np.testing.assert_array_equal(
+            ds_tpr, tpr[np.searchsorted(fpr, ds_fpr)])
+
+    def test_downsample_roc_short_curve(self):
+        fpr, tpr = self.exp_fpr[0], self.exp_tdr[0]
+        ds_fpr, ds_tpr = _downsample_roc(fpr, tpr)
+        np.testing.assert_array_equal(ds_fpr, fpr)
+        np.testing.assert_array_equal(ds_tpr, tpr)
 
     # Proves that the ROC nuts + bolts work if predictions does not have all
     # the classes present in probabilities. This will occur if there are many
@@ -5,12 +5,16 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import copy
 import os
 import pandas as pd
 import pandas.util.testing as pdt
 import biom
 import shutil
 import json
+import tarfile
+import joblib
+import pickle
 import numpy as np
 from sklearn.metrics import mean_squared_error, accuracy_score
 from sklearn.ensemble import AdaBoostClassifier
@@ -27,12 +31,13 @@ from q2_sample_classifier.tests.test_base_class import \
 from q2_sample_classifier.classify import (
     regress_samples_ncv, classify_samples_ncv, fit_classifier, fit_regressor,
     detect_outliers, split_table, predict_classification,
-    predict_regression)
+    predict_regression, summarize)
 from q2_sample_classifier.utilities import (
     _set_parameters_and_estimator, _train_adaboost_base_estimator,
-    _match_series_or_die, _extract_features)
+    _match_series_or_die, _extract_features, SparseFeatureVectorizer,
+    SparseFeatureMatrix)
 from q2_sample_classifier import (
-    SampleEstimatorDirFmt, PickleFormat)
+    SampleEstimatorDirFmt, ModelIndex, estimator_cache)
 
 
 class SampleEstimatorTestBase(SampleClassifierTestPluginBase):
@@ -40,6 +45,8 @@ class SampleEstimatorTestBase(SampleClassifierTestPluginBase):
 
     def setUp(self):
         super().setUp()
+        # pipelines loaded by earlier tests are not shared between tests
+        estimator_cache.clear()
 
         def _load_biom(table_fp):
             table_fp = self.get_data_path(table_fp)
@@ -63,8 +70,8 @@ class SampleEstimatorTestBase(SampleClassifierTestPluginBase):
         transformer = self.get_transformer(
             Pipeline, SampleEstimatorDirFmt)
         self._sklp = transformer(pipeline)
-        sklearn_pipeline = self._sklp.sklearn_pipeline.view(PickleFormat)
-        self.sklearn_pipeline = str(sklearn_pipeline)
+        self.sklearn_pipeline = str(
+            self._sklp.path / 'sklearn_pipeline.joblib')
         self.pipeline = pipeline
 
     def _custom_setup(self, version):
@@ -75,6 +82,21 @@ class SampleEstimatorTestBase(SampleClassifierTestPluginBase):
         return SampleEstimatorDirFmt(
             self.temp_dir.name, mode='r')
 
+    # the layout written before sklearn_pipeline.joblib: a tar of the
+    # joblib dump
+    def _legacy_setup(self, version):
+        with open(os.path.join(self.temp_dir.name,
+                               'sklearn_version.json'), 'w') as fh:
+            fh.write(json.dumps({'sklearn-version': version}))
+        pf = os.path.join(self.temp_dir.name, 'sklearn_pipeline.pkl')
+        with tarfile.open(os.path.join(
+                self.temp_dir.name, 'sklearn_pipeline.tar'), 'w') as tar:
+            for fn in joblib.dump(self.pipeline, pf):
+                tar.add(fn, os.path.basename(fn))
+                os.unlink(fn)
+        return SampleEstimatorDirFmt(
+            self.temp_dir.name, mode='r')
+
 
 class EstimatorsTests(SampleClassifierTestPluginBase):
 
@@ -130,18 +152,57 @@ class EstimatorsTests(SampleClassifierTestPluginBase):
     # test feature extraction
     def test_extract_features(self):
         table = self.table_ecam_fp
-        dicts = _extract_features(table)
-        dv = DictVectorizer()
-        dv.fit(dicts)
-        features = table.ids('observation')
-        self.assertEqual(set(dv.get_feature_names()), set(features))
-        self.assertEqual(len(dicts), len(table.ids()))
-        for dict_row, (table_row, _, _) in zip(dicts, table.iter()):
-            for feature, count in zip(features, table_row):
-                if count == 0:
-                    self.assertTrue(feature not in dict_row)
-                else:
-                    self.assertEqual(dict_row[feature], count)
+        features = _extract_features(table)
+        self.assertEqual(features.shape, table.shape[::-1])
+        self.assertEqual(len(features), len(table.ids()))
+        # features are sorted by id
+        self.assertEqual(
+            list(features.feature_ids), sorted(table.ids('observation')))
+        table = table.sort_order(features.feature_ids, axis='observation')
+        for feature_row, (table_row, _, _) in zip(
+                features.matrix.toarray(), table.iter()):
+            np.testing.assert_array_equal(feature_row, table_row)
+
+    # the sparse vectorizer must reproduce the DictVectorizer output that
+    # estimators were trained on in earlier releases
+    def test_sparse_feature_vectorizer_matches_dict_vectorizer(self):
+        table = self.table_ecam_fp
+        ids = table.ids('observation')
+        dicts = [{ids[ix]: d for ix, d in zip(row.indices, row.data)}
+                 for row in table.matrix_data.T]
+        exp = DictVectorizer().fit(dicts)
+        obs = SparseFeatureVectorizer().fit(_extract_features(table))
+        self.assertEqual(obs.get_feature_names(), exp.get_feature_names())
+        np.testing.assert_array_equal(
+            obs.transform(_extract_features(table)).toarray(),
+            exp.transform(dicts).toarray())
+
+    def test_sparse_feature_vectorizer_unknown_and_reordered_features(self):
+        train = biom.Table(np.array([[1, 0, 2], [0, 3, 4], [0, 0, 0]]),
+                           ['o2', 'o1', 'o3'], ['s1', 's2', 's3'])
+        test = biom.Table(np.array([[5, 6], [7, 8], [9, 10]]),
+                          ['o4', 'o1', 'o2'], ['s4', 's5'])
+        dv = SparseFeatureVectorizer().fit(_extract_features(train))
+        # o3 was never observed in training, o4 is unknown
+        self.assertEqual(dv.get_feature_names(), ['o1', 'o2'])
+        obs = dv.transform(_extract_features(test)).toarray()
+        np.testing.assert_array_equal(obs, [[7, 9], [8, 10]])
+
+    # row slices of the training matrix are mapped by column position; the
+    # result must match matching on feature ids
+    def test_sparse_feature_vectorizer_shared_coding(self):
+        features = _extract_features(self.table_ecam_fp)
+        train, test = features[np.arange(0, 20)], features[np.arange(20, 40)]
+        dv = SparseFeatureVectorizer().fit(train)
+        self.assertEqual(test.coding, train.coding)
+        by_position = dv.transform(test)
+        relabelled = SparseFeatureMatrix(test.matrix, test.feature_ids)
+        by_id = dv.transform(relabelled)
+        self.assertNotEqual(relabelled.coding, train.coding)
+        np.testing.assert_array_equal(
+            by_position.toarray(), by_id.toarray())
+        # run-specific column positions are not persisted
+        self.assertFalse(hasattr(pickle.loads(pickle.dumps(dv)), 'coding_'))
 
     def test_classify_samples_from_dist(self):
         # -- setup -- #
@@ -199,6 +260,90 @@ class EstimatorsTests(SampleClassifierTestPluginBase):
 
         self.assertTrue(expected.sort_index().equals(pred.sort_index()))
 
+    def test_classify_samples_from_dist_memory_map(self):
+        sample_ids = ('f1', 's1', 's2', 's3', 'f2')
+        distance_matrix = skbio.DistanceMatrix([
+            [0, 2, 3, 3, 1],
+            [2, 0, 1, 1, 4],
+            [3, 1, 0, 1, 5],
+            [3, 1, 1, 0, 2],
+            [1, 4, 5, 2, 0],
+            ], ids=sample_ids)
+        dm = qiime2.Artifact.import_data('DistanceMatrix', distance_matrix)
+        categories = pd.Series(('fat', 'skinny', 'skinny', 'fat', 'fat'),
+                               index=sample_ids, name='body_mass')
+        categories.index.name = 'SampleID'
+        metadata = qiime2.CategoricalMetadataColumn(categories)
+
+        exp = sample_classifier.actions.classify_samples_from_dist(
+            distance_matrix=dm, metadata=metadata, k=2)[0].view(pd.Series)
+        for block_size in (1, 2, 1000):
+            res = sample_classifier.actions.classify_samples_from_dist(
+                distance_matrix=dm, metadata=metadata, k=2,
+                memory_map=True, block_size=block_size)
+            pdt.assert_series_equal(res[0].view(pd.Series), exp)
+
+    def test_classify_samples_from_dist_k_values(self):
+        sample_ids = ('f1', 's1', 's2', 's3', 'f2')
+        distance_matrix = skbio.DistanceMatrix([
+            [0, 2, 3, 3, 1],
+            [2, 0, 1, 1, 4],
+            [3, 1, 0, 1, 5],
+            [3, 1, 1, 0, 2],
+            [1, 4, 5, 2, 0],
+            ], ids=sample_ids)
+        dm = qiime2.Artifact.import_data('DistanceMatrix', distance_matrix)
+        categories = pd.Series(('fat', 'skinny', 'skinny', 'skinny', 'fat'),
+                               index=sample_ids, name='body_mass')
+        categories.index.name = 'SampleID'
+        metadata = qiime2.CategoricalMetadataColumn(categories)
+
+        # k=1 classifies every sample correctly, k=4 does not
+        res = sample_classifier.actions.classify_samples_from_dist(
+            distance_matrix=dm, metadata=metadata, k_values=[4, 1])
+        exp = sample_classifier.actions.classify_samples_from_dist(
+            distance_matrix=dm, metadata=metadata, k=1)
+        pdt.assert_series_equal(
+            res[0].view(pd.Series), exp[0].view(pd.Series))
+        self.assertEqual(str(res.k_accuracy.type), 'Visualization')
+
+    def test_classify_samples_from_query_dist(self):
+        distances = qiime2.Artifact.import_data(
+            'SampleData[QueryDistances]', pd.DataFrame(
+                [[0.1, 0.9, 0.8, 0.7],
+                 [0.85, 0.2, 0.15, 0.9],
+                 [0.5, 0.45, 0.6, 0.05]],
+                index=['q1', 'q2', 'q3'], columns=['r1', 'r2', 'r3', 'r4']))
+        categories = pd.Series(('fat', 'skinny', 'skinny', 'fat', 'fat'),
+                               index=['r4', 'r3', 'r2', 'r1', 'r5'],
+                               name='body_mass')
+        categories.index.name = 'SampleID'
+        metadata = qiime2.CategoricalMetadataColumn(categories)
+
+        res = sample_classifier.actions.classify_samples_from_query_dist(
+            distances=distances, metadata=metadata, k=1)
+        pred = res[0].view(pd.Series)
+        exp = pd.Series(('fat', 'skinny', 'fat'), index=['q1', 'q2', 'q3'])
+        self.assertTrue(exp.equals(pred.sort_index()))
+
+        # a 2-2 vote goes to the nearest of the tied categories
+        res = sample_classifier.actions.classify_samples_from_query_dist(
+            distances=distances, metadata=metadata, k=4, block_size=2)
+        pred = res[0].view(pd.Series)
+        exp = pd.Series(('fat', 'skinny', 'fat'), index=['q1', 'q2', 'q3'])
+        self.assertTrue(exp.equals(pred.sort_index()))
+
+    def test_classify_samples_from_query_dist_missing_reference(self):
+        distances = qiime2.Artifact.import_data(
+            'SampleData[QueryDistances]', pd.DataFrame(
+                [[0.1, 0.9]], index=['q1'], columns=['r1', 'r2']))
+        categories = pd.Series(('fat',), index=['r1'], name='body_mass')
+        categories.index.name = 'SampleID'
+        metadata = qiime2.CategoricalMetadataColumn(categories)
+        with self.assertRaisesRegex(ValueError, 'not present.*r2'):
+            sample_classifier.actions.classify_samples_from_query_dist(
+                distances=distances, metadata=metadata)
+
     def test_2nn(self):
         # -- setup -- #
         # 2 nearest neighbors of each sample are
@@ -315,6 +460,78 @@ class EstimatorsTests(SampleClassifierTestPluginBase):
         pdt.assert_series_equal(y_pred, self.exp_pred)
         pdt.assert_frame_equal(importances, self.exp_imp)
 
+    # successive halving tunes on fewer trees, but the returned estimator
+    # must be refit with the requested number of trees
+    def test_fit_regressor_halving_search(self):
+        pipeline, importances = fit_regressor(
+            self.table_ecam_fp, self.mdc_ecam_fp, random_state=123,
+            n_estimators=9, n_jobs=1, parameter_tuning=True,
+            tuning_strategy='halving', tuning_iterations=9,
+            missing_samples='ignore')
+        self.assertEqual(pipeline.named_steps.est.n_estimators, 9)
+
+    def test_regress_samples_ncv_halving_search_knn(self):
+        y_pred, importances = regress_samples_ncv(
+            self.table_ecam_fp, self.mdc_ecam_fp, random_state=123,
+            n_jobs=1, parameter_tuning=True, tuning_strategy='halving',
+            tuning_iterations=4, estimator='KNeighborsRegressor',
+            missing_samples='ignore')
+        self.assertEqual(len(y_pred), len(self.exp_pred))
+
+    # outer folds fit in parallel must match the serial results
+    def test_regress_samples_ncv_parallel_folds(self):
+        y_pred, importances = regress_samples_ncv(
+            self.table_ecam_fp, self.mdc_ecam_fp, random_state=123,
+            n_estimators=2, n_jobs=2, missing_samples='ignore',
+            parallel_folds=True)
+        pdt.assert_series_equal(y_pred, self.exp_pred)
+        pdt.assert_frame_equal(importances, self.exp_imp)
+
+    def test_classify_samples_ncv_parallel_folds(self):
+        exp = classify_samples_ncv(
+            self.table_chard_fp, self.mdc_chard_fp, random_state=123,
+            n_estimators=2, n_jobs=1, parameter_tuning=True,
+            missing_samples='ignore')
+        obs = classify_samples_ncv(
+            self.table_chard_fp, self.mdc_chard_fp, random_state=123,
+            n_estimators=2, n_jobs=2, parameter_tuning=True,
+            missing_samples='ignore', parallel_folds=True)
+        pdt.assert_series_equal(obs[0], exp[0])
+        pdt.assert_frame_equal(obs[1], exp[1])
+        pdt.assert_frame_equal(obs[2], exp[2])
+
+    def test_classify_samples_ncv_oob(self):
+        y_pred, importances, probabilities = classify_samples_ncv(
+            self.table_chard_fp, self.mdc_chard_fp, random_state=123,
+            n_estimators=50, n_jobs=1, evaluation='oob',
+            missing_samples='ignore')
+        self.assertEqual(list(y_pred.index), list(probabilities.index))
+        np.testing.assert_array_almost_equal(probabilities.sum(axis=1), 1.)
+        pdt.assert_series_equal(
+            probabilities.idxmax(axis=1), y_pred, check_names=False)
+        self.assertEqual(importances.shape[1], 1)
+
+    def test_regress_samples_ncv_oob(self):
+        y_pred, importances = regress_samples_ncv(
+            self.table_ecam_fp, self.mdc_ecam_fp, random_state=123,
+            n_estimators=20, n_jobs=1, evaluation='oob',
+            estimator='ExtraTreesRegressor', missing_samples='ignore')
+        self.assertEqual(set(y_pred.index), set(self.exp_pred.index))
+
+    def test_ncv_oob_unsupported(self):
+        with self.assertRaisesRegex(ValueError, 'bagged ensemble'):
+            classify_samples_ncv(
+                self.table_chard_fp, self.mdc_chard_fp, evaluation='oob',
+                estimator='KNeighborsClassifier', missing_samples='ignore')
+        with self.assertRaisesRegex(ValueError, 'Parameter tuning'):
+            classify_samples_ncv(
+                self.table_chard_fp, self.mdc_chard_fp, evaluation='oob',
+                parameter_tuning=True, missing_samples='ignore')
+        with self.assertRaisesRegex(ValueError, 'out-of-bag prediction'):
+            classify_samples_ncv(
+                self.table_chard_fp, self.mdc_chard_fp, evaluation='oob',
+                n_estimators=1, missing_samples='ignore')
+
     # test that fit_* methods output consistent importance scores
     def test_fit_regressor(self):
         pipeline, importances = fit_regressor(
@@ -334,6 +551,21 @@ class EstimatorsTests(SampleClassifierTestPluginBase):
             n_estimators=2, n_jobs=1, optimize_feature_selection=True,
             parameter_tuning=True, missing_samples='ignore')
 
+    def test_fit_classifier_importance_selection(self):
+        pipeline, importances = fit_classifier(
+            self.table_ecam_fp, self.mdc_ecam_fp, random_state=123,
+            n_estimators=2, n_jobs=1, optimize_feature_selection=True,
+            selection_method='importance', step=0.25,
+            missing_samples='ignore')
+        rfe_scores = pipeline.rfe_scores
+        self.assertEqual(rfe_scores.name, 'Accuracy')
+        # geometric grid from 1 feature to all features
+        self.assertEqual(rfe_scores.index[0], 1)
+        self.assertTrue(rfe_scores.index.is_monotonic_increasing)
+        # the estimator is trained on the selected features only
+        self.assertEqual(len(pipeline.named_steps.dv.get_feature_names()),
+                         rfe_scores.idxmax())
+
     # test that each regressor works and delivers an expected accuracy result
     # when a random seed is set.
     def test_regressors(self):
@@ -520,6 +752,78 @@ class EstimatorsTests(SampleClassifierTestPluginBase):
         self.assertAlmostEqual(
             mse, seeded_predict_results['RandomForestRegressor'])
 
+    # tree ensembles saved as arrays predict like the original estimators
+    def test_predict_from_tree_arrays(self):
+        to_dirfmt = self.get_transformer(Pipeline, SampleEstimatorDirFmt)
+        from_dirfmt = self.get_transformer(SampleEstimatorDirFmt, Pipeline)
+        for classifier in ['RandomForestClassifier', 'ExtraTreesClassifier',
+                           'GradientBoostingClassifier', 'AdaBoostClassifier']:
+            estimator, _ = fit_classifier(
+                self.table_chard_fp, self.mdc_chard_fp, random_state=123,
+                n_estimators=2, estimator=classifier, n_jobs=1,
+                missing_samples='ignore', estimator_format='tree-arrays')
+            dirfmt = to_dirfmt(estimator)
+            self.assertTrue((dirfmt.path / 'tree_ensemble.npz').exists())
+            arrays = from_dirfmt(dirfmt)
+            exp_pred, exp_prob = predict_classification(
+                self.table_chard_fp, estimator)
+            pred, prob = predict_classification(self.table_chard_fp, arrays)
+            pdt.assert_series_equal(pred, exp_pred)
+            pdt.assert_frame_equal(prob, exp_prob, check_exact=False,
+                                   atol=1e-6)
+        for regressor in ['RandomForestRegressor', 'ExtraTreesRegressor',
+                          'GradientBoostingRegressor', 'AdaBoostRegressor']:
+            estimator, _ = fit_regressor(
+                self.table_ecam_fp, self.mdc_ecam_fp, random_state=123,
+                n_estimators=2, estimator=regressor, n_jobs=1,
+                missing_samples='ignore', estimator_format='tree-arrays')
+            arrays = from_dirfmt(to_dirfmt(estimator))
+            exp = predict_regression(self.table_ecam_fp, estimator)
+            pred = predict_regression(self.table_ecam_fp, arrays)
+            pdt.assert_series_equal(pred, exp, check_exact=False, rtol=1e-6)
+
+    def test_save_options_are_not_set_on_pipeline(self):
+        estimator, _ = fit_classifier(
+            self.table_chard_fp, self.mdc_chard_fp, random_state=123,
+            n_estimators=2, n_jobs=1, missing_samples='ignore', compress=3)
+        dirfmt = self.get_transformer(Pipeline, SampleEstimatorDirFmt)(
+            estimator)
+        with open(str(dirfmt.path / 'sklearn_pipeline.joblib'), 'rb') as fh:
+            self.assertEqual(fh.read(1), b'\x78')
+        obs = self.get_transformer(SampleEstimatorDirFmt, Pipeline)(dirfmt)
+        for pipeline in (estimator, obs):
+            for attr in ('compress', 'joblib_compress', 'estimator_format'):
+                self.assertFalse(hasattr(pipeline, attr))
+
+        # copies of the pipeline are saved with the default options
+        dirfmt = self.get_transformer(Pipeline, SampleEstimatorDirFmt)(
+            copy.copy(estimator))
+        with open(str(dirfmt.path / 'sklearn_pipeline.joblib'), 'rb') as fh:
+            self.assertEqual(fh.read(1), b'\x80')
+
+    def test_parallel_budget_is_recorded(self):
+        estimator, _ = fit_classifier(
+            self.table_chard_fp, self.mdc_chard_fp, random_state=123,
+            n_estimators=2, n_jobs=1, missing_samples='ignore')
+        dirfmt = self.get_transformer(Pipeline, SampleEstimatorDirFmt)(
+            estimator)
+        index = self.get_transformer(SampleEstimatorDirFmt, ModelIndex)(
+            dirfmt)
+        self.assertEqual(index.parallel_budget, {
+            'n_jobs': 1, 'folds': 1, 'search': 1, 'estimator': 1,
+            'blas_threads': 1})
+        self.assertFalse(hasattr(estimator, 'parallel_budget'))
+
+        summarize(self.temp_dir.name, index)
+        with open(os.path.join(self.temp_dir.name, 'index.html')) as fh:
+            self.assertIn('parallel_budget__estimator', fh.read())
+
+    def test_tree_arrays_unsupported_estimator(self):
+        with self.assertRaisesRegex(ValueError, 'only available for tree'):
+            fit_classifier(
+                self.table_chard_fp, self.mdc_chard_fp, estimator='SVC',
+                missing_samples='ignore', estimator_format='tree-arrays')
+
 
 seeded_results = {
     'RandomForestClassifier': 0.63636363636363635,
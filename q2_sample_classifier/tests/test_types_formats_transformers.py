@@ -10,11 +10,14 @@ import pandas as pd
 import pandas.util.testing as pdt
 import numpy as np
 import shutil
-import tempfile
-import tarfile
+import json
 import joblib
 import sklearn
 from sklearn.pipeline import Pipeline
+from sklearn.svm import LinearSVC
+from sklearn.ensemble import AdaBoostClassifier
+from sklearn.tree import DecisionTreeClassifier
+from scipy.sparse import csr_matrix
 
 
 import qiime2
@@ -26,12 +29,17 @@ from q2_sample_classifier import (
     BooleanSeriesFormat, BooleanSeriesDirectoryFormat, BooleanSeries,
     PredictionsFormat, PredictionsDirectoryFormat, ClassifierPredictions,
     RegressorPredictions, ImportanceFormat, ImportanceDirectoryFormat,
-    Importance, PickleFormat, ProbabilitiesFormat,
+    Importance, PickleFormat, JoblibFormat, ProbabilitiesFormat,
     ProbabilitiesDirectoryFormat, Probabilities, Classifier, Regressor,
-    SampleEstimator, SampleEstimatorDirFmt)
+    SampleEstimator, SampleEstimatorDirFmt, QueryDistancesFormat,
+    QueryDistancesDirectoryFormat, QueryDistances, ImportanceNPZFormat,
+    ModelIndex, estimator_cache, set_save_options)
 from q2_sample_classifier.visuals import (
     _custom_palettes, _plot_heatmap_from_confusion_matrix,)
 from q2_sample_classifier._format import JSONFormat
+from q2_sample_classifier.utilities import (
+    SparseFeatureMatrix, SparseFeatureVectorizer)
+from q2_sample_classifier._tree_ensemble import TreeEnsembleClassifier
 from q2_sample_classifier.tests.test_base_class import \
     SampleClassifierTestPluginBase
 from q2_sample_classifier.tests.test_estimators import SampleEstimatorTestBase
@@ -282,6 +290,33 @@ class TestSemanticTypes(SampleClassifierTestPluginBase):
         with self.assertRaisesRegex(ValidationError, 'two or more fields'):
             format.validate()
 
+    def test_Probabilities_format_validate_reports_line_number(self):
+        filepath = os.path.join(self.temp_dir.name, 'probabilities.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write('id\tA\tB\n')
+            for i in range(7):
+                fh.write('s{0}\t0.5\t0.5\n'.format(i))
+            fh.write('s7\t0.5\tpurple\n')
+        format = ProbabilitiesFormat(filepath, mode='r')
+        # the invalid record is beyond the first five records
+        format.validate(level='min')
+        with self.assertRaisesRegex(ValidationError, r"'0\.5'.*line 9"):
+            format.validate()
+
+    def test_Predictions_and_boolean_format_validate_line_number(self):
+        filepath = os.path.join(self.temp_dir.name, 'predictions.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write('id\tprediction\n'
+                     's0\tTrue\ns1\tFalse\ns2\tTrue\tFalse\ns3\tTrue\n')
+        with self.assertRaisesRegex(ValidationError, 'at line 4'):
+            PredictionsFormat(filepath, mode='r').validate()
+        with self.assertRaisesRegex(ValidationError, 'at line 4'):
+            BooleanSeriesFormat(filepath, mode='r').validate()
+        with open(filepath, 'w') as fh:
+            fh.write('id\tprediction\ns0\tTrue\ns1\tmaybe\n')
+        with self.assertRaisesRegex(ValidationError, 'maybe at line 3'):
+            BooleanSeriesFormat(filepath, mode='r').validate()
+
     def test_Probabilities_dir_fmt_validate_positive(self):
         filepath = self.get_data_path('class_probabilities.tsv')
         shutil.copy(filepath, self.temp_dir.name)
@@ -337,6 +372,124 @@ class TestSemanticTypes(SampleClassifierTestPluginBase):
                            index=exp_index)
         pdt.assert_frame_equal(obs.to_dataframe(), exp)
 
+    def test_Probabilities_format_to_pd_dataframe_nans(self):
+        transformer = self.get_transformer(pd.DataFrame, ProbabilitiesFormat)
+        exp = pd.DataFrame([[0.1, np.nan], [0.8, 0.4]],
+                           columns=['classA', 'classB'],
+                           index=pd.Index(['a', 'b'], name='id'))
+        obs = self.get_transformer(ProbabilitiesFormat, pd.DataFrame)(
+            transformer(exp))
+        pdt.assert_frame_equal(exp, obs)
+
+    def test_Probabilities_format_to_pd_dataframe_nonnumeric(self):
+        fp = os.path.join(self.temp_dir.name, 'class_probabilities.tsv')
+        with open(fp, 'w') as fh:
+            fh.write('id\tclassA\ns1\t0.5\ns2\tfoo\n')
+        transformer = self.get_transformer(ProbabilitiesFormat, pd.DataFrame)
+        with self.assertRaisesRegex(ValueError, 'Unable to parse string'):
+            transformer(ProbabilitiesFormat(fp, mode='r'))
+
+    # test npz tables
+    def test_Probabilities_npz_dir_fmt_round_trip(self):
+        exp = pd.DataFrame([[0.1, np.nan], [0.8, 0.4]],
+                           columns=['classA', 'classB'],
+                           index=pd.Index(['a', 'b'], name='id'))
+        dirfmt = self.get_transformer(
+            pd.DataFrame, ProbabilitiesDirectoryFormat)(exp)
+        self.assertTrue((dirfmt.path / 'class_probabilities.npz').exists())
+        self.assertFalse((dirfmt.path / 'class_probabilities.tsv').exists())
+        dirfmt.validate()
+        obs = self.get_transformer(
+            ProbabilitiesDirectoryFormat, pd.DataFrame)(dirfmt)
+        pdt.assert_frame_equal(exp, obs)
+
+        # export as TSV
+        ff = self.get_transformer(
+            ProbabilitiesDirectoryFormat, ProbabilitiesFormat)(dirfmt)
+        ff.validate()
+        obs = self.get_transformer(ProbabilitiesFormat, pd.DataFrame)(ff)
+        pdt.assert_frame_equal(exp, obs)
+
+    def test_Probabilities_tsv_dir_fmt_to_pd_dataframe(self):
+        filepath = self.get_data_path('class_probabilities.tsv')
+        shutil.copy(filepath, self.temp_dir.name)
+        dirfmt = ProbabilitiesDirectoryFormat(self.temp_dir.name, mode='r')
+        obs = self.get_transformer(
+            ProbabilitiesDirectoryFormat, pd.DataFrame)(dirfmt)
+        _, exp = self.transform_format(
+            ProbabilitiesFormat, pd.DataFrame, 'class_probabilities.tsv')
+        pdt.assert_frame_equal(exp, obs)
+
+    def test_Probabilities_dir_fmt_validate_negative_both_tables(self):
+        filepath = self.get_data_path('class_probabilities.tsv')
+        shutil.copy(filepath, self.temp_dir.name)
+        with open(os.path.join(
+                self.temp_dir.name, 'class_probabilities.npz'), 'wb') as fh:
+            np.savez(fh, index=np.array(['s1']), columns=np.array(['A']),
+                     data=np.ones((1, 1)))
+        format = ProbabilitiesDirectoryFormat(self.temp_dir.name, mode='r')
+        with self.assertRaisesRegex(ValidationError, 'exactly one'):
+            format.validate()
+
+    def test_Importance_npz_format_to_metadata(self):
+        exp = pd.DataFrame([0.5, 0.25, 0.25], columns=['importance'],
+                           index=pd.Index(['f1', 'f2', 'f3'], name='id'))
+        ff = self.get_transformer(pd.DataFrame, ImportanceNPZFormat)(exp)
+        ff.validate()
+        obs = self.get_transformer(ImportanceNPZFormat, qiime2.Metadata)(ff)
+        pdt.assert_frame_equal(obs.to_dataframe(), exp)
+
+    def test_npz_format_validate_negative(self):
+        format = ImportanceNPZFormat(
+            self.get_data_path('garbage.txt'), mode='r')
+        with self.assertRaisesRegex(ValidationError, 'not an npz file'):
+            format.validate()
+
+        fp = os.path.join(self.temp_dir.name, 'importance.npz')
+        with open(fp, 'wb') as fh:
+            np.savez(fh, index=np.array(['f1', 'f2']),
+                     columns=np.array(['importance']), data=np.ones((1, 1)))
+        format = ImportanceNPZFormat(fp, mode='r')
+        format.validate(level='min')
+        with self.assertRaisesRegex(ValidationError, 'shape'):
+            format.validate()
+
+    # test QueryDistances format
+    def test_QueryDistances_format_validate_positive(self):
+        filepath = self.get_data_path('query_distances.tsv')
+        format = QueryDistancesFormat(filepath, mode='r')
+        format.validate(level='min')
+        format.validate()
+
+    def test_QueryDistances_format_validate_negative_nonnumeric(self):
+        filepath = self.get_data_path('chardonnay.map.txt')
+        format = QueryDistancesFormat(filepath, mode='r')
+        with self.assertRaisesRegex(ValidationError, 'numeric values'):
+            format.validate()
+
+    def test_QueryDistances_dir_fmt_validate_positive(self):
+        filepath = self.get_data_path('query_distances.tsv')
+        shutil.copy(filepath, self.temp_dir.name)
+        format = QueryDistancesDirectoryFormat(self.temp_dir.name, mode='r')
+        format.validate()
+
+    def test_QueryDistances_semantic_type_registration(self):
+        self.assertRegisteredSemanticType(QueryDistances)
+
+    def test_sample_data_QueryDistances_to_dir_fmt_registration(self):
+        self.assertSemanticTypeRegisteredToFormat(
+            SampleData[QueryDistances], QueryDistancesDirectoryFormat)
+
+    def test_QueryDistances_format_to_pd_dataframe(self):
+        _, obs = self.transform_format(
+            QueryDistancesFormat, pd.DataFrame, 'query_distances.tsv')
+        exp = pd.DataFrame([[0.1, 0.9, 0.8, 0.7],
+                            [0.85, 0.2, 0.15, 0.9],
+                            [0.5, 0.45, 0.6, 0.05]],
+                           columns=['r1', 'r2', 'r3', 'r4'],
+                           index=pd.Index(['q1', 'q2', 'q3'], name='id'))
+        pdt.assert_frame_equal(exp, obs)
+
     # test utility formats
     def test_pickle_format_validate_negative(self):
         filepath = self.get_data_path('coordinates.tsv')
@@ -383,6 +536,18 @@ class TestFormats(SampleEstimatorTestBase):
         # Should not error
         format.validate()
 
+    def test_sample_classifier_dir_fmt_both_layouts(self):
+        self._legacy_setup(sklearn.__version__)
+        format = self._custom_setup(sklearn.__version__)
+        with self.assertRaisesRegex(ValidationError, 'exactly one'):
+            format.validate()
+
+    def test_joblib_format_validate_negative(self):
+        filepath = self.get_data_path('coordinates.tsv')
+        format = JoblibFormat(filepath, mode='r')
+        with self.assertRaisesRegex(ValidationError, 'not a joblib file'):
+            format.validate()
+
 
 class TestTransformers(SampleEstimatorTestBase):
     def test_old_sklearn_version(self):
@@ -401,23 +566,218 @@ class TestTransformers(SampleEstimatorTestBase):
 
         self.assertTrue(obs)
 
+    def test_legacy_tar_dir_fmt_to_pipeline(self):
+        input = self._legacy_setup(sklearn.__version__)
+        input.validate()
+
+        transformer = self.get_transformer(
+            SampleEstimatorDirFmt, Pipeline)
+        obs = transformer(input)
+
+        self.assertEqual(list(obs.named_steps), ['dv', 'est'])
+        pdt.assert_series_equal(
+            pd.Series(obs.named_steps['est'].feature_importances_),
+            pd.Series(self.pipeline.named_steps['est'].feature_importances_))
+
     def test_taxo_class_result_to_taxo_class_dir_fmt(self):
-        def read_pipeline(pipeline_filepath):
-            with tarfile.open(pipeline_filepath) as tar:
-                dirname = tempfile.mkdtemp()
-                tar.extractall(dirname)
-                pipeline = joblib.load(os.path.join(dirname,
-                                       'sklearn_pipeline.pkl'))
-                for fn in tar.getnames():
-                    os.unlink(os.path.join(dirname, fn))
-                os.rmdir(dirname)
-            return pipeline
-
-        exp = read_pipeline(self.sklearn_pipeline)
+        exp = joblib.load(self.sklearn_pipeline)
         transformer = self.get_transformer(
             Pipeline, SampleEstimatorDirFmt)
         obs = transformer(exp)
-        sklearn_pipeline = obs.sklearn_pipeline.view(PickleFormat)
-        obs_pipeline = read_pipeline(str(sklearn_pipeline))
+        self.assertFalse((obs.path / 'sklearn_pipeline.tar').exists())
+        obs_pipeline = joblib.load(
+            str(obs.path / 'sklearn_pipeline.joblib'))
         obs = obs_pipeline
         self.assertTrue(obs)
+
+    def test_compressed_pipeline_round_trip(self):
+        exp = joblib.load(self.sklearn_pipeline)
+        set_save_options(exp, compress=3)
+        obs = self.get_transformer(Pipeline, SampleEstimatorDirFmt)(exp)
+        obs.validate()
+        with open(str(obs.path / 'sklearn_pipeline.joblib'), 'rb') as fh:
+            self.assertEqual(fh.read(1), b'\x78')
+        obs = self.get_transformer(SampleEstimatorDirFmt, Pipeline)(obs)
+        pdt.assert_series_equal(
+            pd.Series(obs.named_steps['est'].feature_importances_),
+            pd.Series(exp.named_steps['est'].feature_importances_))
+        # save options are not set on either pipeline
+        for pipeline in (exp, obs):
+            self.assertFalse(hasattr(pipeline, 'compress'))
+            self.assertFalse(hasattr(pipeline, 'joblib_compress'))
+
+    def test_uncompressed_pipeline_is_memory_mapped(self):
+        features = SparseFeatureMatrix(
+            csr_matrix(np.random.RandomState(0).rand(20, 3)),
+            np.array(['a', 'b', 'c'], dtype=object))
+        targets = np.array(['x', 'y'] * 10)
+        exp = Pipeline([('dv', SparseFeatureVectorizer()),
+                        ('est', LinearSVC(random_state=0))])
+        exp.fit(features, targets)
+        dirfmt = self.get_transformer(Pipeline, SampleEstimatorDirFmt)(exp)
+        obs = self.get_transformer(SampleEstimatorDirFmt, Pipeline)(dirfmt)
+        self.assertIsInstance(obs.named_steps['est'].coef_, np.memmap)
+        np.testing.assert_array_equal(
+            obs.predict(features), exp.predict(features))
+
+        # compressed files are loaded onto the heap
+        set_save_options(exp, compress=3)
+        dirfmt = self.get_transformer(Pipeline, SampleEstimatorDirFmt)(exp)
+        obs = self.get_transformer(SampleEstimatorDirFmt, Pipeline)(dirfmt)
+        self.assertNotIsInstance(obs.named_steps['est'].coef_, np.memmap)
+
+    def test_uncompressed_forest_is_partly_memory_mapped(self):
+        exp = joblib.load(self.sklearn_pipeline)
+        dirfmt = self.get_transformer(Pipeline, SampleEstimatorDirFmt)(exp)
+        self.assertTrue((dirfmt.path / 'sklearn_pipeline.joblib').exists())
+        obs = self.get_transformer(SampleEstimatorDirFmt, Pipeline)(dirfmt)
+        est = obs.named_steps['est']
+        self.assertIsInstance(est.classes_, np.memmap)
+        # Tree.__setstate__ copies the node arrays onto the heap
+        for tree in est.estimators_:
+            self.assertNotIsInstance(tree.tree_.value, np.memmap)
+            self.assertNotIsInstance(tree.tree_.value.base, np.memmap)
+            self.assertNotIsInstance(tree.tree_.feature, np.memmap)
+        pdt.assert_series_equal(
+            pd.Series(est.feature_importances_),
+            pd.Series(exp.named_steps['est'].feature_importances_))
+
+    def test_tree_ensemble_round_trip(self):
+        exp = joblib.load(self.sklearn_pipeline)
+        set_save_options(exp, estimator_format='tree-arrays')
+        dirfmt = self.get_transformer(Pipeline, SampleEstimatorDirFmt)(exp)
+        dirfmt.validate()
+        self.assertFalse((dirfmt.path / 'sklearn_pipeline.joblib').exists())
+
+        # tree arrays are loaded regardless of the scikit-learn version
+        with open(str(dirfmt.path / 'sklearn_version.json'), 'w') as fh:
+            fh.write(json.dumps({'sklearn-version': 'a very old version'}))
+        obs = self.get_transformer(SampleEstimatorDirFmt, Pipeline)(dirfmt)
+        self.assertIsInstance(obs.named_steps['est'], TreeEnsembleClassifier)
+        self.assertEqual(obs.named_steps['dv'].feature_names_,
+                         exp.named_steps['dv'].feature_names_)
+        pdt.assert_series_equal(obs.rfe_scores, exp.rfe_scores)
+        np.testing.assert_array_equal(
+            obs.named_steps['est'].feature_importances_,
+            exp.named_steps['est'].feature_importances_)
+        self.assertEqual(obs.get_params()['est__n_estimators'], 2)
+
+    def test_tree_ensemble_adaboost_samme_round_trip(self):
+        rng = np.random.RandomState(0)
+        features = rng.rand(60, 5)
+        features[features < 0.5] = 0
+        features = SparseFeatureMatrix(
+            csr_matrix(features), np.array(list('abcde'), dtype=object))
+        # the algorithm parameter was removed with SAMME.R
+        params = {'algorithm': 'SAMME'} if \
+            'algorithm' in AdaBoostClassifier().get_params() else {}
+        for n_classes in (2, 4):
+            targets = np.arange(60) % n_classes
+            exp = Pipeline([('dv', SparseFeatureVectorizer()),
+                            ('est', AdaBoostClassifier(
+                                DecisionTreeClassifier(max_depth=2),
+                                n_estimators=10, random_state=0,
+                                **params))])
+            exp.fit(features, targets)
+            set_save_options(exp, estimator_format='tree-arrays')
+            dirfmt = self.get_transformer(
+                Pipeline, SampleEstimatorDirFmt)(exp)
+            obs = self.get_transformer(SampleEstimatorDirFmt, Pipeline)(dirfmt)
+            np.testing.assert_allclose(
+                obs.predict_proba(features), exp.predict_proba(features),
+                atol=1e-6)
+            np.testing.assert_array_equal(
+                obs.predict(features), exp.predict(features))
+
+    def test_tree_ensemble_is_memory_mapped(self):
+        exp = joblib.load(self.sklearn_pipeline)
+        set_save_options(exp, estimator_format='tree-arrays')
+        dirfmt = self.get_transformer(Pipeline, SampleEstimatorDirFmt)(exp)
+        obs = self.get_transformer(SampleEstimatorDirFmt, Pipeline)(dirfmt)
+        for array in obs.named_steps['est'].arrays_.values():
+            self.assertIsInstance(array, np.memmap)
+
+        # compressed tree arrays are loaded onto the heap
+        set_save_options(exp, compress=3)
+        dirfmt = self.get_transformer(Pipeline, SampleEstimatorDirFmt)(exp)
+        obs = self.get_transformer(SampleEstimatorDirFmt, Pipeline)(dirfmt)
+        for array in obs.named_steps['est'].arrays_.values():
+            self.assertNotIsInstance(array, np.memmap)
+        np.testing.assert_array_equal(
+            obs.named_steps['est'].feature_importances_,
+            exp.named_steps['est'].feature_importances_)
+
+    def test_model_index(self):
+        transformer = self.get_transformer(SampleEstimatorDirFmt, ModelIndex)
+        obs = transformer(self._sklp)
+        est = self.pipeline.named_steps['est']
+        feature_names = self.pipeline.named_steps['dv'].feature_names_
+        self.assertEqual(obs['estimator'], 'RandomForestClassifier')
+        self.assertEqual(obs['classes'], est.classes_.tolist())
+        self.assertEqual(obs['feature_names'], feature_names)
+        self.assertEqual(obs['training_shape'][1], len(feature_names))
+        self.assertEqual(obs.parameters['est__n_estimators'], 2)
+        pdt.assert_series_equal(obs.rfe_scores, self.pipeline.rfe_scores,
+                                check_index_type=False)
+        # the index is read without loading the model
+        self.assertEqual(len(estimator_cache), 0)
+
+        # artifacts without an index are summarized from the model
+        input = self._custom_setup(sklearn.__version__)
+        self.assertEqual(transformer(input), obs)
+
+    def test_estimator_cache(self):
+        self.addCleanup(estimator_cache.configure)
+        transformer = self.get_transformer(SampleEstimatorDirFmt, Pipeline)
+
+        def trees(pipeline):
+            return pipeline.named_steps['est'].estimators_
+
+        obs = transformer(self._sklp)
+        self.assertIs(trees(transformer(self._sklp)), trees(obs))
+        self.assertEqual(len(estimator_cache), 1)
+        self.assertGreater(estimator_cache.nbytes, 0)
+
+        # a copy of the model elsewhere is cached separately
+        input = self._custom_setup(sklearn.__version__)
+        self.assertIsNot(trees(transformer(input)), trees(obs))
+        self.assertEqual(len(estimator_cache), 2)
+
+        # a different model is cached separately
+        exp = joblib.load(self.sklearn_pipeline)
+        set_save_options(exp, compress=3)
+        dirfmt = self.get_transformer(Pipeline, SampleEstimatorDirFmt)(exp)
+        compressed = transformer(dirfmt)
+        self.assertIsNot(trees(compressed), trees(obs))
+        self.assertEqual(len(estimator_cache), 3)
+
+        # least recently used pipelines are evicted first
+        estimator_cache.configure(max_entries=1)
+        self.assertEqual(len(estimator_cache), 1)
+        self.assertIs(trees(transformer(dirfmt)), trees(compressed))
+        self.assertIsNot(trees(transformer(self._sklp)), trees(obs))
+
+        # pipelines larger than max_bytes are not cached
+        estimator_cache.configure(max_bytes=1)
+        self.assertEqual(len(estimator_cache), 0)
+        self.assertIsNot(trees(transformer(self._sklp)),
+                         trees(transformer(self._sklp)))
+
+        # max_entries=0 disables caching
+        estimator_cache.configure(max_entries=0)
+        self.assertIsNot(trees(transformer(self._sklp)),
+                         trees(transformer(self._sklp)))
+
+    def test_estimator_cache_views_are_independent(self):
+        self.addCleanup(estimator_cache.clear)
+        transformer = self.get_transformer(SampleEstimatorDirFmt, Pipeline)
+        obs = transformer(self._sklp)
+        obs.set_params(est__n_jobs=3)
+        obs.steps[0] = ('dv', None)
+
+        exp = transformer(self._sklp)
+        self.assertIsNot(exp, obs)
+        self.assertIs(exp.named_steps['est'].estimators_,
+                      obs.named_steps['est'].estimators_)
+        self.assertNotEqual(exp.named_steps['est'].n_jobs, 3)
+        self.assertIsNotNone(exp.named_steps['dv'])
@@ -5,21 +5,24 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import os
 import pandas as pd
 import biom
 import numpy as np
 from sklearn.svm import LinearSVC
-from sklearn.feature_extraction import DictVectorizer
 from sklearn.pipeline import Pipeline
 from sklearn.ensemble import RandomForestClassifier
 import pandas.util.testing as pdt
 
 import qiime2
+from skbio.stats.distance import DistanceMatrixError
 
 from q2_sample_classifier.utilities import (
     _load_data, _calculate_feature_importances, _extract_important_features,
     _disable_feature_selection, _mean_feature_importance,
-    _null_feature_importance, _extract_features)
+    _null_feature_importance, _extract_features, SparseFeatureVectorizer,
+    _collect_cv_predictions, _tuned_parameters_key, _parallel_budget,
+    _loo_knn_predict, _loo_knn_sweep, _lsmat_to_memmap)
 from q2_sample_classifier.tests.test_base_class import \
     SampleClassifierTestPluginBase
 
@@ -67,7 +70,7 @@ class UtilitiesTests(SampleClassifierTestPluginBase):
     # test feature importance calculation with main classifier types
     def test_calculate_feature_importances_ensemble(self):
         estimator = Pipeline(
-            [('dv', DictVectorizer()),
+            [('dv', SparseFeatureVectorizer()),
              ('est', RandomForestClassifier(n_estimators=10))])
         estimator.fit(_extract_features(self.features),
                       self.targets.values.ravel())
@@ -76,7 +79,7 @@ class UtilitiesTests(SampleClassifierTestPluginBase):
 
     def test_calculate_feature_importances_svm(self):
         estimator = Pipeline(
-            [('dv', DictVectorizer()), ('est', LinearSVC())])
+            [('dv', SparseFeatureVectorizer()), ('est', LinearSVC())])
         estimator.fit(_extract_features(self.features),
                       self.targets.values.ravel())
         fi = _calculate_feature_importances(estimator)
@@ -148,7 +151,120 @@ class UtilitiesTests(SampleClassifierTestPluginBase):
         # test that merge of tables is inner merge
         intersection = set(('peanut', 'bugs', 'pandas'))
         feature_data, targets = _load_data(a, b, missing_samples='ignore')
-        exp = [{'c': 1.0, 'a': 1.0, 'b': 1.0}, {'c': 1.0, 'a': 1.0, 'b': 1.0},
-               {'c': 1.0, 'a': 1.0, 'b': 1.0}]
-        np.testing.assert_array_equal(feature_data, exp)
+        np.testing.assert_array_equal(
+            feature_data.matrix.toarray(), np.ones((3, 3)))
+        np.testing.assert_array_equal(
+            feature_data.feature_ids, ['a', 'b', 'c'])
         self.assertEqual(set(targets.index), intersection)
+
+    # rows follow fold order; classes missing from a fold's estimator are NaN
+    def test_collect_cv_predictions(self):
+        index = pd.Index(['s0', 's1', 's2', 's3'])
+        folds = [(None, np.array([1, 3])), (None, np.array([0, 2]))]
+        preds = [np.array(['b', 'a']), np.array(['aa', 'b'])]
+        probs = [(np.array([[0.2, 0.8], [0.9, 0.1]]), pd.Index(['a', 'b'])),
+                 (np.array([[1.0], [0.0]]), pd.Index(['b']))]
+        predictions, probabilities = _collect_cv_predictions(
+            index, folds, preds, probs)
+        exp_index = pd.Index(['s1', 's3', 's0', 's2'], name='SampleID')
+        pdt.assert_frame_equal(predictions, pd.DataFrame(
+            ['b', 'a', 'aa', 'b'], index=exp_index, columns=['prediction']))
+        pdt.assert_frame_equal(probabilities, pd.DataFrame(
+            [[0.2, 0.8], [0.9, 0.1], [np.nan, 1.0], [np.nan, 0.0]],
+            index=exp_index, columns=['a', 'b']))
+
+    def test_tuned_parameters_key(self):
+        estimator = Pipeline(
+            [('dv', SparseFeatureVectorizer()),
+             ('est', RandomForestClassifier(
+                 max_depth=np.int64(4), max_features=None))])
+        obs = _tuned_parameters_key(
+            estimator, ['est__max_features', 'est__max_depth'])
+        self.assertEqual(
+            obs, '{"est__max_depth": 4, "est__max_features": null}')
+
+    def test_parallel_budget(self):
+        # search workers are served before the estimator
+        obs = _parallel_budget(32, search=100)
+        self.assertEqual(obs, {'n_jobs': 32, 'folds': 1, 'search': 32,
+                               'estimator': 1, 'blas_threads': 1})
+        # outer folds first; the product of all levels stays within n_jobs
+        obs = _parallel_budget(32, folds=5, search=100)
+        self.assertEqual((obs['folds'], obs['search'], obs['estimator']),
+                         (5, 6, 1))
+        # without inner parallelism, the estimator gets the remainder
+        obs = _parallel_budget(8, folds=3)
+        self.assertEqual((obs['folds'], obs['search'], obs['estimator']),
+                         (3, 1, 2))
+        self.assertEqual(obs['blas_threads'], 2)
+
+    # each sample is excluded from its own neighbors; vote ties go to the
+    # label of the nearest tied neighbor, and k is capped at n - 1
+    def test_loo_knn_predict(self):
+        distances = np.array([[0, 1, 2, 4],
+                              [1, 0, 3, 3],
+                              [2, 3, 0, 1],
+                              [4, 3, 1, 0]], dtype=float)
+        labels = np.array(['a', 'b', 'b', 'a'], dtype=object)
+        obs = _loo_knn_predict(distances, labels, 1)
+        np.testing.assert_array_equal(obs, ['b', 'a', 'a', 'b'])
+        obs = _loo_knn_predict(distances, labels, 2, block_size=3)
+        np.testing.assert_array_equal(obs, ['b', 'a', 'a', 'b'])
+        obs = _loo_knn_predict(distances, labels, 10, block_size=1)
+        np.testing.assert_array_equal(obs, ['b', 'a', 'a', 'b'])
+
+    # every k votes over a prefix of one neighbor ordering; the most
+    # accurate k wins, and samples without a label are not scored
+    def test_loo_knn_sweep(self):
+        distances = np.array([[0, 1, 2, 3, 4],
+                              [1, 0, 5, 5, 5],
+                              [2, 5, 0, 1, 6],
+                              [3, 5, 1, 0, 1],
+                              [4, 5, 6, 1, 0]], dtype=float)
+        labels = np.array(['a', 'a', 'b', 'b', np.nan], dtype=object)
+        predictions, accuracy = _loo_knn_sweep(
+            distances, labels, [4, 1, 3], block_size=2)
+        pdt.assert_series_equal(accuracy, pd.Series(
+            [1.0, 0.25, 0.0], index=pd.Index([1, 3, 4], name='k'),
+            name='Accuracy'))
+        np.testing.assert_array_equal(
+            predictions, _loo_knn_predict(distances, labels, 1))
+
+    def _write_lsmat(self, distances):
+        ids = ['s{0}'.format(i) for i in range(len(distances))]
+        fp = os.path.join(self.temp_dir.name, 'distances.tsv')
+        pd.DataFrame(distances, index=ids, columns=ids).to_csv(fp, sep='\t')
+        return fp
+
+    def test_lsmat_to_memmap(self):
+        distances = np.array([[0, 1, 2, 3],
+                              [1, 0, 5, 5],
+                              [2, 5, 0, 1],
+                              [3, 5, 1, 0]], dtype=float)
+        fp = self._write_lsmat(distances)
+        for block_size in (1, 3, 1000):
+            ids, obs = _lsmat_to_memmap(fp, os.path.join(
+                self.temp_dir.name, 'distances.npy'), block_size)
+            self.assertEqual(ids, ['s0', 's1', 's2', 's3'])
+            np.testing.assert_array_equal(obs, distances)
+            del obs
+
+    # malformed matrices are rejected, as skbio.DistanceMatrix rejects them
+    def test_lsmat_to_memmap_not_symmetric(self):
+        distances = np.array([[0, 1, 2],
+                              [1, 0, 5],
+                              [2, 4, 0]], dtype=float)
+        fp = self._write_lsmat(distances)
+        for block_size in (1, 2, 1000):
+            with self.assertRaisesRegex(DistanceMatrixError, 'symmetric'):
+                _lsmat_to_memmap(fp, os.path.join(
+                    self.temp_dir.name, 'distances.npy'), block_size)
+
+    def test_lsmat_to_memmap_not_hollow(self):
+        distances = np.array([[0, 1, 2],
+                              [1, 0, 5],
+                              [2, 5, 1]], dtype=float)
+        fp = self._write_lsmat(distances)
+        with self.assertRaisesRegex(DistanceMatrixError, 'hollow'):
+            _lsmat_to_memmap(fp, os.path.join(
+                self.temp_dir.name, 'distances.npy'), 2)
@@ -6,6 +6,7 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 import pandas as pd
+import numpy as np
 import pandas.util.testing as pdt
 from os import mkdir, listdir
 from os.path import join
@@ -16,9 +17,10 @@ from qiime2.plugins import sample_classifier
 
 from q2_sample_classifier.visuals import (
     _linear_regress, _calculate_baseline_accuracy,
-    _add_sample_size_to_xtick_labels)
+    _add_sample_size_to_xtick_labels, _confusion_counts,
+    _plot_confusion_matrix)
 from q2_sample_classifier.classify import (
-    scatterplot, confusion_matrix)
+    scatterplot, confusion_matrix, knn_accuracy)
 from q2_sample_classifier.utilities import (
     _match_series_or_die, _predict_and_plot)
 from q2_sample_classifier.tests.test_base_class import \
@@ -110,6 +112,31 @@ class TestPlottingVisualizers(SampleClassifierTestPluginBase):
         b = qiime2.CategoricalMetadataColumn(self.a)
         confusion_matrix(self.tmpd, self.a, b)
 
+    def test_confusion_matrix_svg(self):
+        b = qiime2.CategoricalMetadataColumn(self.a)
+        confusion_matrix(self.tmpd, self.a, b, figure_format='svg')
+        files = listdir(self.tmpd)
+        self.assertIn('predictions.svg', files)
+        self.assertNotIn('predictions.png', files)
+        with open(join(self.tmpd, 'index.html')) as fh:
+            self.assertIn('<img src="predictions.svg">', fh.read())
+
+    def test_confusion_matrix_parallel_figures(self):
+        b = qiime2.CategoricalMetadataColumn(self.a)
+        confusion_matrix(self.tmpd, self.a, b, n_jobs=2)
+        files = listdir(self.tmpd)
+        self.assertIn('predictions.png', files)
+        self.assertIn('predictions.pdf', files)
+
+    def test_knn_accuracy(self):
+        accuracy = pd.DataFrame({'Accuracy': [0.5, 0.75, 0.75]},
+                                index=pd.Index(['1', '3', '5'], name='id'))
+        knn_accuracy(self.tmpd, qiime2.Metadata(accuracy))
+        with open(join(self.tmpd, 'index.html')) as fh:
+            html = fh.read()
+        self.assertIn('Leave-one-out accuracy by k', html)
+        self.assertIn('0.75', html)
+
     def test_confusion_matrix_class_overlap_error(self):
         b = pd.Series([1, 2, 3, 4, 5, 6], name='site',
                       index=['a1', 'a2', 'b1', 'b2', 'c1', 'c2'])
@@ -225,6 +252,30 @@ class TestPlottingVisualizers(SampleClassifierTestPluginBase):
         exp = ['0 (n=0)', 'a (n=2)', 'b (n=2)', 'bb (n=0)', 'c (n=2)']
         self.assertListEqual(labels, exp)
 
+    def test_confusion_counts(self):
+        b = pd.Series(['a', 'c', 'b', 'b', 'a', 'd'], name='site',
+                      index=['a1', 'a2', 'b1', 'b2', 'c1', 'c2'])
+        counts = _confusion_counts(self.a, b, ['a', 'b', 'c', 'd'])
+        exp = np.array([[1, 0, 1, 0], [0, 2, 0, 0], [1, 0, 0, 1],
+                        [0, 0, 0, 0]])
+        np.testing.assert_array_equal(counts, exp)
+
+    # the heatmap of a matrix with more than max_classes classes shows blocks
+    # of classes, but the returned matrix is exact
+    def test_plot_confusion_matrix_blocks(self):
+        b = pd.Series(['a', 'c', 'b', 'b', 'a', 'c'], name='site',
+                      index=['a1', 'a2', 'b1', 'b2', 'c1', 'c2'])
+        predictions, confusion = _plot_confusion_matrix(
+            self.a, b, ['a', 'b', 'c'], normalize=True, palette='sirocco',
+            max_classes=2)
+        exp, _ = _plot_confusion_matrix(
+            self.a, b, ['a', 'b', 'c'], normalize=True, palette='sirocco')
+        pdt.assert_frame_equal(exp, predictions)
+        labels = [t.get_text() for t in confusion.get_xticklabels()]
+        self.assertListEqual(labels, ['a - b (n=4)', 'c (n=2)'])
+        labels = [t.get_text() for t in confusion.get_yticklabels()]
+        self.assertListEqual(labels, ['a - b (n=4)', 'c (n=2)'])
+
     def test_match_series_or_die(self):
         exp = pd.Series(['a', 'b', 'c'], name='site', index=['a1', 'b2', 'c2'])
         exp.index.name = 'SampleID'
@@ -6,40 +6,47 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import json
+import uuid
 import warnings
+from collections import Counter
 from os.path import join
 
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
 from sklearn.model_selection import (
-    train_test_split, RandomizedSearchCV, KFold, StratifiedKFold)
-from sklearn.metrics import accuracy_score
-from sklearn.feature_selection import RFECV
-from sklearn.feature_extraction import DictVectorizer
-from sklearn.ensemble import (RandomForestRegressor, RandomForestClassifier,
-                              ExtraTreesClassifier, ExtraTreesRegressor,
-                              AdaBoostClassifier, GradientBoostingClassifier,
-                              AdaBoostRegressor, GradientBoostingRegressor)
-from sklearn.svm import LinearSVC, SVR, SVC
-from sklearn.linear_model import Ridge, Lasso, ElasticNet
-from sklearn.neighbors import KNeighborsClassifier, KNeighborsRegressor
-from sklearn.tree import DecisionTreeClassifier, DecisionTreeRegressor
+    train_test_split, RandomizedSearchCV, HalvingRandomSearchCV, KFold,
+    StratifiedKFold, check_cv)
+from sklearn.metrics import accuracy_score, check_scoring
 from sklearn.pipeline import Pipeline
+from sklearn.base import BaseEstimator, TransformerMixin, clone, is_classifier
 
-import q2templates
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import pkg_resources
-from scipy.sparse import issparse
+from scipy.sparse import issparse, csr_matrix
 from scipy.stats import randint
 import biom
+from joblib import Parallel, delayed, effective_n_jobs
+from threadpoolctl import threadpool_limits
+from skbio.stats.distance import (
+    DissimilarityMatrixError, DistanceMatrixError)
 
 from .visuals import (_linear_regress, _plot_confusion_matrix, _plot_RFE,
                       _regplot_from_dataframe, _generate_roc_plots)
+from ._model_index import ModelIndex, model_index
+from ._save_options import set_save_options
+
+# The estimators, RFECV, q2templates, matplotlib and pkg_resources are slow
+# to import, so they are imported by the functions that use them rather than
+# whenever the plugin is loaded (e.g., by every qiime CLI command).
 
 _classifiers = ['RandomForestClassifier', 'ExtraTreesClassifier',
                 'GradientBoostingClassifier', 'AdaBoostClassifier',
                 'KNeighborsClassifier', 'LinearSVC', 'SVC']
 
+# bagged ensembles that can be evaluated from out-of-bag predictions
+_oob_estimators = ['RandomForestClassifier', 'ExtraTreesClassifier',
+                   'RandomForestRegressor', 'ExtraTreesRegressor']
+
 parameters = {
     'ensemble': {"max_depth": [4, 8, 16, None],
                  "max_features": [None, 'sqrt', 'log2', 0.1],
@@ -72,15 +79,126 @@ parameters = {
 }
 
 
-TEMPLATES = pkg_resources.resource_filename('q2_sample_classifier', 'assets')
+# file extensions written for each figure, by figure_format: a PNG to
+# display and a PDF to download, or an SVG alone, which is drawn once and
+# only rasterized by the browser when it is displayed
+figure_formats = {'png+pdf': ('png', 'pdf'), 'svg': ('svg',)}
+
+
+def _templates():
+    import pkg_resources
+
+    return pkg_resources.resource_filename('q2_sample_classifier', 'assets')
+
+
+class SparseFeatureMatrix:
+    '''Sample x feature CSR matrix labelled with the ids of its features.
+
+    This is the design matrix for a single run: it is built once from the
+    input table and every CV fold, RFECV step and parameter search candidate
+    slices rows of it. Indexing selects rows (samples), so cross-validators
+    and parameter searches can slice it like any other array-like. Row
+    slices share the `coding` token of the matrix they were taken from,
+    which tells SparseFeatureVectorizer that their columns line up with the
+    vocabulary it was fit on.
+    '''
+
+    def __init__(self, matrix, feature_ids, coding=None):
+        self.matrix = csr_matrix(matrix)
+        self.feature_ids = np.asarray(feature_ids, dtype=object)
+        if coding is None:
+            coding = uuid.uuid4().hex
+        self.coding = coding
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def __getitem__(self, rows):
+        return SparseFeatureMatrix(
+            self.matrix[rows], self.feature_ids, self.coding)
+
+    def select_features(self, feature_ids):
+        '''Return a copy restricted to the features in feature_ids.'''
+        keep = np.flatnonzero(pd.Index(self.feature_ids).isin(feature_ids))
+        return SparseFeatureMatrix(
+            self.matrix[:, keep], self.feature_ids[keep])
+
+
+class SparseFeatureVectorizer(TransformerMixin, BaseEstimator):
+    '''Map a SparseFeatureMatrix onto a fixed feature vocabulary.
+
+    This replaces DictVectorizer as the first step of every pipeline. The
+    vocabulary is built the same way (every feature observed in at least one
+    training sample, sorted by name), so the columns of the output matrix
+    match what DictVectorizer would produce. Features that are not in the
+    vocabulary are dropped at transform time.
+
+    Input sharing the coding of the training data is mapped by column
+    position alone; anything else (e.g., a new table at prediction time) is
+    matched on feature ids.
+    '''
+
+    def fit(self, X, y=None):
+        observed = np.unique(X.matrix.indices)
+        names = X.feature_ids[observed]
+        order = np.argsort(names, kind='stable')
+        self.feature_names_ = list(names[order])
+        self.columns_ = observed[order]
+        self.coding_ = X.coding
+        return self
+
+    def transform(self, X):
+        matrix = X.matrix
+        if getattr(self, 'coding_', None) == X.coding:
+            columns = np.full(matrix.shape[1], -1, dtype=np.intp)
+            columns[self.columns_] = np.arange(len(self.columns_))
+        else:
+            # position of each input feature in the vocabulary (-1 if unknown)
+            columns = pd.Index(self.feature_names_).get_indexer(X.feature_ids)
+        columns = columns[matrix.indices]
+        keep = columns >= 0
+        kept = np.concatenate(([0], np.cumsum(keep)))
+        result = csr_matrix(
+            (matrix.data[keep], columns[keep], kept[matrix.indptr]),
+            shape=(matrix.shape[0], len(self.feature_names_)),
+            dtype=np.float64)
+        result.sort_indices()
+        return result
+
+    def get_feature_names(self):
+        return list(self.feature_names_)
+
+    def __getstate__(self):
+        # column positions are only meaningful within the run that fit them
+        state = dict(super().__getstate__() or {})
+        state.pop('columns_', None)
+        state.pop('coding_', None)
+        return state
 
 
 def _extract_features(feature_data):
     ids = feature_data.ids('observation')
-    features = np.empty(feature_data.shape[1], dtype=dict)
-    for i, row in enumerate(feature_data.matrix_data.T):
-        features[i] = {ids[ix]: d for ix, d in zip(row.indices, row.data)}
-    return features
+    # sort features once, so that per-fold vocabularies are column subsets
+    order = np.argsort(ids, kind='stable')
+    return SparseFeatureMatrix(
+        feature_data.matrix_data.T.tocsr()[:, order], ids[order])
+
+
+def _upgrade_legacy_vectorizer(estimator):
+    '''Pipelines trained by earlier releases vectorize features with a
+    DictVectorizer; swap it for the equivalent SparseFeatureVectorizer.'''
+    from sklearn.feature_extraction import DictVectorizer
+
+    dv = estimator.named_steps.dv
+    if isinstance(dv, DictVectorizer):
+        vectorizer = SparseFeatureVectorizer()
+        vectorizer.feature_names_ = list(dv.feature_names_)
+        estimator.steps[0] = ('dv', vectorizer)
+    return estimator
 
 
 def _load_data(feature_data, targets_metadata, missing_samples, extract=True):
@@ -209,8 +327,8 @@ def _rfecv_feature_selection(feature_data, targets, estimator,
     __________
     Parameters
     __________
-    feature_data: list of dicts
-        Training set feature data x samples.
+    feature_data: SparseFeatureMatrix
+        Training set samples x feature data.
     targets: pandas.DataFrame
         Training set target value data x samples.
     cv: int
@@ -234,6 +352,7 @@ def _rfecv_feature_selection(feature_data, targets, estimator,
     importance: pandas.DataFrame
         List of top features.
     '''
+    from sklearn.feature_selection import RFECV
 
     rfecv = Pipeline(
         [('dv', estimator.named_steps.dv),
@@ -267,13 +386,84 @@ def _extract_rfe_scores(rfecv):
     return pd.Series(rfecv.grid_scores_, index=x, name='Accuracy')
 
 
+def _importance_path_feature_selection(feature_data, targets, estimator,
+                                       cv=5, step=0.05, scoring=None,
+                                       n_jobs=1):
+    '''Optimize feature depth by ranking features once per CV fold and
+    scoring the top-ranked subsets of a geometric grid of sizes.
+
+    This is a faster alternative to _rfecv_feature_selection: features are
+    ranked by a single fit per fold (feature_importances_ or coef_) instead
+    of being eliminated step by step, and the subsets are scored in
+    parallel. Accepts the same parameters (the grid has about 1 / step
+    sizes) and returns importance and rfe_scores in the same form.
+    '''
+    dv = clone(estimator.named_steps.dv).fit(feature_data)
+    names = dv.get_feature_names()
+    X = dv.transform(feature_data)
+    y = targets.values.ravel()
+    est = estimator.named_steps.est
+    n_features = X.shape[1]
+
+    sizes = np.unique(np.round(np.geomspace(
+        1, n_features, num=max(2, int(np.ceil(1 / step))))).astype(int))
+    splits = list(check_cv(cv, y, classifier=is_classifier(est)).split(X, y))
+    scorer = check_scoring(est, scoring=scoring)
+
+    parallel = Parallel(n_jobs=n_jobs)
+    rankings = parallel(
+        delayed(_rank_features)(clone(est), X[train], y[train])
+        for train, _ in splits)
+    scores = parallel(
+        delayed(_score_feature_subset)(
+            clone(est), X, y, train, test, ranking[:k], scorer)
+        for (train, test), ranking in zip(splits, rankings) for k in sizes)
+    scores = np.reshape(scores, (len(splits), len(sizes))).mean(axis=0)
+
+    # rank features on the full training set; as for RFECV, selected
+    # features have rank 1
+    n_opt = sizes[np.argmax(scores)]
+    ranking = np.empty(n_features, dtype=int)
+    ranking[_rank_features(clone(est), X, y)] = np.maximum(
+        np.arange(n_features) - n_opt + 2, 1)
+    importance = _extract_important_features(names, ranking)
+    importance = sort_importances(importance, ascending=True)[:n_opt]
+
+    rfe_scores = pd.Series(scores, index=sizes, name='Accuracy')
+
+    return importance, rfe_scores
+
+
+def _rank_features(estimator, X, y):
+    '''Return feature indices, most important first.'''
+    estimator.fit(X, y)
+    try:
+        importances = estimator.feature_importances_
+    except AttributeError:
+        importances = np.abs(estimator.coef_)
+        if importances.ndim > 1:
+            importances = importances.sum(axis=0)
+    return np.argsort(-np.ravel(importances), kind='stable')
+
+
+def _score_feature_subset(estimator, X, y, train, test, features, scorer):
+    X = X[:, features]
+    estimator.fit(X[train], y[train])
+    return scorer(estimator, X[test], y[test])
+
+
 def nested_cross_validation(table, metadata, cv, random_state, n_jobs,
                             n_estimators, estimator, stratify,
                             parameter_tuning, classification, scoring,
-                            missing_samples='error'):
+                            missing_samples='error', parallel_folds=False,
+                            tuning_strategy='random', tuning_iterations=20,
+                            evaluation='cv'):
     # extract column name from NumericMetadataColumn
     column = metadata.name
 
+    if evaluation == 'oob':
+        _validate_oob_evaluation(estimator, parameter_tuning)
+
     # load feature data, metadata targets
     X_train, y_train = _load_data(
         table, metadata, missing_samples=missing_samples)
@@ -285,21 +475,38 @@ def nested_cross_validation(table, metadata, cv, random_state, n_jobs,
     # specify parameters and distributions to sample from for parameter tuning
     estimator, param_dist, parameter_tuning = _set_parameters_and_estimator(
         estimator, table, y_train[column], column, n_estimators, n_jobs, cv,
-        random_state, parameter_tuning, classification)
-
-    # predict values for all samples via (nested) CV
-    scores, predictions, importances, tops, probabilities = \
-        _fit_and_predict_cv(
-            X_train, y_train[column], estimator, param_dist, n_jobs, scoring,
-            random_state, cv, stratify, calc_feature_importance,
-            parameter_tuning)
+        random_state, parameter_tuning, classification,
+        tuning_strategy=tuning_strategy, tuning_iterations=tuning_iterations)
+
+    # predict values for all samples via (nested) CV or from a single fit,
+    # using out-of-bag predictions
+    if evaluation == 'oob':
+        scores, predictions, importances, tops, probabilities = \
+            _fit_and_predict_oob(
+                X_train, y_train[column], estimator, scoring,
+                calc_feature_importance)
+    else:
+        scores, predictions, importances, tops, probabilities = \
+            _fit_and_predict_cv(
+                X_train, y_train[column], estimator, param_dist, n_jobs,
+                scoring, random_state, cv, stratify, calc_feature_importance,
+                parameter_tuning, parallel_folds, tuning_strategy,
+                tuning_iterations)
 
     # Print accuracy score to stdout
     print("Estimator Accuracy: {0} ± {1}".format(
         np.mean(scores), np.std(scores)))
 
-    # TODO: save down estimator with tops parameters (currently the estimator
-    # would be untrained, and tops parameters are not reported)
+    # Print the tuned parameters selected most often across outer folds
+    if tops is not None:
+        print("Most frequent best parameters: {0}".format(
+            json.dumps(tops, sort_keys=True)))
+
+    # TODO: the tuned parameters are only printed. Neither the ncv outputs
+    # (predictions, feature importance, probabilities) nor their types can
+    # hold them, so surfacing tops needs a new output (e.g., a parameter
+    # table or an estimator refit on all samples with tops), which changes
+    # the outputs of classify_samples_ncv and regress_samples_ncv.
 
     return predictions['prediction'], importances, probabilities
 
@@ -307,7 +514,9 @@ def nested_cross_validation(table, metadata, cv, random_state, n_jobs,
 def _fit_estimator(features, targets, estimator, n_estimators=100, step=0.05,
                    cv=5, random_state=None, n_jobs=1,
                    optimize_feature_selection=False, parameter_tuning=False,
-                   missing_samples='error', classification=True):
+                   missing_samples='error', classification=True,
+                   tuning_strategy='random', tuning_iterations=20,
+                   selection_method='rfecv'):
     # extract column name from CategoricalMetadataColumn
     column = targets.to_series().name
 
@@ -322,25 +531,43 @@ def _fit_estimator(features, targets, estimator, n_estimators=100, step=0.05,
     # specify parameters and distributions to sample from for parameter tuning
     estimator, param_dist, parameter_tuning = _set_parameters_and_estimator(
         estimator, features, targets, column, n_estimators, n_jobs, cv,
-        random_state, parameter_tuning, classification=classification)
-
-    # optimize training feature count
-    if optimize_feature_selection:
-        X_train, importances, rfe_scores = _optimize_feature_selection(
-            X_train=X_train, y_train=y_train,
-            estimator=estimator, cv=cv, step=step, n_jobs=n_jobs)
-    else:
-        importances = None
+        random_state, parameter_tuning, classification=classification,
+        tuning_strategy=tuning_strategy, tuning_iterations=tuning_iterations)
+
+    # split n_jobs between search/selection workers, the estimator and BLAS
+    budget = _parallel_budget(n_jobs, search=_search_tasks(
+        cv, step, parameter_tuning, tuning_iterations,
+        optimize_feature_selection, selection_method))
+    estimator = _set_estimator_n_jobs(estimator, budget['estimator'])
+
+    with threadpool_limits(limits=budget['blas_threads']):
+        # optimize training feature count
+        if optimize_feature_selection:
+            X_train, importances, rfe_scores = _optimize_feature_selection(
+                X_train=X_train, y_train=y_train,
+                estimator=estimator, cv=cv, step=step,
+                n_jobs=budget['search'], selection_method=selection_method)
+        else:
+            importances = None
 
-    # optimize tuning parameters on your training set
-    if parameter_tuning:
-        # tune parameters
-        estimator = _tune_parameters(
-            X_train, y_train, estimator, param_dist, n_iter_search=20,
-            n_jobs=n_jobs, cv=cv, random_state=random_state).best_estimator_
+        # optimize tuning parameters on your training set
+        if parameter_tuning:
+            # tune parameters; the best estimator is refit on the training set
+            estimator = _tune_parameters(
+                X_train, y_train, estimator, param_dist,
+                n_iter_search=tuning_iterations, n_jobs=budget['search'],
+                cv=cv, random_state=random_state,
+                tuning_strategy=tuning_strategy)
+        else:
+            # fit estimator
+            estimator.fit(X_train, y_train.values.ravel())
 
-    # fit estimator
-    estimator.fit(X_train, y_train.values.ravel())
+    # restore the full budget for prediction, and record the split in the
+    # model index when the artifact is written
+    estimator = _set_estimator_n_jobs(estimator, n_jobs)
+    set_save_options(estimator, parallel_budget=budget)
+    estimator.training_shape = (
+        len(y_train), len(estimator.named_steps.dv.feature_names_))
 
     importances = _attempt_to_calculate_feature_importances(
         estimator, calc_feature_importance,
@@ -397,12 +624,16 @@ def _prepare_training_data(features, targets, column, test_size,
     return X_train, X_test, y_train, y_test
 
 
-def _optimize_feature_selection(X_train, y_train, estimator, cv, step, n_jobs):
-    importance, rfe_scores = _rfecv_feature_selection(
+def _optimize_feature_selection(X_train, y_train, estimator, cv, step, n_jobs,
+                                selection_method='rfecv'):
+    if selection_method == 'importance':
+        select_features = _importance_path_feature_selection
+    else:
+        select_features = _rfecv_feature_selection
+    importance, rfe_scores = select_features(
         X_train, y_train, estimator=estimator, cv=cv, step=step, n_jobs=n_jobs)
 
-    index = set(importance.index)
-    X_train = [{k: r[k] for k in r.keys() & index} for r in X_train]
+    X_train = X_train.select_features(importance.index)
     return X_train, importance, rfe_scores
 
 
@@ -439,13 +670,34 @@ def _predict_and_plot(output_dir, y_test, y_pred, vmin=None, vmax=None,
         predictions = _linear_regress(y_test, y_pred)
         predict_plot = _regplot_from_dataframe(y_test, y_pred)
     if output_dir is not None:
-        predict_plot.get_figure().savefig(
-            join(output_dir, 'predictions.png'), bbox_inches='tight')
-        predict_plot.get_figure().savefig(
-            join(output_dir, 'predictions.pdf'), bbox_inches='tight')
+        _save_figures(output_dir, {'predictions': (
+            predict_plot.get_figure(), {'bbox_inches': 'tight'})})
     return predictions, predict_plot
 
 
+def _savefig(figure, fp, kwargs):
+    # render with Agg, regardless of the backend pyplot was set up with
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    FigureCanvasAgg(figure)
+    figure.savefig(fp, **kwargs)
+
+
+def _save_figures(output_dir, figures, figure_format='png+pdf', n_jobs=1):
+    '''Save figures, a dict of {name: (figure, savefig kwargs)}, to
+    output_dir/name.ext for each file extension of figure_format. With
+    n_jobs > 1, figures and formats are rendered in parallel processes.'''
+    tasks = [(figure, join(output_dir, '{0}.{1}'.format(name, ext)), kwargs)
+             for name, (figure, kwargs) in figures.items()
+             for ext in figure_formats[figure_format]]
+    n_jobs = min(effective_n_jobs(n_jobs), len(tasks))
+    if n_jobs > 1:
+        Parallel(n_jobs=n_jobs)(delayed(_savefig)(*task) for task in tasks)
+    else:
+        for task in tasks:
+            _savefig(*task)
+
+
 def _class_overlap_error():
     raise ValueError(
         'Predicted and true metadata values do not overlap. Check your '
@@ -475,7 +727,7 @@ def _match_series_or_die(predictions, truth, missing_samples='error'):
 
 def _plot_accuracy(output_dir, predictions, truth, probabilities,
                    missing_samples, classification, palette, plot_title,
-                   vmin=None, vmax=None):
+                   vmin=None, vmax=None, figure_format='png+pdf', n_jobs=1):
     '''Plot accuracy results and send to visualizer on either categorical
     or numeric data inside two pd.Series
     '''
@@ -485,21 +737,25 @@ def _plot_accuracy(output_dir, predictions, truth, probabilities,
 
     # calculate prediction accuracy and plot results
     predictions, predict_plot = _predict_and_plot(
-        output_dir, truth, predictions, vmin=vmin, vmax=vmax,
+        None, truth, predictions, vmin=vmin, vmax=vmax,
         classification=classification, palette=palette)
+    figures = {'predictions': (
+        predict_plot.get_figure(), {'bbox_inches': 'tight'})}
 
     # optionally generate ROC curves for classification results
     if probabilities is not None:
         probabilities, truth = _match_series_or_die(
             probabilities, truth, missing_samples)
         roc = _generate_roc_plots(truth, probabilities, palette)
-        roc.savefig(join(output_dir, 'roc_plot.png'), bbox_inches='tight')
-        roc.savefig(join(output_dir, 'roc_plot.pdf'), bbox_inches='tight')
+        figures['roc_plot'] = (roc, {'bbox_inches': 'tight'})
+
+    # all figures are saved at once, so that they can be rendered in parallel
+    _save_figures(output_dir, figures, figure_format, n_jobs)
 
     # output to viz
-    _visualize(output_dir=output_dir, estimator=None, cm=predictions,
+    _visualize(output_dir=output_dir, parameters=None, cm=predictions,
                roc=probabilities, optimize_feature_selection=False,
-               title=plot_title)
+               title=plot_title, figure_format=figure_format)
 
 
 def sort_importances(importances, ascending=False):
@@ -507,40 +763,44 @@ def sort_importances(importances, ascending=False):
         by=importances.columns[0], ascending=ascending)
 
 
-def _extract_estimator_parameters(estimator):
-    # summarize model accuracy and params
-    # (drop pipeline params and individual base estimators)
-    estimator_params = {k: v for k, v in estimator.get_params().items() if
-                        k.startswith('est__') and k != 'est__base_estimator'}
-    return pd.Series(estimator_params, name='Parameter setting')
+def _summarize_estimator(output_dir, sample_estimator,
+                         figure_format='png+pdf'):
+    import matplotlib.pyplot as plt
 
-
-def _summarize_estimator(output_dir, sample_estimator):
-    try:
-        rfep = _plot_RFE(
-            x=sample_estimator.rfe_scores.index, y=sample_estimator.rfe_scores)
-        rfep.savefig(join(output_dir, 'rfe_plot.png'))
-        rfep.savefig(join(output_dir, 'rfe_plot.pdf'))
+    # a ModelIndex, or a trained pipeline to build one from
+    if not isinstance(sample_estimator, ModelIndex):
+        sample_estimator = model_index(sample_estimator)
+    rfe_scores = sample_estimator.rfe_scores
+    optimize_feature_selection = rfe_scores is not None
+    if optimize_feature_selection:
+        rfep = _plot_RFE(x=rfe_scores.index, y=rfe_scores)
+        _save_figures(output_dir, {'rfe_plot': (rfep, {})}, figure_format)
         plt.close('all')
-        optimize_feature_selection = True
-    # if the rfe_scores attribute does not exist, do nothing
-    except AttributeError:
-        optimize_feature_selection = False
 
-    _visualize(output_dir=output_dir, estimator=sample_estimator, cm=None,
-               roc=None, optimize_feature_selection=optimize_feature_selection,
-               title='Estimator Summary')
+    # the n_jobs split is listed with the estimator parameters
+    parameters = sample_estimator.parameters
+    budget = sample_estimator.parallel_budget
+    if budget is not None:
+        parameters = pd.concat([parameters, pd.Series(
+            {'parallel_budget__' + k: v for k, v in budget.items()},
+            name=parameters.name, dtype=object)])
+
+    _visualize(output_dir=output_dir, parameters=parameters,
+               cm=None, roc=None,
+               optimize_feature_selection=optimize_feature_selection,
+               title='Estimator Summary', figure_format=figure_format)
 
 
-def _visualize(output_dir, estimator, cm, roc,
-               optimize_feature_selection=True, title='results'):
+def _visualize(output_dir, parameters, cm, roc,
+               optimize_feature_selection=True, title='results',
+               figure_format='png+pdf'):
+    import q2templates
 
     pd.set_option('display.max_colwidth', None)
 
-    # summarize model accuracy and params
-    if estimator is not None:
-        result = _extract_estimator_parameters(estimator)
-        result = q2templates.df_to_html(result.to_frame())
+    # summarize model params
+    if parameters is not None:
+        result = q2templates.df_to_html(parameters.to_frame())
     else:
         result = False
 
@@ -552,49 +812,195 @@ def _visualize(output_dir, estimator, cm, roc,
     if roc is not None:
         roc = True
 
-    index = join(TEMPLATES, 'index.html')
+    index = join(_templates(), 'index.html')
+    # figures are displayed in the first format and downloaded in the last
+    extensions = figure_formats[figure_format]
     q2templates.render(index, output_dir, context={
         'title': title,
         'result': result,
         'predictions': cm,
         'roc': roc,
-        'optimize_feature_selection': optimize_feature_selection})
+        'optimize_feature_selection': optimize_feature_selection,
+        'image_ext': extensions[0],
+        'download_ext': extensions[-1]})
 
 
-def _visualize_knn(output_dir, params: pd.Series):
-    result = q2templates.df_to_html(params.to_frame())
-    index = join(TEMPLATES, 'index.html')
+def _visualize_knn(output_dir, accuracy: pd.DataFrame):
+    import q2templates
+
+    # predictions are made with the most accurate k (the first, if tied)
+    best_k = accuracy['Accuracy'].idxmax()
+    accuracy['Best'] = np.where(accuracy.index == best_k, '*', '')
+    index = join(_templates(), 'index.html')
     q2templates.render(index, output_dir, context={
-        'title': 'Estimator Summary',
-        'result': result,
+        'title': 'KNN accuracy by k',
+        'result': False,
         'predictions': None,
-        'importances': None,
-        'classification': True,
+        'k_accuracy': q2templates.df_to_html(accuracy),
         'optimize_feature_selection': False})
 
 
+def _parallel_budget(n_jobs, folds=1, search=1):
+    '''Split one n_jobs budget between the nested levels of parallelism.
+
+    folds: int
+        Number of outer CV folds that can run concurrently (1 if serial).
+    search: int
+        Number of concurrent inner tasks (parameter search candidates x CV
+        folds, or RFE folds; 1 if none).
+
+    Outer levels are served first; each level gets at most as many jobs as
+    it has tasks and the remainder is divided among its workers. The
+    estimator gets what is left for each search worker, and BLAS/OpenMP
+    threads are capped to the same number, so that the product of all
+    levels never exceeds n_jobs.
+    '''
+    total = effective_n_jobs(n_jobs)
+    fold_jobs = max(1, min(total, folds))
+    remaining = max(1, total // fold_jobs)
+    search_jobs = max(1, min(remaining, search))
+    estimator_jobs = max(1, remaining // search_jobs)
+    return {'n_jobs': total, 'folds': fold_jobs, 'search': search_jobs,
+            'estimator': estimator_jobs, 'blas_threads': estimator_jobs}
+
+
+def _search_tasks(cv, step, parameter_tuning, tuning_iterations,
+                  optimize_feature_selection=False, selection_method='rfecv'):
+    '''Number of concurrent tasks in the inner search and selection stages.'''
+    tasks = 1
+    if parameter_tuning:
+        tasks = max(tasks, tuning_iterations * cv)
+    if optimize_feature_selection:
+        if selection_method == 'importance':
+            tasks = max(tasks, cv * int(np.ceil(1 / step)))
+        else:
+            tasks = max(tasks, cv)
+    return tasks
+
+
+def _set_estimator_n_jobs(estimator, n_jobs):
+    if 'est__n_jobs' in estimator.get_params():
+        estimator.set_params(est__n_jobs=n_jobs)
+    return estimator
+
+
 def _map_params_to_pipeline(param_dist):
     return {'est__' + param: dist for param, dist in param_dist.items()}
 
 
 def _tune_parameters(X_train, y_train, estimator, param_dist, n_iter_search=20,
-                     n_jobs=1, cv=None, random_state=None):
-    # run randomized search
-    random_search = RandomizedSearchCV(
-        estimator, param_distributions=param_dist, n_iter=n_iter_search,
-        n_jobs=n_jobs, cv=cv, random_state=random_state)
-    random_search.fit(X_train, y_train.values.ravel())
-    return random_search
+                     n_jobs=1, cv=None, random_state=None,
+                     tuning_strategy='random'):
+    '''Search param_dist and return estimator refit on the full training set
+    with the best parameters found.
+
+    tuning_strategy: str
+        'random' evaluates n_iter_search candidates with full-size fits.
+        'halving' runs successive halving over n_iter_search candidates:
+        every round only the best third of the candidates is kept and the
+        resource is tripled. The resource is the number of trees for
+        ensembles (est__n_estimators), otherwise the number of samples.
+    '''
+    y_train = y_train.values.ravel()
+    if tuning_strategy == 'random':
+        random_search = RandomizedSearchCV(
+            estimator, param_distributions=param_dist, n_iter=n_iter_search,
+            n_jobs=n_jobs, cv=cv, random_state=random_state)
+        random_search.fit(X_train, y_train)
+        return random_search.best_estimator_
+
+    if 'est__n_estimators' in estimator.get_params():
+        resource = 'est__n_estimators'
+        max_resources = estimator.get_params()[resource]
+    else:
+        resource = 'n_samples'
+        max_resources = 'auto'
+    halving_search = HalvingRandomSearchCV(
+        estimator, param_distributions=param_dist, n_candidates=n_iter_search,
+        resource=resource, max_resources=max_resources,
+        min_resources='exhaust', n_jobs=n_jobs, cv=cv,
+        random_state=random_state, refit=False)
+    halving_search.fit(X_train, y_train)
+    # the last round may stop short of max_resources, so refit the winner
+    # with the full number of trees
+    best_params = dict(halving_search.best_params_)
+    best_params.pop(resource, None)
+    return clone(estimator).set_params(**best_params).fit(X_train, y_train)
+
+
+def _fit_and_predict_fold(estimator, features, metadata, train_index,
+                          test_index, param_dist, n_jobs, scoring,
+                          random_state, cv, calc_feature_importance,
+                          parameter_tuning, tuning_strategy='random',
+                          tuning_iterations=20, blas_threads=None):
+    '''Fit estimator on one outer CV training set and predict its test set.'''
+    X_train = features[train_index]
+    y_train = metadata.iloc[train_index]
+    with threadpool_limits(limits=blas_threads):
+        # perform parameter tuning in inner loop
+        if parameter_tuning:
+            estimator = _tune_parameters(
+                X_train, y_train, estimator, param_dist,
+                n_iter_search=tuning_iterations, n_jobs=n_jobs, cv=cv,
+                random_state=random_state, tuning_strategy=tuning_strategy)
+        else:
+            # fit estimator on inner outer training set
+            estimator.fit(X_train, y_train.values.ravel())
+    # predict values for outer loop test set
+    test_set = features[test_index]
+    index = metadata.iloc[test_index]
+    pred = np.asarray(estimator.predict(test_set))
+
+    # log prediction probabilities (classifiers only)
+    if estimator.named_steps.est.__class__.__name__ in _classifiers:
+        probs = predict_probabilities(estimator, test_set, index.index)
+        probs = (probs.values, probs.columns)
+    else:
+        probs = None
+
+    # log accuracy on that fold
+    score = scoring(pred, index)
+    # log feature importances
+    if calc_feature_importance:
+        imp = _calculate_feature_importances(estimator)
+    else:
+        imp = None
+    # log top parameters
+    if parameter_tuning:
+        params = _tuned_parameters_key(estimator, param_dist)
+    else:
+        params = None
+    return pred, probs, score, imp, params
+
+
+def _tuned_parameters_key(estimator, param_names):
+    '''Return the values of the tuned parameters of a fitted pipeline as a
+    canonical JSON string (sorted keys, builtin types), so that the winning
+    parameter sets of different folds can be hashed and counted.
+    '''
+    est_params = estimator.named_steps.est.get_params(deep=False)
+    tuned = {}
+    for name in param_names:
+        value = est_params[name[len('est__'):]]
+        if isinstance(value, np.generic):
+            value = value.item()
+        tuned[name] = value
+    return json.dumps(tuned, sort_keys=True)
 
 
 def _fit_and_predict_cv(table, metadata, estimator, param_dist, n_jobs,
                         scoring=accuracy_score, random_state=None, cv=10,
                         stratify=True, calc_feature_importance=False,
-                        parameter_tuning=False):
+                        parameter_tuning=False, parallel_folds=False,
+                        tuning_strategy='random', tuning_iterations=20):
     '''train and test estimators via cross-validation.
     scoring: str
         use accuracy_score for classification, mean_squared_error for
         regression.
+    parallel_folds: bool
+        fit outer folds concurrently in a process pool. n_jobs is split
+        between the folds and the estimator (or inner parameter search) of
+        each fold. Results are identical to fitting folds serially.
     '''
     # Set CV method
     if stratify:
@@ -603,72 +1009,152 @@ def _fit_and_predict_cv(table, metadata, estimator, param_dist, n_jobs,
     else:
         _cv = KFold(n_splits=cv, shuffle=True, random_state=random_state)
 
-    predictions = pd.DataFrame()
-    probabilities = pd.DataFrame()
-    scores = []
-    top_params = []
-    importances = []
     if isinstance(table, biom.Table):
         features = _extract_features(table)
     else:
         features = table
-    for train_index, test_index in _cv.split(features, metadata):
-        X_train = features[train_index]
-        y_train = metadata.iloc[train_index]
-        # perform parameter tuning in inner loop
-        if parameter_tuning:
-            estimator = _tune_parameters(
-                X_train, y_train, estimator, param_dist,
-                n_iter_search=20, n_jobs=n_jobs, cv=cv,
-                random_state=random_state).best_estimator_
-        else:
-            # fit estimator on inner outer training set
-            estimator.fit(X_train, y_train.values.ravel())
-        # predict values for outer loop test set
-        test_set = features[test_index]
-        index = metadata.iloc[test_index]
-        pred = pd.DataFrame(estimator.predict(test_set), index=index.index)
-
-        # log predictions results
-        predictions = pd.concat([predictions, pred])
-
-        # log prediction probabilities (classifiers only)
-        if estimator.named_steps.est.__class__.__name__ in _classifiers:
-            probs = predict_probabilities(estimator, test_set, index.index)
-            probabilities = pd.concat([probabilities, probs])
-
-        # log accuracy on that fold
-        scores += [scoring(pred, index)]
-        # log feature importances
-        if calc_feature_importance:
-            imp = _calculate_feature_importances(estimator)
-            importances += [imp]
-        # log top parameters
-        # for now we will cast as a str (instead of dict) so that we can count
-        # frequency of unique elements below
-        top_params += [str(estimator.named_steps.est.get_params())]
+    folds = list(_cv.split(features, metadata))
+
+    # split n_jobs between outer folds, inner search, estimator and BLAS
+    budget = _parallel_budget(
+        n_jobs, folds=len(folds) if parallel_folds else 1,
+        search=_search_tasks(cv, None, parameter_tuning, tuning_iterations))
+    estimator = _set_estimator_n_jobs(clone(estimator), budget['estimator'])
+
+    # large arrays in features are memory-mapped rather than copied to
+    # each worker
+    results = Parallel(n_jobs=budget['folds'])(
+        delayed(_fit_and_predict_fold)(
+            clone(estimator), features, metadata, train_index, test_index,
+            param_dist, budget['search'], scoring, random_state, cv,
+            calc_feature_importance, parameter_tuning, tuning_strategy,
+            tuning_iterations, budget['blas_threads'])
+        for train_index, test_index in folds)
+
+    predictions, probabilities = _collect_cv_predictions(
+        metadata.index, folds, [r[0] for r in results],
+        [r[1] for r in results])
+    scores = [r[2] for r in results]
+    importances = [r[3] for r in results]
+    top_params = [r[4] for r in results]
 
     # Report most frequent best params
-    # convert top_params to a set, order by count (hence str conversion above)
-    # max will be the most frequent... then we convert back to a dict via eval
-    # which should be safe since this is always a dict of param values reported
-    # by sklearn.
-    tops = max(set(top_params), key=top_params.count)
-    tops = eval(tops)
+    if parameter_tuning:
+        tops, _ = Counter(top_params).most_common(1)[0]
+        tops = json.loads(tops)
+    else:
+        tops = None
 
     # calculate mean feature importances
     if calc_feature_importance:
         importances = _mean_feature_importance(importances)
     else:
-        importances = _null_feature_importance(table)
-
-    predictions.columns = ['prediction']
-    predictions.index.name = 'SampleID'
-    probabilities.index.name = 'SampleID'
+        importances = _null_feature_importance(features)
 
     return scores, predictions, importances, tops, probabilities
 
 
+def _collect_cv_predictions(index, folds, fold_predictions,
+                            fold_probabilities):
+    '''Assemble per-fold predictions (and class probabilities) into frames.
+
+    Fold results are written into arrays preallocated for all samples, at
+    the positions given by each fold's test indices, and the frames are
+    built once. Rows are ordered by fold, in the order the folds were split.
+    Probability columns are the union of the classes seen by each fold's
+    estimator, in order of first appearance; classes unknown to a fold are
+    NaN.
+    '''
+    order = np.concatenate([test_index for _, test_index in folds])
+    sample_ids = index[order]
+    sample_ids.name = 'SampleID'
+
+    predictions = np.empty(
+        len(index), dtype=np.result_type(*fold_predictions))
+    for (_, test_index), pred in zip(folds, fold_predictions):
+        predictions[test_index] = pred
+    predictions = pd.DataFrame(
+        predictions[order], index=sample_ids, columns=['prediction'])
+
+    fold_probabilities = [
+        (test_index, probs) for (_, test_index), probs in
+        zip(folds, fold_probabilities) if probs is not None]
+    if not fold_probabilities:
+        probabilities = pd.DataFrame()
+        probabilities.index.name = 'SampleID'
+        return predictions, probabilities
+
+    classes = pd.Index([])
+    for _, (_, columns) in fold_probabilities:
+        classes = classes.append(columns[~columns.isin(classes)])
+    probabilities = np.full((len(index), len(classes)), np.nan)
+    for test_index, (probs, columns) in fold_probabilities:
+        probabilities[np.ix_(test_index, classes.get_indexer(columns))] = probs
+    probabilities = pd.DataFrame(
+        probabilities[order], index=sample_ids, columns=classes)
+
+    return predictions, probabilities
+
+
+def _validate_oob_evaluation(estimator, parameter_tuning):
+    if estimator not in _oob_estimators:
+        raise ValueError(
+            'Out-of-bag evaluation is only supported for bagged ensemble '
+            'estimators ({0}), not {1}. Use evaluation="cv" for this '
+            'estimator.'.format(', '.join(_oob_estimators), estimator))
+    if parameter_tuning:
+        raise ValueError(
+            'Parameter tuning requires cross-validation and cannot be '
+            'combined with out-of-bag evaluation. Disable parameter_tuning '
+            'or use evaluation="cv".')
+
+
+def _fit_and_predict_oob(features, metadata, estimator, scoring=accuracy_score,
+                         calc_feature_importance=True):
+    '''Fit a bagged ensemble once and predict every sample from the trees
+    whose bootstrap sample left it out (out-of-bag). Returns the same values
+    as _fit_and_predict_cv.
+    '''
+    estimator.set_params(est__bootstrap=True, est__oob_score=True)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always', UserWarning)
+        estimator.fit(features, metadata.values.ravel())
+    # sklearn warns (and leaves placeholder values) for samples that were
+    # included in every bootstrap sample
+    missing_oob = False
+    for w in caught:
+        if 'do not have OOB scores' in str(w.message):
+            missing_oob = True
+        else:
+            warnings.warn_explicit(w.message, w.category, w.filename, w.lineno)
+    if missing_oob:
+        raise ValueError(
+            'Some samples were used to grow every tree, so they have no '
+            'out-of-bag prediction. Increase n_estimators or use '
+            'evaluation="cv".')
+
+    est = estimator.named_steps.est
+    index = metadata.index.copy()
+    index.name = 'SampleID'
+    if estimator.named_steps.est.__class__.__name__ in _classifiers:
+        probabilities = pd.DataFrame(
+            est.oob_decision_function_, index=index, columns=est.classes_)
+        pred = est.classes_[np.argmax(est.oob_decision_function_, axis=1)]
+    else:
+        probabilities = pd.DataFrame()
+        probabilities.index.name = 'SampleID'
+        pred = est.oob_prediction_
+    predictions = pd.DataFrame(pred, index=index, columns=['prediction'])
+
+    scores = [scoring(pred, metadata)]
+    if calc_feature_importance:
+        importances = _calculate_feature_importances(estimator)
+    else:
+        importances = _null_feature_importance(features)
+
+    return scores, predictions, importances, None, probabilities
+
+
 def predict_probabilities(estimator, test_set, index):
     '''
     Predict class probabilities for a set of test samples.
@@ -701,7 +1187,7 @@ def _mean_feature_importance(importances):
 
 
 def _null_feature_importance(table):
-    feature_extractor = DictVectorizer()
+    feature_extractor = SparseFeatureVectorizer()
     feature_extractor.fit(table)
     imp = pd.DataFrame(index=feature_extractor.get_feature_names())
     imp.index.name = "feature"
@@ -711,6 +1197,14 @@ def _null_feature_importance(table):
 
 def _select_estimator(estimator, n_jobs, n_estimators, random_state=None):
     '''Select estimator and parameters from argument name.'''
+    from sklearn.ensemble import (
+        RandomForestRegressor, RandomForestClassifier, ExtraTreesClassifier,
+        ExtraTreesRegressor, GradientBoostingClassifier,
+        GradientBoostingRegressor)
+    from sklearn.svm import LinearSVC, SVR, SVC
+    from sklearn.linear_model import Ridge, Lasso, ElasticNet
+    from sklearn.neighbors import KNeighborsClassifier, KNeighborsRegressor
+
     # Regressors
     if estimator == 'RandomForestRegressor':
         param_dist = {**parameters['ensemble'], **parameters['bootstrap']}
@@ -779,7 +1273,12 @@ def _train_adaboost_base_estimator(table, metadata, column, n_estimators,
                                    n_jobs, cv, random_state=None,
                                    parameter_tuning=False,
                                    classification=True,
-                                   missing_samples='error'):
+                                   missing_samples='error',
+                                   tuning_strategy='random',
+                                   tuning_iterations=20):
+    from sklearn.ensemble import AdaBoostClassifier, AdaBoostRegressor
+    from sklearn.tree import DecisionTreeClassifier, DecisionTreeRegressor
+
     param_dist = parameters['ensemble']
     if classification:
         base_estimator = DecisionTreeClassifier()
@@ -788,7 +1287,7 @@ def _train_adaboost_base_estimator(table, metadata, column, n_estimators,
         base_estimator = DecisionTreeRegressor()
         adaboost_estimator = AdaBoostRegressor
     base_estimator = Pipeline(
-        [('dv', DictVectorizer()), ('est', base_estimator)])
+        [('dv', SparseFeatureVectorizer()), ('est', base_estimator)])
 
     if parameter_tuning:
         features, targets = _load_data(
@@ -796,7 +1295,8 @@ def _train_adaboost_base_estimator(table, metadata, column, n_estimators,
         param_dist = _map_params_to_pipeline(param_dist)
         base_estimator = _tune_parameters(
             features, targets[column], base_estimator, param_dist,
-            n_jobs=n_jobs, cv=cv, random_state=random_state).best_estimator_
+            n_iter_search=tuning_iterations, n_jobs=n_jobs, cv=cv,
+            random_state=random_state, tuning_strategy=tuning_strategy)
 
     return Pipeline(
         [('dv', base_estimator.named_steps.dv),
@@ -822,19 +1322,23 @@ def _disable_feature_selection(estimator, optimize_feature_selection):
 def _set_parameters_and_estimator(estimator, table, metadata, column,
                                   n_estimators, n_jobs, cv, random_state,
                                   parameter_tuning, classification=True,
-                                  missing_samples='error'):
+                                  missing_samples='error',
+                                  tuning_strategy='random',
+                                  tuning_iterations=20):
     # specify parameters and distributions to sample from for parameter tuning
     if estimator in ['AdaBoostClassifier', 'AdaBoostRegressor']:
         estimator = _train_adaboost_base_estimator(
             table, metadata, column, n_estimators, n_jobs, cv, random_state,
             parameter_tuning, classification=classification,
-            missing_samples=missing_samples)
+            missing_samples=missing_samples, tuning_strategy=tuning_strategy,
+            tuning_iterations=tuning_iterations)
         parameter_tuning = False
         param_dist = None
     else:
         param_dist, estimator = _select_estimator(
             estimator, n_jobs, n_estimators, random_state)
-        estimator = Pipeline([('dv', DictVectorizer()), ('est', estimator)])
+        estimator = Pipeline(
+            [('dv', SparseFeatureVectorizer()), ('est', estimator)])
         param_dist = _map_params_to_pipeline(param_dist)
     return estimator, param_dist, parameter_tuning
 
@@ -845,3 +1349,174 @@ def _warn_feature_selection():
          'the parameter settings requested. See documentation or try a '
          'different estimator model.'))
     warnings.warn(warning, UserWarning)
+
+
+def _encode_labels(labels):
+    '''Encode labels as integer codes; missing values get their own code.'''
+    codes, uniques = pd.factorize(labels)
+    uniques = np.asarray(uniques, dtype=object)
+    if (codes < 0).any():
+        codes[codes < 0] = len(uniques)
+        uniques = np.append(uniques, np.nan)
+    return codes, uniques
+
+
+def _nearest_neighbors(distances, k, self_columns=None):
+    '''Return the column indices of the k nearest neighbors of each row of
+    distances, ordered from nearest to farthest.
+
+    Ties are broken by column index, so the result matches taking the first
+    k values of a stable sort of each row. If self_columns is given, column
+    self_columns[i] is excluded from row i (e.g., the sample itself in a
+    square distance matrix); k is capped at the number of candidates.
+    '''
+    distances = np.asarray(distances)
+    n_rows, n_columns = distances.shape
+    rows = np.arange(n_rows)
+    if self_columns is not None:
+        mask = np.ones(distances.shape, dtype=bool)
+        mask[rows, self_columns] = False
+        distances = distances[mask].reshape(n_rows, n_columns - 1)
+    k = min(k, distances.shape[1])
+
+    # the k smallest values: everything below the kth value, plus as many
+    # values equal to it as needed, lowest columns first
+    kth = np.partition(distances, k - 1, axis=1)[:, k - 1:k]
+    below = distances < kth
+    tied = distances == kth
+    n_tied = k - below.sum(axis=1, keepdims=True)
+    selected = below | (tied & (np.cumsum(tied, axis=1) <= n_tied))
+    columns = np.nonzero(selected)[1].reshape(n_rows, k)
+
+    # order by distance; the stable sort keeps ties in column order
+    order = np.argsort(
+        np.take_along_axis(distances, columns, axis=1), axis=1, kind='stable')
+    columns = np.take_along_axis(columns, order, axis=1)
+    if self_columns is not None:
+        columns += columns >= np.asarray(self_columns)[:, None]
+    return columns
+
+
+def _knn_vote(neighbor_codes, n_labels):
+    '''Majority vote over each row of neighbor label codes, ordered nearest
+    first. Ties go to the tied label of the nearest neighbor.'''
+    n_rows = neighbor_codes.shape[0]
+    offsets = np.arange(n_rows)[:, None] * n_labels
+    counts = np.bincount((neighbor_codes + offsets).ravel(),
+                         minlength=n_rows * n_labels).reshape(n_rows, n_labels)
+    neighbor_counts = np.take_along_axis(counts, neighbor_codes, axis=1)
+    winner = np.argmax(
+        neighbor_counts == counts.max(axis=1, keepdims=True), axis=1)
+    return neighbor_codes[np.arange(n_rows), winner]
+
+
+def _loo_knn_predict(distances, labels, k, block_size=1000):
+    '''Leave-one-out k-nearest-neighbors classification of the samples of
+    a square distance matrix. Rows are processed in blocks of block_size,
+    so that working memory is O(block_size x n).'''
+    predictions, _ = _loo_knn_sweep(distances, labels, [k], block_size)
+    return predictions
+
+
+def _loo_knn_sweep(distances, labels, k_values, block_size=1000):
+    '''Leave-one-out KNN classification for several values of k at once.
+
+    The neighbors of each row are found and ordered once, up to the largest
+    k; every smaller k votes over a prefix of that ordering. Returns the
+    predictions for the most accurate k (the smallest, if tied) and a
+    Series of leave-one-out accuracy indexed by k. Samples with missing
+    labels are not scored.
+    '''
+    k_values = sorted(set(k_values))
+    if not k_values or k_values[0] < 1:
+        raise ValueError('k must be at least 1.')
+    codes, uniques = _encode_labels(labels)
+    n_samples = len(codes)
+    predictions = np.empty((len(k_values), n_samples), dtype=np.intp)
+    for start in range(0, n_samples, block_size):
+        rows = np.arange(start, min(start + block_size, n_samples))
+        neighbors = codes[_nearest_neighbors(
+            distances[rows], k_values[-1], self_columns=rows)]
+        for i, k in enumerate(k_values):
+            predictions[i, rows] = _knn_vote(neighbors[:, :k], len(uniques))
+
+    labelled = ~pd.isnull(labels)
+    if labelled.any():
+        accuracy = (predictions[:, labelled] == codes[labelled]).mean(axis=1)
+    else:
+        accuracy = np.full(len(k_values), np.nan)
+    accuracy = pd.Series(
+        accuracy, index=pd.Index(k_values, name='k'), name='Accuracy')
+    best = np.argmax(accuracy.fillna(-1).values)
+    return uniques[predictions[best]], accuracy
+
+
+def _knn_predict(distances, reference_labels, k, block_size=1000):
+    '''k-nearest-neighbors classification of query samples from a query x
+    reference distance block, voting as in _loo_knn_predict.'''
+    if k < 1:
+        raise ValueError('k must be at least 1.')
+    codes, uniques = _encode_labels(reference_labels)
+    n_queries = distances.shape[0]
+    predictions = np.empty(n_queries, dtype=np.intp)
+    for start in range(0, n_queries, block_size):
+        rows = slice(start, min(start + block_size, n_queries))
+        neighbors = _nearest_neighbors(distances[rows], k)
+        predictions[rows] = _knn_vote(codes[neighbors], len(uniques))
+    return uniques[predictions]
+
+
+def _lsmat_to_memmap(lsmat_fp, memmap_fp, block_size=1000):
+    '''Stream an LSMat distance matrix file into an on-disk .npy memmap.
+
+    Rows are parsed block_size at a time, so peak memory is
+    O(block_size x n) rather than O(n x n). The memmap holds the full n x n
+    float64 matrix, so memmap_fp needs as much free disk space as the matrix
+    (8 x n^2 bytes). Each block is checked as it is written, so that the
+    matrix is rejected if it is not symmetric and hollow, as
+    skbio.DistanceMatrix would reject it. Returns the sample ids and the
+    memory-mapped matrix.
+    '''
+    with open(lsmat_fp) as fh:
+        ids = fh.readline().rstrip('\r\n').split('\t')
+    if ids[0] != '':
+        raise ValueError('Distance matrix header must begin with an empty '
+                         'field followed by the sample IDs.')
+    ids = ids[1:]
+    duplicates = pd.Index(ids)[pd.Index(ids).duplicated()].unique()
+    if len(duplicates) > 0:
+        raise DissimilarityMatrixError(
+            'IDs must be unique. Found the following duplicate IDs: '
+            '{0}'.format(', '.join(map(repr, duplicates))))
+    n_samples = len(ids)
+    distances = np.lib.format.open_memmap(
+        memmap_fp, mode='w+', dtype=np.float64, shape=(n_samples, n_samples))
+    # values are parsed exactly as float() would, so the matrix is
+    # identical to the one skbio reads into memory
+    blocks = pd.read_csv(
+        lsmat_fp, sep='\t', header=None, skiprows=1, index_col=0,
+        dtype={0: str}, na_filter=False, float_precision='round_trip',
+        chunksize=block_size)
+    start = 0
+    for block in blocks:
+        stop = start + len(block)
+        if block.shape[1] != n_samples or \
+                list(block.index) != ids[start:stop]:
+            raise ValueError('Distance matrix rows must match the sample IDs '
+                             'in the header, in the same order.')
+        block = block.values
+        if np.any(block[np.arange(stop - start), np.arange(start, stop)]):
+            raise DistanceMatrixError('Data must be hollow.')
+        # the columns of this block that precede it must mirror the rows
+        # already written; later columns are checked by later blocks
+        if not (np.array_equal(block[:, start:stop], block[:, start:stop].T)
+                and np.array_equal(block[:, :start],
+                                   distances[:start, start:stop].T)):
+            raise DistanceMatrixError('Data must be symmetric.')
+        distances[start:stop] = block
+        start = stop
+    if start != n_samples:
+        raise ValueError('Distance matrix has {0} rows but {1} sample '
+                         'IDs.'.format(start, n_samples))
+    distances.flush()
+    return ids, distances
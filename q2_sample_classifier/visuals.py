@@ -7,18 +7,30 @@
 # ----------------------------------------------------------------------------
 
 from sklearn.metrics import (
-    mean_squared_error, confusion_matrix, accuracy_score, roc_curve, auc)
+    mean_squared_error, roc_curve, auc)
 from sklearn.preprocessing import label_binarize
 from itertools import cycle
-from scipy import interp
 import pandas as pd
 import numpy as np
-import seaborn as sns
 from scipy.stats import linregress
-import matplotlib.pyplot as plt
+# seaborn and matplotlib.pyplot are slow to import, so they are imported by
+# the functions that plot rather than whenever the plugin is loaded
+
+
+# names of the palettes defined by _custom_palettes, available without
+# importing seaborn (e.g., to register the palette parameter choices)
+palette_names = [
+    'YellowOrangeBrown', 'YellowOrangeRed', 'OrangeRed', 'PurpleRed',
+    'RedPurple', 'BluePurple', 'GreenBlue', 'PurpleBlue', 'YellowGreen',
+    'summer', 'copper', 'viridis', 'cividis', 'plasma', 'inferno', 'magma',
+    'sirocco', 'drifting', 'melancholy', 'enigma', 'eros', 'spectre',
+    'ambition', 'mysteriousstains', 'daydream', 'solano', 'navarro',
+    'dandelions', 'deepblue', 'verve', 'greyscale']
 
 
 def _custom_palettes():
+    import seaborn as sns
+
     return {
         'YellowOrangeBrown': 'YlOrBr',
         'YellowOrangeRed': 'YlOrRd',
@@ -71,6 +83,9 @@ def _custom_palettes():
 def _regplot_from_dataframe(x, y, plot_style="whitegrid", arb=True,
                             color="grey"):
     '''Seaborn regplot with true 1:1 ratio set by arb (bool).'''
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+
     sns.set_style(plot_style)
     reg = sns.regplot(x, y, color=color)
     plt.xlabel('True value')
@@ -100,6 +115,9 @@ def _linear_regress(actual, pred):
 
 
 def _plot_heatmap_from_confusion_matrix(cm, palette, vmin=None, vmax=None):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+
     palette = _custom_palettes()[palette]
     plt.figure()
     scaler, labelsize, dpi, cbar_min = 20, 8, 100, .15
@@ -125,51 +143,110 @@ def _plot_heatmap_from_confusion_matrix(cm, palette, vmin=None, vmax=None):
     return heatmap
 
 
+def _class_counts(ser, classes):
+    '''Number of occurrences of each of classes in ser, as a np.array.'''
+    return ser.value_counts().reindex(classes, fill_value=0).values
+
+
 def _add_sample_size_to_xtick_labels(ser, classes):
     '''ser is a pandas series.'''
-    labels = ['{0} (n={1})'.format(c, ser[ser == c].count()) for c in classes]
+    labels = ['{0} (n={1})'.format(c, n)
+              for c, n in zip(classes, _class_counts(ser, classes))]
     return labels
 
 
-def _plot_confusion_matrix(y_test, y_pred, classes, normalize, palette,
-                           vmin=None, vmax=None):
+def _confusion_counts(y_test, y_pred, classes):
+    '''Confusion matrix of counts, with rows (true labels) and columns
+    (predicted labels) in the order of classes. Labels are integer-coded once
+    and counted with a single bincount; samples whose true or predicted label
+    is not in classes are ignored.'''
+    n_classes = len(classes)
+    true = pd.Categorical(y_test, categories=classes).codes.astype(np.int64)
+    pred = pd.Categorical(y_pred, categories=classes).codes.astype(np.int64)
+    known = (true >= 0) & (pred >= 0)
+    counts = np.bincount(true[known] * n_classes + pred[known],
+                         minlength=n_classes ** 2)
+    return counts.reshape(n_classes, n_classes)
 
-    accuracy = accuracy_score(y_test, pd.DataFrame(y_pred))
-    cm = confusion_matrix(y_test, y_pred)
-    # normalize
-    if normalize:
-        cm = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
 
+def _normalize_rows(cm):
     # fill na values (e.g., true values that were not predicted) otherwise
     # these will appear as whitespace in plots and results table.
-    cm = np.nan_to_num(cm)
-    _check_vmin_and_vmax(cm, vmin, vmax)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cm = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
+    return np.nan_to_num(cm)
+
+
+def _block_confusion_matrix(counts, y_test, y_pred, classes, max_classes,
+                            normalize):
+    '''Aggregate a confusion matrix of counts with more than max_classes
+    classes into at most max_classes blocks of consecutive classes (in the
+    sorted class order, so that, e.g., taxa sharing a lineage fall in the same
+    block). Returns the block matrix and the block tick labels for the x
+    (predicted) and y (true) axes.'''
+    block_size = int(np.ceil(len(classes) / max_classes))
+    starts = np.arange(0, len(classes), block_size)
+    cm = np.add.reduceat(np.add.reduceat(counts, starts, axis=0),
+                         starts, axis=1)
+    if normalize:
+        cm = _normalize_rows(cm)
+
+    ends = np.append(starts[1:], len(classes)) - 1
+    names = ['{0} - {1}'.format(classes[s], classes[e]) if s != e
+             else str(classes[s]) for s, e in zip(starts, ends)]
+
+    def _labels(ser):
+        sizes = np.add.reduceat(_class_counts(ser, classes), starts)
+        return ['{0} (n={1})'.format(name, n) for name, n in zip(names, sizes)]
 
-    confusion = _plot_heatmap_from_confusion_matrix(cm, palette, vmin=vmin,
-                                                    vmax=vmax)
+    return cm, _labels(y_pred), _labels(y_test)
 
-    x_tick_labels = _add_sample_size_to_xtick_labels(y_pred, classes)
-    y_tick_labels = _add_sample_size_to_xtick_labels(y_test, classes)
+
+def _plot_confusion_matrix(y_test, y_pred, classes, normalize, palette,
+                           vmin=None, vmax=None, max_classes=100):
+    '''Plot the confusion matrix of y_test and y_pred as a heatmap, and
+    return it as a pd.DataFrame along with the overall and baseline accuracy.
+    The returned matrix is always exact; if there are more than max_classes
+    classes, the heatmap shows consecutive classes aggregated into blocks.
+    '''
+    import matplotlib.pyplot as plt
+
+    counts = _confusion_counts(y_test, y_pred, classes)
+    accuracy = np.trace(counts) / len(y_test)
+    cm = _normalize_rows(counts) if normalize else counts
+
+    if len(classes) > max_classes:
+        plot_cm, x_tick_labels, y_tick_labels = _block_confusion_matrix(
+            counts, y_test, y_pred, classes, max_classes, normalize)
+    else:
+        plot_cm = cm
+        x_tick_labels = _add_sample_size_to_xtick_labels(y_pred, classes)
+        y_tick_labels = _add_sample_size_to_xtick_labels(y_test, classes)
+    _check_vmin_and_vmax(plot_cm, vmin, vmax)
+
+    confusion = _plot_heatmap_from_confusion_matrix(plot_cm, palette,
+                                                    vmin=vmin, vmax=vmax)
 
     plt.ylabel('True label')
     plt.xlabel('Predicted label')
     confusion.set_xticklabels(x_tick_labels, rotation=90, ha='center')
     confusion.set_yticklabels(y_tick_labels, rotation=0, ha='right')
 
-    # generate confusion matrix as pd.DataFrame for viewing
-    predictions = pd.DataFrame(cm, index=classes, columns=classes)
-    # add empty row/column to show overall accuracy in bottom right cell
+    # generate confusion matrix as pd.DataFrame for viewing, with an extra
+    # row/column to show overall accuracy in bottom right cell
     # baseline error = error rate for a classifier that always guesses the
     # most common class
     n_samples, n_samples_largest_class, basline_accuracy, accuracy_ratio = \
         _calculate_baseline_accuracy(y_test, accuracy)
-    predictions["Overall Accuracy"] = ""
-    predictions.loc["Overall Accuracy"] = ""
-    predictions.loc["Baseline Accuracy"] = ""
-    predictions.loc["Accuracy Ratio"] = ""
-    predictions.loc["Overall Accuracy"]["Overall Accuracy"] = accuracy
-    predictions.loc["Baseline Accuracy"]["Overall Accuracy"] = basline_accuracy
-    predictions.loc["Accuracy Ratio"]["Overall Accuracy"] = accuracy_ratio
+    n_classes = len(classes)
+    table = np.full((n_classes + 3, n_classes + 1), '', dtype=object)
+    table[:n_classes, :n_classes] = cm
+    table[n_classes:, n_classes] = [
+        accuracy, basline_accuracy, accuracy_ratio]
+    summary = ["Overall Accuracy", "Baseline Accuracy", "Accuracy Ratio"]
+    predictions = pd.DataFrame(
+        table, index=list(classes) + summary,
+        columns=list(classes) + summary[:1])
 
     return predictions, confusion
 
@@ -204,6 +281,8 @@ def _calculate_baseline_accuracy(y_test, accuracy):
 
 
 def _plot_RFE(x, y):
+    import matplotlib.pyplot as plt
+
     rfe = plt.figure()
     plt.xlabel("Feature Count")
     plt.ylabel("Accuracy")
@@ -258,6 +337,8 @@ def _roc_palette(palette, n_classes):
 
     Returns an iterator of colors.
     '''
+    import seaborn as sns
+
     palette = _custom_palettes()[palette]
 
     # specify color palette. Use different specification for str palette name
@@ -318,32 +399,44 @@ def _roc_micro_average(binarized_targets, probabilities, fpr, tpr, roc_auc):
 
 # adapted from scikit-learn examples
 # https://scikit-learn.org/stable/auto_examples/model_selection/plot_roc.html
-def _roc_macro_average(fpr, tpr, roc_auc, classes):
+def _roc_macro_average(fpr, tpr, roc_auc, classes, n_points=201):
     '''
     fpr: dict of false-positive rates for each class.
     tdr: dict of true-detection rates for each class.
     roc_auc: dict of auc scores for each class.
     classes: list of classes.
+    n_points: int number of evenly spaced false-positive rates at which the
+        class ROC curves are averaged.
 
-    Returns fpr, tdr, roc_auc with micro average scores added.
+    Returns fpr, tdr, roc_auc with macro average scores added. The macro
+        average AUC is the mean of the class AUCs, so it does not depend on
+        the resolution of the averaged curve.
     '''
-    # Aggregate all false positive rates for computing average
-    all_fpr = np.unique(np.concatenate([fpr[c] for c in classes]))
+    all_fpr = np.linspace(0, 1, n_points)
 
-    # Then interpolate all ROC curves at this point
-    mean_tpr = np.zeros_like(all_fpr)
-    for c in classes:
-        mean_tpr += interp(all_fpr, fpr[c], tpr[c])
-
-    # Finally average it and compute AUC
-    mean_tpr /= len(classes)
+    # interpolate all ROC curves at these points and average them
+    mean_tpr = np.mean(
+        [np.interp(all_fpr, fpr[c], tpr[c]) for c in classes], axis=0)
 
     fpr["macro"] = all_fpr
     tpr["macro"] = mean_tpr
-    roc_auc["macro"] = auc(fpr["macro"], tpr["macro"])
+    roc_auc["macro"] = np.mean([roc_auc[c] for c in classes])
     return fpr, tpr, roc_auc
 
 
+def _downsample_roc(fpr, tpr, max_points=200):
+    '''Select at most max_points + 1 vertices of a ROC curve for plotting,
+    evenly spaced along the curve (which is monotone, so its length from the
+    origin is fpr + tpr). The first and last vertices are always kept.'''
+    fpr, tpr = np.asarray(fpr), np.asarray(tpr)
+    if len(fpr) <= max_points + 1:
+        return fpr, tpr
+    length = fpr + tpr
+    idx = np.searchsorted(length, np.linspace(0, length[-1], max_points + 1))
+    idx = np.unique(np.r_[0, np.minimum(idx, len(fpr) - 1), len(fpr) - 1])
+    return fpr[idx], tpr[idx]
+
+
 # inspired by scikit-learn examples for multi-class ROC plots
 # https://scikit-learn.org/stable/auto_examples/model_selection/plot_roc.html
 def _roc_plot(fpr, tpr, roc_auc, classes, colors):
@@ -353,14 +446,19 @@ def _roc_plot(fpr, tpr, roc_auc, classes, colors):
     roc_auc: dict of auc scores for each class.
     classes: list of classes.
     colors: list of colors.
+
+    Curves are downsampled to a bounded number of vertices before plotting;
+    the AUC scores in the legend are those of the full curves.
     '''
+    import matplotlib.pyplot as plt
+
     fig, axes = plt.subplots(nrows=1, ncols=2, figsize=(12, 4), sharey=True)
     lw = 3
 
     # plot averages in each panel
     for i in [0, 1]:
-        axes[i].plot(fpr['micro'], tpr['micro'], color='navy', linestyle=':',
-                     lw=lw,
+        axes[i].plot(*_downsample_roc(fpr['micro'], tpr['micro']),
+                     color='navy', linestyle=':', lw=lw,
                      label='micro-average (AUC = %0.2f)' % roc_auc['micro'])
         axes[i].plot(fpr['macro'], tpr['macro'], color='lightblue',
                      linestyle=':', lw=lw,
@@ -381,7 +479,7 @@ def _roc_plot(fpr, tpr, roc_auc, classes, colors):
     axes[1].set_title('Per-Class Receiver Operating Characteristics')
 
     for c, color in zip(classes, colors):
-        plt.plot(fpr[c], tpr[c], color=color, lw=lw,
+        plt.plot(*_downsample_roc(fpr[c], tpr[c]), color=color, lw=lw,
                  label='{0} (AUC = {1:0.2f})'.format(c, roc_auc[c]))
     axes[1].legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
 